@@ -1,7 +1,6 @@
-import hashlib
-import json
 import os
 
+from fingerprint import compute_fingerprint, legacy_algorithm
 from global_config import token_key_names, token_others, stop_words_key, bold_split, thin_split
 
 
@@ -39,21 +38,41 @@ def is_token_key(param_keyname, level=0, enable_stopwords=True):
     return False
 
 
-def get_md5_from_entry(entry):
+def get_md5_from_entry(entry, algorithm=None):
     """
-    从 entry 中获取 md5, 如果没有则生成并添加到 entry 中
+    从 entry 中获取 md5（entry 的指纹）, 如果没有则生成并添加到 entry 中
     :param entry: entry 字典
+    :param algorithm: 生成时使用的指纹算法，一般为 har 中记录的算法（见 fingerprint.get_har_fingerprint_algorithm）；
+        为 None 时使用没有记录算法的 har（旧的预处理结果、未预处理的 har）所用的 md5-full，与之前的结果一致
     :return: 返回 md5
     """
 
     if 'md5' not in entry.keys():
-        entry_str = json.dumps(entry, ensure_ascii=False, sort_keys=True)
-        entry_hash = hashlib.md5(entry_str.encode()).hexdigest()
-        entry['md5'] = entry_hash
+        entry['md5'] = compute_fingerprint(entry, algorithm or legacy_algorithm)
 
     return entry['md5']
 
 
+def is_har_file(file_path, only_hash=True):
+    """
+    判断是否为待分析的 har 文件
+    预处理生成的 .harc 缓存文件在对应的 .har 文件不存在时也视为 har 文件，两者都存在时只取 .har（读取时会自动使用缓存）
+    :param file_path: 文件路径
+    :param only_hash: 只接受预处理过的（带 _md5 后缀的）文件
+    """
+    file_name, ext = os.path.splitext(file_path)
+    if ext == '.harc':
+        if os.path.exists(file_name + '.har'):
+            return False
+    elif ext != '.har':
+        return False
+
+    if only_hash and not file_name.endswith('_md5'):
+        return False
+
+    return True
+
+
 def get_test_file_list(only_hash=True, enable_print=False):
     """获取测试文件列表"""
 
@@ -63,9 +82,7 @@ def get_test_file_list(only_hash=True, enable_print=False):
     file_paths = {}
     for root, dirs, files in os.walk("./har_files"):
         for file in files:
-            if file.endswith('.har'):
-                if only_hash and not file.endswith("_md5.har"):
-                    continue
+            if is_har_file(os.path.join(root, file), only_hash=only_hash):
                 file_name, ext = os.path.splitext(file)
                 file_date = to_YYYY_MM_DD(file_name.split('_')[1])
                 file_paths.setdefault(file_date, []).append(os.path.join(root, file))
@@ -0,0 +1,157 @@
+import argparse
+import glob
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from base import is_har_file
+from detect_cross_domain import get_domain
+from global_config import bold_split, thin_split
+from main import find_cross_domain_tokens
+
+
+def collect_har_files(path_or_glob, only_hash=True):
+    """
+    获取待分析的 har 文件列表
+    :param path_or_glob: 目录（会递归查找其中的 .har / .harc 文件）或 glob 表达式（如 ./har_files/*_md5.har）
+    :param only_hash: 只保留带 _md5 后缀的 har 文件，glob 表达式不受此参数影响
+    :return: 排序后的文件路径列表
+    """
+    if os.path.isdir(path_or_glob):
+        har_files = []
+        for root, dirs, files in os.walk(path_or_glob):
+            for file in files:
+                if is_har_file(os.path.join(root, file), only_hash=only_hash):
+                    har_files.append(os.path.join(root, file))
+    else:
+        har_files = [f for f in glob.glob(path_or_glob, recursive=True) if os.path.isfile(f)]
+
+    return sorted(har_files)
+
+
+def analyze_har_file(har_path, enable_stopwords=2, only_multi=True, use_psl=False):
+    """
+    在子进程中分析单个 har 文件，异常会被捕获并记录在返回值中，不会影响其他文件
+    :return: dict, 包含 har_path, ok, time_cost, error, traceback, result
+        result 的 key 是 token value，value 是每个分组的 {domain, md5_list}
+    """
+    start_time = time.time()
+    try:
+        res = find_cross_domain_tokens(har_path,
+                                       show_skip_info=False,
+                                       only_multi=only_multi,
+                                       enable_stopwords=enable_stopwords,
+                                       use_psl=use_psl)
+        result = {value: [{'domain': get_domain(group[0][0], domain_level=0),
+                           'md5_list': [md5 for url, md5 in group]} for group in groups]
+                  for value, groups in res.items()}
+        return {'har_path': har_path, 'ok': True, 'time_cost': time.time() - start_time,
+                'error': None, 'traceback': None, 'result': result}
+    except Exception as e:
+        return {'har_path': har_path, 'ok': False, 'time_cost': time.time() - start_time,
+                'error': f'{type(e).__name__}: {e}', 'traceback': traceback.format_exc(), 'result': {}}
+
+
+def merge_results(file_results):
+    """
+    合并各个 har 文件的检测结果
+    :param file_results: analyze_har_file 返回值的列表
+    :return: dict, key: token value, value: {domains: 出现过的域名列表, files: {har_path: 分组结果}}
+    """
+    merged = {}
+    for file_res in file_results:
+        for value, groups in file_res['result'].items():
+            item = merged.setdefault(value, {'domains': [], 'files': {}})
+            for group in groups:
+                if group['domain'] not in item['domains']:
+                    item['domains'].append(group['domain'])
+            item['files'][file_res['har_path']] = groups
+
+    return merged
+
+
+def run_batch(path_or_glob, workers=None, only_hash=True, enable_stopwords=2, only_multi=True, use_psl=False,
+              report_path=None, enable_print=True):
+    """
+    使用进程池并行分析多个 har 文件，不需要交互输入
+    :param path_or_glob: 目录或 glob 表达式，见 collect_har_files
+    :param workers: 进程数，默认为 CPU 核数
+    :param only_hash: 只分析带 _md5 后缀的 har 文件
+    :param enable_stopwords: 同 find_tokens_by_compare
+    :param only_multi: 同 find_tokens_by_compare
+    :param use_psl: 同 find_cross_domain_tokens
+    :param report_path: 合并后的报告输出路径（json），为 None 时不输出
+    :param enable_print: 是否打印每个文件的耗时和失败信息
+    :return: dict, 包含 files（每个文件的耗时和状态）和 tokens（合并后的跨域 tokens）
+    """
+    start_time = time.time()
+    har_files = collect_har_files(path_or_glob, only_hash=only_hash)
+
+    file_results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyze_har_file, har_path, enable_stopwords, only_multi, use_psl): har_path
+                   for har_path in har_files}
+        for future in as_completed(futures):
+            har_path = futures[future]
+            try:
+                file_res = future.result()
+            except Exception as e:
+                # 子进程异常退出等情况（如内存不足被杀掉）
+                file_res = {'har_path': har_path, 'ok': False, 'time_cost': None,
+                            'error': f'{type(e).__name__}: {e}', 'traceback': None, 'result': {}}
+
+            file_results.append(file_res)
+            if enable_print:
+                if file_res['ok']:
+                    print(f'[{len(file_results)}/{len(har_files)}] "{os.path.basename(har_path)}" done, '
+                          f'cross domain values: {len(file_res["result"])}, '
+                          f'time cost: {file_res["time_cost"]:.2f}s')
+                else:
+                    print(f'[{len(file_results)}/{len(har_files)}] "{os.path.basename(har_path)}" failed: '
+                          f'{file_res["error"]}')
+
+    file_results.sort(key=lambda r: r['har_path'])
+    report = {
+        'files': [{k: r[k] for k in ('har_path', 'ok', 'time_cost', 'error', 'traceback')} for r in file_results],
+        'tokens': merge_results(file_results),
+        'time_cost': time.time() - start_time,
+    }
+
+    if enable_print:
+        failed = [r for r in file_results if not r['ok']]
+        print(f'{bold_split}\n'
+              f'HAR files tested: {len(file_results)}, failed: {len(failed)}, '
+              f'cross domain values: {len(report["tokens"])}, '
+              f'total time cost: {report["time_cost"]:.2f}s\n'
+              f'{thin_split}')
+        for value, item in report['tokens'].items():
+            print(f"value: {value}\n"
+                  f"domains: {item['domains']}\n"
+                  f"files: {[os.path.basename(f) for f in item['files']]}\n"
+                  f"{thin_split}")
+
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='并行检测多个 har 文件中的跨域 tokens')
+    parser.add_argument('path', nargs='?', default='./har_files', help='har 文件目录或 glob 表达式')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='进程数，默认为 CPU 核数')
+    parser.add_argument('--all', action='store_true', help='同时分析不带 _md5 后缀的 har 文件')
+    parser.add_argument('--stopwords', type=int, default=2, choices=[0, 1, 2], help='停用词过滤模式')
+    parser.add_argument('--psl', action='store_true', help='按公共后缀列表得到的可注册域名分组')
+    parser.add_argument('-o', '--output', default=None, help='合并报告输出路径（json）')
+    args = parser.parse_args()
+
+    run_batch(args.path,
+              workers=args.workers,
+              only_hash=not args.all,
+              enable_stopwords=args.stopwords,
+              use_psl=args.psl,
+              report_path=args.output)
@@ -0,0 +1,307 @@
+import argparse
+import copy
+import gc
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from detect_cross_domain import group_by_domain
+from field_batch import FieldBatch
+from fingerprint import compute_fingerprint
+from get_values import get_values_from_entry
+from global_config import fingerprint_algorithm
+from har_index import EntryIndex
+from har_reader import iter_har_entries
+from main import find_tokens_by_keyname, find_tokens_by_compare
+
+benchmark_version = 1
+
+# 合成 har 中使用的 keyname，一部分会被 keyname 方式识别为 token
+_token_keys = ['access_token', 'token', 'sid', 'session_id', 'uid', 'device_id', 'auth']
+_other_keys = ['page', 'size', 'lang', 'ts', 'v', 'os', 'channel', 'from']
+_header_names = ['Accept', 'Accept-Language', 'User-Agent', 'X-Request-Id', 'X-Client-Version', 'Referer',
+                 'Content-Type', 'X-Trace-Id', 'X-Device-Id', 'Origin']
+
+
+def _random_str(rng, length, alphabet=string.ascii_letters + string.digits):
+    return ''.join(rng.choice(alphabet) for _ in range(length))
+
+
+def generate_synthetic_har(n_entries=1000, n_domains=20, headers_per_entry=8, token_pool_size=200,
+                           token_reuse_rate=0.3, body_size=256, seed=0):
+    """
+    生成结构与 ZAP 导出的 har 一致的合成 har，相同的参数和 seed 生成的结果完全相同
+    :param n_entries: entry 个数
+    :param n_domains: 域名个数（分布在 n_domains // 3 + 1 个二级域名下）
+    :param headers_per_entry: 每个请求的 header 个数（不含 Authorization 和 Cookie）
+    :param token_pool_size: 可重复使用的 token 个数
+    :param token_reuse_rate: 每个 token 位置使用 token 池中已有的 token（而不是新生成）的概率，决定跨请求共有 value 的比例
+    :param body_size: post body 和 response body 的大致字节数，0 表示没有 post body
+    :param seed: 随机数种子
+    :return: har 字典
+    """
+    rng = random.Random(seed)
+    token_pool = [_random_str(rng, 32) for _ in range(token_pool_size)]
+    domains = [f'{_random_str(rng, 5).lower()}.site{i % (n_domains // 3 + 1)}.com' for i in range(n_domains)]
+
+    def get_token():
+        if rng.random() < token_reuse_rate:
+            return rng.choice(token_pool)
+        return _random_str(rng, 32)
+
+    entries = []
+    for i in range(n_entries):
+        domain = rng.choice(domains)
+        params = {key: get_token() for key in rng.sample(_token_keys, 2)}
+        params.update({key: _random_str(rng, rng.randint(1, 6)) for key in rng.sample(_other_keys, 3)})
+        query = '&'.join(f'{k}={v}' for k, v in params.items())
+
+        headers = [{'name': name, 'value': _random_str(rng, rng.randint(4, 40))}
+                   for name in rng.sample(_header_names, min(headers_per_entry, len(_header_names)))]
+        headers.append({'name': 'Authorization', 'value': 'Bearer ' + get_token()})
+        cookies = [{'name': 'sessionid', 'value': get_token()}, {'name': 'lang', 'value': 'zh-CN'}]
+        headers.append({'name': 'Cookie', 'value': '; '.join(f"{c['name']}={c['value']}" for c in cookies)})
+
+        request = {
+            'method': 'POST' if body_size else 'GET',
+            'url': f'https://{domain}/api/v1/{_random_str(rng, 6).lower()}?{query}',
+            'httpVersion': 'HTTP/1.1',
+            'headers': headers,
+            'cookies': cookies,
+            'queryString': [{'name': k, 'value': v} for k, v in params.items()],
+            'headersSize': -1,
+            'bodySize': body_size,
+        }
+        if body_size:
+            body = {'device_id': get_token(), 'user_token': get_token()}
+            while len(json.dumps(body)) < body_size:
+                body[_random_str(rng, 6).lower()] = _random_str(rng, 24)
+            request['postData'] = {'mimeType': 'application/json', 'text': json.dumps(body), 'params': []}
+
+        entries.append({
+            'startedDateTime': f'2024-08-10T12:{i // 3600 % 60:02d}:{i // 60 % 60:02d}.{i % 60:03d}Z',
+            'time': rng.randint(5, 500),
+            'request': request,
+            'response': {
+                'status': 200,
+                'statusText': 'OK',
+                'httpVersion': 'HTTP/1.1',
+                'headers': [{'name': 'Content-Type', 'value': 'application/json'}],
+                'cookies': [],
+                'content': {'size': body_size, 'mimeType': 'application/json',
+                            'text': json.dumps({'data': _random_str(rng, max(body_size - 12, 0))})},
+                'redirectURL': '',
+                'headersSize': -1,
+                'bodySize': body_size,
+            },
+            'cache': {},
+            'timings': {'send': 0, 'wait': 1, 'receive': 1},
+        })
+
+    return {'log': {'version': '1.2', 'creator': {'name': 'benchmark', 'version': str(benchmark_version)},
+                    'entries': entries}}
+
+
+def _measure(func, repeat):
+    """
+    :return: (最快一次的耗时, 每次的耗时, 单独一次运行时 tracemalloc 的峰值, 最后一次的返回值)
+    """
+    times = []
+    res = None
+    for _ in range(repeat):
+        gc.collect()
+        start_time = time.perf_counter()
+        res = func()
+        times.append(time.perf_counter() - start_time)
+
+    # 内存测量单独运行一次，tracemalloc 会明显拖慢运行速度，不影响上面的计时
+    del res
+    gc.collect()
+    tracemalloc.start()
+    res = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(times), times, peak, res
+
+
+def _bench_geoip(ips):
+    """GeoIP 查询，需要 geoip2 和 GeoLite2 数据库，不满足时返回跳过的原因"""
+    # get_country_of_ip 以 cross_border_detection 目录为工作目录运行，同目录的模块直接 import
+    cross_border_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cross_border_detection')
+    if cross_border_dir not in sys.path:
+        sys.path.append(cross_border_dir)
+
+    try:
+        from get_country_of_ip import GeoIPService, geolite2_db_path
+    except ImportError as e:
+        return None, f'{type(e).__name__}: {e}'
+
+    db_path = os.path.join(cross_border_dir, geolite2_db_path)
+    if not os.path.exists(db_path):
+        return None, f'GeoLite2 database not found: {db_path}'
+
+    def run():
+        with GeoIPService(db_path) as service:
+            return service.get_countries(ips)
+
+    return run, None
+
+
+def run_benchmark(n_entries=1000, n_domains=20, headers_per_entry=8, token_pool_size=200, token_reuse_rate=0.3,
+                  body_size=256, seed=0, repeat=3, enable_stopwords=1, enable_print=True):
+    """
+    生成合成 har，依次测量各个阶段的耗时（重复 repeat 次取最快）和内存峰值（tracemalloc）
+    阶段：load（json 整体加载 / 流式读取）、md5、get_values_from_entry、get_values_batch（FieldBatch）、find_tokens_by_keyname、
+    find_tokens_by_compare、group_by_domain、geoip（缺少依赖时跳过）
+    :return: 可以直接保存为 json 的结果字典
+    """
+    params = {'n_entries': n_entries, 'n_domains': n_domains, 'headers_per_entry': headers_per_entry,
+              'token_pool_size': token_pool_size, 'token_reuse_rate': token_reuse_rate, 'body_size': body_size,
+              'seed': seed, 'repeat': repeat, 'enable_stopwords': enable_stopwords}
+
+    har = generate_synthetic_har(n_entries, n_domains, headers_per_entry, token_pool_size, token_reuse_rate,
+                                 body_size, seed)
+    fd, har_path = tempfile.mkstemp(prefix='benchmark_', suffix='.har')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(har, f, ensure_ascii=False)
+
+    stages = {}
+
+    def add_stage(name, func, items):
+        best, times, peak, res = _measure(func, repeat)
+        stages[name] = {'time_s': best, 'times_s': times, 'peak_mem_bytes': peak, 'items': items,
+                        'items_per_s': items / best if best > 0 else None}
+        if enable_print:
+            print(f'{name:<24} {best * 1000:10.2f} ms {peak / 1024 / 1024:10.2f} MiB  ({items} items)')
+        return res
+
+    try:
+        def load_json():
+            with open(har_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+
+        add_stage('load_json', load_json, n_entries)
+        add_stage('load_stream', lambda: sum(1 for _ in iter_har_entries(har_path, use_cache=False)), n_entries)
+
+        entries = har['log']['entries']
+        add_stage('md5', lambda: [compute_fingerprint(e, fingerprint_algorithm) for e in entries], n_entries)
+
+        # 之后的阶段使用带 md5 的 entry，与预处理后的 har 一致
+        har_md5 = copy.deepcopy(har)
+        for entry in har_md5['log']['entries']:
+            entry['md5'] = compute_fingerprint(entry, fingerprint_algorithm)
+
+        add_stage('get_values_from_entry',
+                  lambda: [get_values_from_entry(e, enable_stopwords=enable_stopwords) for e in har_md5['log']['entries']],
+                  n_entries)
+        add_stage('get_values_batch',
+                  lambda: FieldBatch.from_entries(har_md5['log']['entries']).get_values(enable_stopwords=enable_stopwords),
+                  n_entries)
+        add_stage('find_tokens_by_keyname', lambda: find_tokens_by_keyname(har_md5), n_entries)
+        res_compare = add_stage('find_tokens_by_compare',
+                                lambda: find_tokens_by_compare(har_md5, show_skip_info=False, only_multi=True,
+                                                               enable_stopwords=enable_stopwords),
+                                n_entries)
+
+        entry_index = EntryIndex(har_md5, keep_entries=False)
+        url_lists = [[(entry_index.get_url(md5), md5) for md5 in md5_list] for md5_list in res_compare.values()]
+        add_stage('group_by_domain', lambda: [group_by_domain(urls, level=2) for urls in url_lists],
+                  sum(len(urls) for urls in url_lists))
+
+        rng = random.Random(seed)
+        ips = [f'{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}'
+               for _ in range(n_entries)]
+        geoip_func, skip_reason = _bench_geoip(ips)
+        if geoip_func is None:
+            stages['geoip'] = {'skipped': skip_reason}
+            if enable_print:
+                print(f'{"geoip":<24} skipped: {skip_reason}')
+        else:
+            add_stage('geoip', geoip_func, len(ips))
+    finally:
+        os.remove(har_path)
+
+    return {
+        'benchmark_version': benchmark_version,
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'git_commit': _get_git_commit(),
+            'fingerprint_algorithm': fingerprint_algorithm,
+            'har_size_bytes': len(json.dumps(har, ensure_ascii=False).encode()),
+        },
+        'params': params,
+        'stages': stages,
+    }
+
+
+def _get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_benchmarks(baseline, current, threshold=1.2):
+    """
+    对比两次 run_benchmark 的结果，打印每个阶段的耗时比例
+    :param threshold: 耗时超过基线的 threshold 倍时视为退化
+    :return: 退化的阶段名列表
+    """
+    if baseline['params'] != current['params']:
+        print(f'warning: params differ, baseline: {baseline["params"]}, current: {current["params"]}')
+
+    regressions = []
+    for name, stage in current['stages'].items():
+        base_stage = baseline['stages'].get(name)
+        if 'time_s' not in stage or not base_stage or 'time_s' not in base_stage:
+            continue
+
+        ratio = stage['time_s'] / base_stage['time_s'] if base_stage['time_s'] > 0 else float('inf')
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  <-- regression'
+        print(f'{name:<24} {base_stage["time_s"] * 1000:10.2f} ms -> {stage["time_s"] * 1000:10.2f} ms '
+              f'({ratio:.2f}x){flag}')
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='使用合成 har 测量各个检测阶段的耗时和内存')
+    parser.add_argument('-n', '--entries', type=int, default=1000, help='entry 个数')
+    parser.add_argument('--domains', type=int, default=20, help='域名个数')
+    parser.add_argument('--headers', type=int, default=8, help='每个请求的 header 个数')
+    parser.add_argument('--token-pool', type=int, default=200, help='可重复使用的 token 个数')
+    parser.add_argument('--reuse', type=float, default=0.3, help='token 重复使用的概率')
+    parser.add_argument('--body-size', type=int, default=256, help='post body / response body 的字节数')
+    parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+    parser.add_argument('--repeat', type=int, default=3, help='每个阶段的重复次数')
+    parser.add_argument('--stopwords', type=int, default=1, choices=[0, 1, 2], help='停用词过滤模式')
+    parser.add_argument('-o', '--output', default=None, help='结果输出路径（json）')
+    parser.add_argument('--baseline', default=None, help='与之前的结果（json）对比，有退化时返回值为 1')
+    args = parser.parse_args()
+
+    result = run_benchmark(args.entries, args.domains, args.headers, args.token_pool, args.reuse, args.body_size,
+                           args.seed, args.repeat, args.stopwords)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f'result saved to |{args.output}|')
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            sys.exit(1 if compare_benchmarks(json.load(f), result) else 0)
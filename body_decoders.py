@@ -0,0 +1,460 @@
+import base64
+import binascii
+import json
+import re
+import zlib
+from collections import deque, namedtuple
+from functools import lru_cache
+from time import perf_counter
+from urllib.parse import parse_qsl
+
+import instrumentation
+from global_config import json_max_depth, json_max_nodes, json_max_str_len, json_max_body_size, \
+    body_decoder_max_bytes, body_decoder_max_nesting, body_decompress_max_size, base64_min_len
+
+# post body 中字段所在的位置（与 extract_fields 中的其他位置一起使用）
+LOCATION_POST_JSON = 'post_json'  # application/json 类型的 post body
+LOCATION_POST_FORM = 'post_form'  # application/x-www-form-urlencoded 类型的 post body
+LOCATION_POST_MULTIPART = 'post_multipart'  # multipart/form-data 中的非文件部分
+LOCATION_POST_TEXT = 'post_text'  # text/plain 等格式的 key=value 文本
+
+# 待解码的 body
+#   mime_type: mimeType 中的类型部分（小写，不含参数），mime_params: mimeType 中的参数（如 boundary）
+#   text: body 文本，params: har 中解析好的表单参数列表
+#   nesting: 嵌套解码的层数（base64、压缩等解码之后再次解码时加一）
+Body = namedtuple('Body', ['mime_type', 'mime_params', 'text', 'params', 'nesting'])
+
+# 一个 body 解码器
+#   name: 名称，启用统计时记录各解码器的调用次数
+#   mime_types: 适用的 mimeType，为空表示只在 mimeType 没有匹配的解码器（或匹配的解码器都无法解码）时按 sniff 尝试
+#   sniff: sniff(body) -> bool，只检查 body 开头的少量内容，为 True 时才调用 decode
+#   decode: decode(body) -> (location, key, value) 列表，无法解码时返回 None，继续尝试下一个解码器
+#   max_bytes: body 超过该长度（字符数）时跳过这个解码器
+BodyDecoder = namedtuple('BodyDecoder', ['name', 'mime_types', 'sniff', 'decode', 'max_bytes'])
+
+# 按注册顺序尝试
+_decoders = []
+# mimeType -> 依次尝试的解码器列表，注册解码器时清空
+_candidates_cache = {}
+
+# 这些类型的 body 不尝试解码
+skip_mime_prefixes = ('image/', 'video/', 'audio/', 'font/')
+
+
+def register_decoder(name, decode, mime_types=(), sniff=None, max_bytes=body_decoder_max_bytes, index=None):
+    """
+    注册一个解码器，参数见 BodyDecoder，sniff 为 None 时总是调用 decode
+    :param index: 插入的位置，为 None 时添加到最后（最后尝试）
+    """
+    decoder = BodyDecoder(name, tuple(mime_types), sniff, decode, max_bytes)
+    _decoders.insert(len(_decoders) if index is None else index, decoder)
+    _candidates_cache.clear()
+
+    return decoder
+
+
+def get_decoders():
+    return list(_decoders)
+
+
+@lru_cache(maxsize=1024)
+def parse_mime_type(mime_type):
+    """
+    :return: (类型, 参数字典)，例如 'multipart/form-data; boundary=xx' -> ('multipart/form-data', {'boundary': 'xx'})
+        结果会被缓存，不要修改返回的字典
+    """
+    mime_type, _, rest = (mime_type or '').partition(';')
+    params = {}
+    for item in rest.split(';'):
+        key, sep, value = item.partition('=')
+        if sep:
+            params[key.strip().lower()] = value.strip().strip('"')
+
+    return mime_type.strip().lower(), params
+
+
+def decode_post_body(post_data):
+    """
+    按 mimeType 和内容解码 post body：先尝试 mimeType 匹配的解码器，都无法解码时再按 sniff 尝试通用的解码器
+    :param post_data: entry['request']['postData']
+    :return: (location, key, value) 列表
+    """
+    mime_type, mime_params = parse_mime_type(post_data.get('mimeType'))
+    return decode_body(Body(mime_type, mime_params, post_data.get('text') or '', post_data.get('params') or [], 0))
+
+
+def decode_content(content):
+    """
+    解码 har 中的 content（如 entry['response']['content']），content['encoding'] 为 base64 时先进行 base64 解码
+    :return: (location, key, value) 列表，location 与 post body 相同
+    """
+    mime_type, mime_params = parse_mime_type(content.get('mimeType'))
+    text = content.get('text') or ''
+    if content.get('encoding') != 'base64':
+        return decode_body(Body(mime_type, mime_params, text, [], 0))
+
+    data = _b64decode(text.strip())
+    # 解码得到的内容作为第 0 层
+    return (decode_bytes(data, Body(mime_type, mime_params, '', [], -1)) or []) if data else []
+
+
+def decode_body(body):
+    """
+    :param body: Body
+    :return: (location, key, value) 列表
+    """
+    if body.nesting > body_decoder_max_nesting or body.mime_type.startswith(skip_mime_prefixes):
+        return []
+
+    candidates = _candidates_cache.get(body.mime_type)
+    if candidates is None:
+        candidates = _candidates_cache[body.mime_type] = \
+            [d for d in _decoders if body.mime_type in d.mime_types] + [d for d in _decoders if not d.mime_types]
+
+    tried = set()
+    for decoder in candidates:
+        if len(body.text) > decoder.max_bytes or decoder.decode in tried:
+            continue
+        if decoder.sniff is not None and not decoder.sniff(body):
+            continue
+        tried.add(decoder.decode)
+
+        if instrumentation.enabled:
+            instrumentation.metrics.incr(f'body_decoder_{decoder.name}')
+
+        res = decoder.decode(body)
+        if res is not None:
+            return res
+
+    return []
+
+
+def iter_json_leaves(obj, max_depth=json_max_depth, max_nodes=json_max_nodes, max_str_len=json_max_str_len,
+                     with_path=True):
+    """
+    按层次顺序（先浅后深）遍历 json.loads 的结果，使用队列而不是递归，耗时和内存不超过 max_nodes 个节点
+    :param obj: json.loads 的结果
+    :param max_depth: 最多展开的嵌套层数，更深的 dict / list 跳过
+    :param max_nodes: 最多访问的节点数（dict 的每个 key、list 的每个元素各算一个），超过后不再展开，只返回已访问的叶子
+    :param max_str_len: 超过该长度的字符串叶子跳过
+    :param with_path: 为 False 时 path 返回 None，不需要 path 时更快
+    :return: (path, key, value) 的迭代器，value 为字符串、数字、布尔值或 None
+        path: 从根到叶子的 dict key 和 list 下标组成的 tuple，例如 {"auth": {"ids": ["x"]}} 中 "x" 的 path 为 ('auth', 'ids', 0)
+        key: 叶子所在的最内层 dict 的 key（上例中为 'ids'），不在任何 dict 中时为空字符串
+    """
+    if not isinstance(obj, (dict, list)):
+        if not (isinstance(obj, str) and len(obj) > max_str_len):
+            yield (), '', obj
+        return
+
+    queue = deque([((), '', obj, 0)])
+    nodes = 0
+
+    while queue:
+        path, key, value, depth = queue.popleft()
+        if depth >= max_depth or nodes >= max_nodes:
+            continue
+
+        is_list = isinstance(value, list)
+        for step, child in (enumerate(value) if is_list else value.items()):
+            nodes += 1
+            if nodes > max_nodes:
+                break
+
+            child_key = key if is_list else step
+            child_path = path + (step,) if with_path else None
+            if isinstance(child, (dict, list)):
+                queue.append((child_path, child_key, child, depth + 1))
+            elif not (isinstance(child, str) and len(child) > max_str_len):
+                yield child_path, child_key, child
+
+
+# ----------------- base64 和压缩 -----------------
+
+_base64_pattern = re.compile(r'[A-Za-z0-9+/_-]+={0,2}')
+_base64_prefix_pattern = re.compile(r'[A-Za-z0-9+/_-]{16}')
+
+
+def _looks_like_base64(text):
+    """长度足够、只包含 base64（或 url safe base64）字符，且去掉填充后的长度可能是 base64 编码的结果"""
+    return (len(text) >= base64_min_len and len(text.rstrip('=')) % 4 != 1
+            and _base64_pattern.fullmatch(text) is not None)
+
+
+_hex_pattern = re.compile(r'[0-9A-Fa-f]+')
+
+
+def _looks_like_base64_value(text):
+    """
+    字段中的 value 是否尝试 base64 解码，比 _looks_like_base64 更严格，避免每个较长的 value 都解码一次：
+    带填充的长度是 4 的倍数，且不是十六进制字符串（十六进制的 token、哈希值也只包含 base64 字符）
+    """
+    return len(text) % 4 == 0 and _looks_like_base64(text) and _hex_pattern.fullmatch(text) is None
+
+
+def _b64decode(text):
+    try:
+        if '-' in text or '_' in text:
+            return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+        return base64.b64decode(text + '=' * (-len(text) % 4), validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def _is_compressed(data):
+    """gzip 或 zlib 格式（deflate 带 zlib 头）"""
+    return data[:2] == b'\x1f\x8b' or (len(data) >= 2 and data[0] == 0x78 and not data[1] & 0x20
+                                        and (data[0] << 8 | data[1]) % 31 == 0)
+
+
+def _decompress(data):
+    """解压 gzip / zlib，最多输出 body_decompress_max_size 字节，失败时返回 None"""
+    try:
+        return zlib.decompressobj(wbits=47).decompress(data, body_decompress_max_size)
+    except zlib.error:
+        return None
+
+
+_control_char_pattern = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+
+
+def decode_bytes(data, body):
+    """
+    base64 解码或解压得到的字节：如果是压缩数据先解压，再作为 utf-8 文本嵌套解码
+    :param body: 原来的 Body，mimeType 和参数保持不变
+    :return: (location, key, value) 列表，无法解码时返回 None
+    """
+    if _is_compressed(data):
+        data = _decompress(data)
+        if data is None:
+            return None
+
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+    if _control_char_pattern.search(text):
+        # 不是文本（例如长 id 被当作 base64 解码得到的随机字节），不再解码，避免产生无意义的字段
+        return None
+
+    return decode_body(body._replace(text=text, params=[], nesting=body.nesting + 1)) or None
+
+
+def expand_base64_values(location, key, value, body):
+    """
+    字段本身，以及 value 为 base64 编码的 json、key=value 文本或压缩数据时解码得到的字段
+    sf_mad.har 中的 'datalist=...' 即为这种情况
+    """
+    res = [(location, key, value)]
+    if isinstance(value, str) and _looks_like_base64_value(value):
+        data = _b64decode(value)
+        if data:
+            res.extend(decode_bytes(data, body._replace(mime_type='', mime_params={})) or [])
+
+    return res
+
+
+# ----------------- 各格式的解码器 -----------------
+
+_json_prefix_pattern = re.compile(r'\s*[\[{]')
+
+
+def sniff_json(body):
+    return _json_prefix_pattern.match(body.text) is not None
+
+
+def decode_json(body):
+    """json 展开嵌套的 dict 和 list，每个叶子节点一个字段，见 iter_json_leaves"""
+    try:
+        if instrumentation.enabled:
+            start_time = perf_counter()
+            obj = json.loads(body.text)
+            instrumentation.metrics.add_time('post_body_json_loads', perf_counter() - start_time)
+        else:
+            obj = json.loads(body.text)
+    except ValueError:
+        return None
+
+    return [(LOCATION_POST_JSON, key, value) for _, key, value in iter_json_leaves(obj, with_path=False)]
+
+
+def decode_form(body):
+    """优先使用 har 中解析好的 params，没有时解析 body 文本"""
+    if body.params:
+        items = [(param['name'], param['value']) for param in body.params]
+    else:
+        items = parse_qsl(body.text, keep_blank_values=True)
+
+    return [field for key, value in items for field in expand_base64_values(LOCATION_POST_FORM, key, value, body)]
+
+
+def sniff_multipart(body):
+    return bool(body.mime_params.get('boundary')) or body.text.startswith('--') or bool(body.params)
+
+
+_disposition_param_pattern = re.compile(r';\s*([\w*]+)="?([^";]*)"?')
+
+
+def decode_multipart(body):
+    """
+    multipart/form-data 中的非文件部分，每部分一个字段（key 为 name），文件部分跳过
+    部分的 Content-Type 为 json 等可以解码的类型时，使用解码得到的字段
+    """
+    boundary = body.mime_params.get('boundary')
+    if not boundary and body.text.startswith('--'):
+        boundary = body.text[2:body.text.find('\n')].strip()
+
+    if not boundary or f'--{boundary}' not in body.text:
+        # 没有 body 文本时使用 har 中解析好的 params
+        if not body.params:
+            return None
+        return [field for param in body.params if 'fileName' not in param
+                for field in expand_base64_values(LOCATION_POST_MULTIPART, param['name'], param.get('value', ''),
+                                                  body)]
+
+    fields = []
+    for part in body.text.split(f'--{boundary}')[1:]:
+        if part.startswith('--'):
+            # 结束标记
+            break
+
+        head, sep, content = part.lstrip('\r\n').partition('\r\n\r\n')
+        if not sep:
+            head, sep, content = part.lstrip('\n').partition('\n\n')
+            if not sep:
+                continue
+
+        headers = {}
+        for line in head.splitlines():
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        disposition = dict((k.lower(), v) for k, v in
+                           _disposition_param_pattern.findall(headers.get('content-disposition', '')))
+        if 'filename' in disposition or 'name' not in disposition:
+            continue
+
+        content = content[:-2] if content.endswith('\r\n') else content.rstrip('\n')
+
+        # 有 Content-Type 的部分先按其类型解码，无法解码时作为一个字段
+        part_type, part_params = parse_mime_type(headers.get('content-type'))
+        part_fields = decode_body(Body(part_type, part_params, content, [], body.nesting + 1)) if part_type else []
+        fields.extend(part_fields or expand_base64_values(LOCATION_POST_MULTIPART, disposition['name'], content, body))
+
+    return fields
+
+
+_key_value_pattern = re.compile(r'\s*[\w.\-\[\]]{1,64}=')
+_key_value_sep_pattern = re.compile(r'[&\r\n]+')
+
+
+def sniff_key_value(body):
+    return _key_value_pattern.match(body.text) is not None
+
+
+def decode_key_value(body):
+    """key=value 文本，以 & 或换行分隔，key 只允许字母、数字和 _.-[]"""
+    fields = []
+    for item in _key_value_sep_pattern.split(body.text):
+        key, sep, value = item.partition('=')
+        key = key.strip()
+        if sep and _key_value_pattern.match(key + '='):
+            fields.extend(expand_base64_values(LOCATION_POST_TEXT, key, value.strip(), body))
+
+    return fields or None
+
+
+def sniff_compressed(body):
+    # 以 latin-1 保存的二进制 body
+    return _is_compressed(body.text[:2].encode('latin-1', errors='replace'))
+
+
+def decode_compressed(body):
+    try:
+        data = body.text.encode('latin-1')
+    except UnicodeEncodeError:
+        return None
+
+    return decode_bytes(data, body)
+
+
+def sniff_base64(body):
+    return _base64_prefix_pattern.match(body.text) is not None
+
+
+def decode_base64(body):
+    text = body.text.strip()
+    if not _looks_like_base64(text):
+        return None
+
+    data = _b64decode(text)
+    return decode_bytes(data, body) if data else None
+
+
+register_decoder('json', decode_json, mime_types=('application/json', 'text/json'), sniff=sniff_json,
+                 max_bytes=json_max_body_size)
+register_decoder('form', decode_form, mime_types=('application/x-www-form-urlencoded',))
+register_decoder('multipart', decode_multipart, mime_types=('multipart/form-data',), sniff=sniff_multipart)
+register_decoder('key_value', decode_key_value, mime_types=('text/plain',), sniff=sniff_key_value)
+
+# 通用的解码器，按顺序根据内容尝试
+register_decoder('compressed', decode_compressed, sniff=sniff_compressed)
+register_decoder('base64', decode_base64, sniff=sniff_base64)
+register_decoder('json_sniffed', decode_json, sniff=sniff_json, max_bytes=json_max_body_size)
+register_decoder('key_value_sniffed', decode_key_value, sniff=sniff_key_value)
+
+
+def test_body_decoders():
+    """检查 multipart、表单中 base64 编码的 datalist=、gzip 压缩的 body、无效的 json 和不是 base64 的 value 的解码结果"""
+    import gzip
+
+    def check(name, post_data, expected):
+        res = decode_post_body(post_data)
+        if sorted(res, key=repr) != sorted(expected, key=repr):
+            raise AssertionError(f'{name}: expected {expected}, but {res}')
+
+    token = 'Qx7Lm2Rt5Wp8Kz3NaB4c'
+
+    boundary = '----WebKitFormBoundary7MA4YWxkTrZu0gW'
+    multipart_text = (f'--{boundary}\r\n'
+                      f'Content-Disposition: form-data; name="session"\r\n\r\n'
+                      f'{token}\r\n'
+                      f'--{boundary}\r\n'
+                      f'Content-Disposition: form-data; name="meta"\r\n'
+                      f'Content-Type: application/json\r\n\r\n'
+                      f'{{"device": {{"id": "{token}"}}}}\r\n'
+                      f'--{boundary}\r\n'
+                      f'Content-Disposition: form-data; name="file"; filename="a.png"\r\n'
+                      f'Content-Type: image/png\r\n\r\n'
+                      f'\x89PNG\r\n'
+                      f'--{boundary}--\r\n')
+    check('multipart', {'mimeType': f'multipart/form-data; boundary={boundary}', 'text': multipart_text},
+          [(LOCATION_POST_MULTIPART, 'session', token), (LOCATION_POST_JSON, 'id', token)])
+
+    datalist = base64.b64encode(json.dumps({'uid': token, 'ts': 1723291200}).encode()).decode()
+    check('base64 datalist', {'mimeType': 'application/x-www-form-urlencoded', 'text': f'v=2&datalist={datalist}'},
+          [(LOCATION_POST_FORM, 'v', '2'), (LOCATION_POST_FORM, 'datalist', datalist),
+           (LOCATION_POST_JSON, 'uid', token), (LOCATION_POST_JSON, 'ts', 1723291200)])
+
+    compressed = gzip.compress(json.dumps({'uid': token}).encode()).decode('latin-1')
+    check('gzip', {'mimeType': 'application/octet-stream', 'text': compressed}, [(LOCATION_POST_JSON, 'uid', token)])
+
+    # 无效的 json 不抛出异常，没有其他解码器能解码时没有字段，key=value 文本仍然可以被通用的解码器解码
+    check('invalid json', {'mimeType': 'application/json', 'text': '{"uid": "' + token}, [])
+    check('key=value as json', {'mimeType': 'application/json', 'text': f'uid={token}&v=2'},
+          [(LOCATION_POST_TEXT, 'uid', token), (LOCATION_POST_TEXT, 'v', '2')])
+
+    # 十六进制的 token 不尝试 base64 解码，解码得到控制字符（不是文本）时不产生字段
+    hex_token = '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08'
+    if _looks_like_base64_value(hex_token):
+        raise AssertionError('hex token treated as base64')
+    binary = base64.b64encode(b'ab=' + bytes(range(1, 9)) + bytes(range(14, 23))).decode()
+    check('not base64 text', {'mimeType': 'application/x-www-form-urlencoded', 'text': f'sig={hex_token}&id={binary}'},
+          [(LOCATION_POST_FORM, 'sig', hex_token), (LOCATION_POST_FORM, 'id', binary)])
+
+    print('body decoders test passed')
+
+
+if __name__ == '__main__':
+    test_body_decoders()
@@ -0,0 +1,183 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+dns_cache_path = r'./dns_cache.json'
+
+# 解析结果在磁盘缓存中的有效期（秒）
+dns_cache_ttl = 24 * 3600
+# 解析失败（域名不存在等）的结果的有效期（秒）
+dns_negative_ttl = 10 * 60
+
+
+def load_hosts_file(hosts_path):
+    """
+    读取 hosts 文件格式的静态解析表，每行为 "IP 主机名 [主机名...]"，# 之后为注释
+    :return: dict, key: 主机名, value: IP 列表
+    """
+    hosts = {}
+    with open(hosts_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.split('#', 1)[0].split()
+            if len(parts) < 2:
+                continue
+            for hostname in parts[1:]:
+                ips = hosts.setdefault(hostname.lower(), [])
+                if parts[0] not in ips:
+                    ips.append(parts[0])
+
+    return hosts
+
+
+class CachedResolver:
+    """
+    并发的主机名 -> IP 解析，带有持久化到磁盘的 TTL 缓存
+    - 同时进行的解析数不超过 max_concurrency，每个主机名的解析超过 timeout 秒即放弃（结果不缓存）
+    - 解析结果保存在 cache_path（json）中，重复分析同一批 ZAP 抓包时不需要再访问网络
+    - hosts 中的主机名直接使用静态结果，不访问网络也不写入缓存，可用于离线测试
+    """
+
+    def __init__(self, cache_path=dns_cache_path, ttl=dns_cache_ttl, negative_ttl=dns_negative_ttl,
+                 max_concurrency=32, timeout=5.0, hosts=None, hosts_file=None, getaddrinfo=socket.getaddrinfo):
+        """
+        :param cache_path: 磁盘缓存路径，为 None 时只在内存中缓存
+        :param ttl: 解析成功的结果的有效期（秒）
+        :param negative_ttl: 解析失败的结果的有效期（秒）
+        :param max_concurrency: 最大并发解析数
+        :param timeout: 单个主机名的解析超时（秒）
+        :param hosts: 静态解析表，dict, key: 主机名, value: IP 列表
+        :param hosts_file: hosts 文件格式的静态解析表，见 load_hosts_file
+        :param getaddrinfo: 实际执行解析的函数，签名同 socket.getaddrinfo
+        """
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._getaddrinfo = getaddrinfo
+
+        self.hosts = {}
+        if hosts_file:
+            self.hosts.update(load_hosts_file(hosts_file))
+        if hosts:
+            self.hosts.update({k.lower(): list(v) for k, v in hosts.items()})
+
+        self._cache = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                self._cache = json.load(f)
+
+    def _get_cached(self, hostname, now):
+        if hostname in self.hosts:
+            return self.hosts[hostname]
+
+        item = self._cache.get(hostname)
+        if item is not None and item['expires'] > now:
+            return item['ips']
+
+        return None
+
+    def _lookup(self, hostname):
+        """在线程中执行，返回 IP 列表，解析失败时返回 None"""
+        try:
+            host_info = self._getaddrinfo(hostname, None)
+            return list(dict.fromkeys(info[4][0] for info in host_info))
+        except (OSError, UnicodeError) as e:
+            # gaierror 是 OSError 的子类；label 过长等无法进行 IDNA 编码的主机名会抛出 UnicodeError
+            print(f"获取 IP 地址失败: {hostname}, {e}")
+            return None
+
+    async def _resolve_uncached(self, hostnames):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+        async def resolve_one(hostname):
+            async with semaphore:
+                try:
+                    return hostname, await asyncio.wait_for(loop.run_in_executor(executor, self._lookup, hostname),
+                                                            self.timeout)
+                except asyncio.TimeoutError:
+                    print(f"获取 IP 地址超时: {hostname}")
+                    return hostname, TimeoutError
+
+        try:
+            return await asyncio.gather(*(resolve_one(h) for h in hostnames))
+        finally:
+            # 超时的解析仍在线程中运行，不等待它们结束
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def resolve_many(self, hostnames):
+        """
+        并发解析多个主机名
+        :param hostnames: 主机名的可迭代对象，None 和空字符串（urlparse(url).hostname 可能为 None）会被忽略
+        :return: dict, key: 主机名, value: IP 列表（解析失败或超时为空列表）
+        """
+        now = time.time()
+        res = {}
+        uncached = []
+        for hostname in dict.fromkeys(h for h in hostnames if h):
+            ips = self._get_cached(hostname.lower(), now)
+            if ips is None:
+                uncached.append(hostname)
+            else:
+                res[hostname] = ips
+
+        if uncached:
+            for hostname, ips in asyncio.run(self._resolve_uncached(uncached)):
+                if ips is TimeoutError:
+                    # 超时可能只是网络波动，不缓存
+                    res[hostname] = []
+                    continue
+
+                ttl = self.ttl if ips else self.negative_ttl
+                res[hostname] = ips or []
+                self._cache[hostname.lower()] = {'ips': res[hostname], 'expires': now + ttl}
+
+            self.save()
+
+        return res
+
+    def resolve(self, hostname):
+        """解析单个主机名，返回 IP 列表"""
+        return self.resolve_many([hostname])[hostname]
+
+    def save(self):
+        """将缓存写入磁盘（去掉已过期的条目），先写临时文件再重命名"""
+        if not self.cache_path:
+            return
+
+        now = time.time()
+        self._cache = {k: v for k, v in self._cache.items() if v['expires'] > now}
+
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._cache, f, ensure_ascii=False)
+        os.replace(tmp_path, self.cache_path)
+
+
+def test_resolver_offline():
+    """不访问网络检查 CachedResolver：hosts 中的主机名、空主机名、解析失败和无法编码的主机名"""
+
+    def fake_getaddrinfo(hostname, port):
+        # 与 socket.getaddrinfo 一样先进行 IDNA 编码，label 超过 63 个字符时抛出 UnicodeError
+        hostname.encode('idna')
+        raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+    long_hostname = 'a' * 70 + '.example.com'
+    resolver = CachedResolver(cache_path=None, hosts={'Static.Example.com': ['192.0.2.1']},
+                              getaddrinfo=fake_getaddrinfo)
+    res = resolver.resolve_many(['static.example.com', None, '', 'missing.example.com', long_hostname])
+
+    expected = {'static.example.com': ['192.0.2.1'], 'missing.example.com': [], long_hostname: []}
+    if res != expected:
+        raise AssertionError(f'unexpected resolve result: {res}')
+
+    print('CachedResolver offline test passed')
+
+
+if __name__ == '__main__':
+    test_resolver_offline()
@@ -1,42 +1,122 @@
-import json
 import os
 import socket
+import threading
 
 import geoip2.database
+import geoip2.errors
 import urllib.parse
 
+from dns_resolver import CachedResolver
 from global_config import hostname_blacklist
+from har_reader import iter_har_entries
+
+geolite2_db_path = r'./geolite2/GeoLite2-Country.mmdb'
+
+# 每个 GeoIPService 缓存的 IP 个数，超过后清空重新缓存
+geoip_cache_size = 1 << 16
+
+
+class GeoIPService:
+    """
+    长期持有的 IP -> 国家 查询服务
+    mmdb 只打开一次（MODE_MMAP，多个进程之间共享操作系统的页缓存），查询结果按 IP 缓存；
+    geoip2 的 Reader 在 MODE_MMAP 下可以被多个线程同时使用
+    """
+
+    def __init__(self, db_path=geolite2_db_path):
+        self.db_path = db_path
+        self._reader = None
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def _get_reader(self):
+        if self._reader is None:
+            with self._lock:
+                if self._reader is None:
+                    self._reader = geoip2.database.Reader(self.db_path, mode=geoip2.database.MODE_MMAP)
+
+        return self._reader
+
+    def close(self):
+        with self._lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+            self._cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_country(self, ip_address):
+        """
+        :param ip_address: IP 地址
+        :return: 国家名，查不到或出错时返回 None
+        """
+        try:
+            return self._cache[ip_address]
+        except KeyError:
+            pass
+
+        try:
+            country = self._get_reader().country(ip_address).country.name
+        except (geoip2.errors.AddressNotFoundError, ValueError):
+            # 数据库中没有这个 IP，或不是合法的 IP，结果同样缓存
+            country = None
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            return None
+
+        if len(self._cache) >= geoip_cache_size:
+            self._cache.clear()
+        self._cache[ip_address] = country
+
+        return country
+
+    def get_countries(self, ip_addresses):
+        """
+        批量查询
+        :param ip_addresses: IP 地址的可迭代对象
+        :return: dict, key: IP 地址, value: 国家名（查不到为 None）
+        """
+        return {ip_address: self.get_country(ip_address) for ip_address in dict.fromkeys(ip_addresses)}
+
+
+_geoip_services = {}
+_geoip_services_lock = threading.Lock()
+
+
+def get_geoip_service(db_path=geolite2_db_path):
+    """返回当前进程中 db_path 对应的 GeoIPService，同一个数据库只打开一次"""
+    service = _geoip_services.get(db_path)
+    if service is None:
+        with _geoip_services_lock:
+            service = _geoip_services.setdefault(db_path, GeoIPService(db_path))
+
+    return service
 
 
 def get_country_by_ip(ip_address):
-    db_path = r'./geolite2/GeoLite2-Country.mmdb'
+    return get_geoip_service().get_country(ip_address)
 
-    try:
-        with geoip2.database.Reader(db_path) as reader:
-            response = reader.country(ip_address)
-            country = response.country.name
-            return country
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return None
+
+def get_countries_by_ips(ip_addresses):
+    """批量查询 IP 所属国家，见 GeoIPService.get_countries"""
+    return get_geoip_service().get_countries(ip_addresses)
 
 
 def get_all_hostname_from_zap_har(har, only_hostname=True, enable_blacklist=True):
     """
     从 zap 的 har 中提取所有的 url 或主机名
-    :param har: zap 生成的 har，字典或文件路径
+    :param har: zap 生成的 har，字典、entry 的迭代器或文件路径（流式读取）
     :param only_hostname: 是否只返回 hostname
     :param enable_blacklist: 是否启用 hostname 黑名单
     :return: 返回不重复 url 列表
     """
-    if isinstance(har, str) and os.path.exists(har):
-        with open(har, "r", encoding="utf-8-sig") as f:
-            har = json.load(f)
-    elif not isinstance(har, dict):
-        raise ValueError("har is not a dict or a valid file path")
-
     urls = []
-    for entry in har['log']['entries']:
+    for entry in iter_har_entries(har):
         url = entry['request']['url']
 
         # 屏蔽 localhost 等主机名
@@ -70,22 +150,30 @@ def test_ip_to_country():
     print(get_country_by_ip('114.114.114.114'))
 
 
-def test_har_to_country(only_print_non_China=False):
+def test_har_to_country(only_print_non_China=False, resolver=None):
+    """
+    :param resolver: CachedResolver，为 None 时使用默认配置（磁盘缓存 ./dns_cache.json）
+    """
     har_root_dir = r'../har_files/ZAP_test_20240810'
     har_files = [f for f in os.listdir(har_root_dir) if f.endswith('.har')]
+    if resolver is None:
+        resolver = CachedResolver()
 
     for har_file in har_files:
         print(f"处理 {har_file}...")
 
         har_file_path = os.path.join(har_root_dir, har_file)
         all_hostnames = get_all_hostname_from_zap_har(har_file_path)
+        # 并发解析这个 har 中所有的主机名，已缓存的不再访问网络
+        hostname_ips = resolver.resolve_many(all_hostnames)
 
-        for hostname in all_hostnames:
+        # 一次性批量查询这个 har 中所有的 IP
+        ip_country = get_countries_by_ips(ip for ips in hostname_ips.values() for ip in ips)
 
-            ip_addresses = get_ip_from_hostname(hostname)
+        for hostname, ip_addresses in hostname_ips.items():
             cnt = 0
             for ip_address in ip_addresses:
-                country = get_country_by_ip(ip_address)
+                country = ip_country[ip_address]
                 if only_print_non_China and country == 'China':
                     continue
 
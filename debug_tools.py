@@ -2,7 +2,13 @@ import json
 import os
 
 from base import get_md5_from_entry
+from fingerprint import compute_fingerprint, get_har_fingerprint_algorithm, get_lookup_algorithms
 from global_config import bold_split, thin_split
+from har_cache import HarCache, find_valid_cache, cache_suffix
+from har_index import EntryIndex, get_entry_index
+from har_reader import iter_har_entries, list_har_files
+from search_index import SearchIndex, search_index_path, serialize_entry, get_context_lines
+from token_index import TokenIndex, token_index_path
 
 import urllib.parse
 
@@ -13,36 +19,60 @@ def print_entry_by_md5(md5, only_hash=True):
     :param md5: entry 的 md5
     :param only_hash: 只测试带 _md5 后缀的 har 文件
     """
-    har_files = os.listdir("./har_files")
-    for har_file in har_files:
-        if har_file.endswith(".har"):
-            if only_hash and not har_file.endswith("_md5.har"):
-                continue
-
-            har_file_path = os.path.join("./har_files", har_file)
-
+    for har_file_path in list_har_files("./har_files", only_hash=only_hash):
+        if find_valid_cache(har_file_path):
+            # 有预处理缓存时直接按 md5 表查找，不需要解码所有 entry
             entry_found = get_entry_by_md5(har_file_path, md5)
-            if entry_found:
-                print(f"entry found in {har_file}")
-                print(json.dumps(entry_found, ensure_ascii=False, indent=2))
-                return
+        else:
+            entry_found = get_entry_index(har_file_path).get_entry(md5)
+
+        if entry_found:
+            print(f"entry found in {os.path.basename(har_file_path)}")
+            print(json.dumps(entry_found, ensure_ascii=False, indent=2))
+            return
 
     print(f"\n未找到 md5 为 {md5} 的 entry")
 
 
-def get_entries_with_str(target_str, only_hash=True, print_context=5):
-    har_files = os.listdir("./har_files")
+def get_entries_with_str(target_str, only_hash=True, print_context=5, use_index=True):
+    """
+    查找包含特定字符串的 entry 并打印
+    :param use_index: 是否使用索引
+        search_index.sqlite 存在时，已索引且没有变化的 har 文件直接在子串搜索索引中查找，不需要重新解析；
+        否则逐个 entry 全文搜索（token_index.sqlite 只能精确匹配请求中的 value，不用于子串搜索，
+        精确查找见 get_entries_with_value）
+    """
+    har_paths = list_har_files("./har_files", only_hash=only_hash)
 
-    res = {}
-    for har_file in har_files:
-        if har_file.endswith(".har"):
-            if only_hash and not har_file.endswith("_md5.har"):
-                continue
+    # {har_path: [(md5, entry 的文本)]}
+    if use_index and os.path.exists(search_index_path):
+        res = get_entries_with_str_from_search_index(har_paths, target_str)
+    else:
+        res = {}
+        for har_file_path in har_paths:
+            for har_path, entries in get_entries_with_str_in_har(har_file_path, target_str).items():
+                res[har_path] = [(get_md5_from_entry(entry), serialize_entry(entry)) for entry in entries]
+
+    print_search_result(res, target_str, print_context)
+
+
+def get_entries_with_value(value, only_hash=True, print_context=5):
+    """
+    通过倒排索引（token_index.sqlite）查找请求中包含 value（完全相同）的 entry 并打印，
+    只包含请求中经过过滤的 value，不包含 value 的子串、response 中的内容
+    """
+    har_paths = list_har_files("./har_files", only_hash=only_hash)
+    res = get_entries_with_value_from_index(har_paths, value) or {har_path: [] for har_path in har_paths}
+    res = {har_path: [(get_md5_from_entry(entry), serialize_entry(entry)) for entry in entries]
+           for har_path, entries in res.items()}
 
-            har_file_path = os.path.join("./har_files", har_file)
+    print_search_result(res, value, print_context)
 
-            res.update(get_entries_with_str_in_har(har_file_path, target_str))
 
+def print_search_result(res, target_str, print_context=5):
+    """
+    :param res: dict: {har_path: [(md5, entry 的文本)]}
+    """
     total_count = 0
     not_found_file = []
     for har_path, entries in res.items():
@@ -67,35 +97,99 @@ def get_entries_with_str(target_str, only_hash=True, print_context=5):
             for har_file_path, entry_res in res.items():
                 har_count += 1
                 entry_count = 0
-                for entry in entry_res:
+                for entry_md5, entry_text in entry_res:
                     entry_count += 1
                     print(thin_split)
-                    print(f"entry {entry_count} / {len(entry_res)} | entry md5: {get_md5_from_entry(entry)}"
+                    print(f"entry {entry_count} / {len(entry_res)} | entry md5: {entry_md5}"
                           f" | har {har_count} / {len(res)} | har: {har_file_path}")
                     print(thin_split)
 
-                    entry_str = json.dumps(entry, ensure_ascii=False, indent=2)
-                    entry_str = entry_str.split('\n')
-                    for i, line in enumerate(entry_str):
-                        if target_str in line:
-                            for j in range(i - print_context, i + print_context + 1):
-                                if 0 <= j < len(entry_str):
-                                    print(entry_str[j])
-                            break
+                    for line in get_context_lines(entry_text, target_str, print_context):
+                        print(line)
+
+
+def get_entries_with_str_from_search_index(har_paths, target_str, db_path=search_index_path):
+    """
+    通过子串搜索索引查找包含 target_str 的 entry，没有索引或索引已过期的 har 文件仍然逐个 entry 搜索
+    :return: dict: {har_path: [(md5, entry 的文本)]}
+    """
+    res = {har_path: [] for har_path in har_paths}
+    with SearchIndex(db_path) as index:
+        indexed = [har_path for har_path in har_paths if index.is_up_to_date(har_path)]
+        # 索引中保存的是绝对路径
+        abs_paths = {os.path.abspath(har_path): har_path for har_path in indexed}
+        for abs_path, entry_md5, entry_text in index.search(target_str, indexed):
+            res[abs_paths[abs_path]].append((entry_md5, entry_text))
+
+    indexed = set(indexed)
+    for har_path in har_paths:
+        if har_path not in indexed:
+            entries = get_entries_with_str_in_har(har_path, target_str)[har_path]
+            res[har_path] = [(get_md5_from_entry(entry), serialize_entry(entry)) for entry in entries]
+
+    return res
+
+
+def get_entries_with_value_from_index(har_paths, value, db_path=token_index_path, enable_stopwords=None):
+    """
+    通过倒排索引查找请求中包含 value（完全相同）的 entry，查询前会增量更新 har_paths 的索引
+    :param enable_stopwords: 索引使用的停用词过滤模式，为 None 时沿用已有索引建立时的模式，
+        避免与已有索引的模式不同而每次查询都重新索引所有文件
+    :return: dict: {har_path: 符合条件的 entry 列表}，没有找到任何 entry 时返回 None
+    """
+    with TokenIndex(db_path) as index:
+        params = {}
+        if enable_stopwords is None:
+            params = index.get_index_params() or {}
+        else:
+            params['enable_stopwords'] = enable_stopwords
+        index.update(har_paths, prune=False, enable_print=False, **params)
+        occurrences = index.lookup(value)
+
+    md5_lists = {}
+    for occurrence in occurrences:
+        md5_list = md5_lists.setdefault(occurrence.har_path, [])
+        if occurrence.md5 not in md5_list:
+            md5_list.append(occurrence.md5)
+
+    if not md5_lists:
+        return None
+
+    # 索引中保存的是绝对路径
+    return {har_path: get_entries_by_md5(har_path, md5_lists.get(os.path.abspath(har_path), []))
+            for har_path in har_paths}
+
+
+def get_entries_by_md5(har_path, md5_list):
+    """
+    通过 md5 批量获取一个 har 文件中的 entry，每个文件只打开一次缓存或建立一次索引，不会每个 md5 都遍历一次 har
+    :return: entry 列表，找不到的 md5 被跳过
+    """
+    if not md5_list:
+        return []
+
+    cache_path = find_valid_cache(har_path)
+    if cache_path:
+        with HarCache(cache_path) as cache:
+            entries = [cache.get_entry(md5) for md5 in md5_list]
+    else:
+        entry_index = get_entry_index(har_path)
+        entries = [entry_index.get_entry(md5) for md5 in md5_list]
+
+    return [entry for entry in entries if entry is not None]
 
 
 def get_entries_with_str_in_har(har_path, target_str):
     """在 har 的 entries 中，查找包含特定字符串的 entry，返回 dit: {har_path: 符合条件的 entry 列表}"""
 
-    with open(har_path, "r", encoding="utf-8-sig") as f:
-        har = json.load(f)
     res = []
 
-    for entry in har['log']['entries']:
-        url = entry['request']['url']
+    if har_path.endswith(cache_suffix):
+        print(f"|{har_path}| is a {cache_suffix} cache without response, only request fields are searched")
 
-        entry_str = json.dumps(entry, ensure_ascii=False, sort_keys=True)
-        if target_str in entry_str:
+    # 需要在完整的 entry（包括 response）中查找，不使用只包含请求侧字段的缓存
+    for entry in iter_har_entries(har_path, use_cache=False):
+        if target_str in serialize_entry(entry):
             res.append(entry)
 
     return {har_path: res}
@@ -104,19 +198,30 @@ def get_entries_with_str_in_har(har_path, target_str):
 def get_entry_by_md5(har, md5):
     """
     通过 md5 获取 entry
-    :param har: har 字典对象或 .har 文件路径
+    :param har: har 字典对象、EntryIndex、entry 的迭代器或 .har 文件路径（流式读取）
     :param md5: entry 的 md5
-    :return: 返回 entry，找不到则抛出异常
+    :return: 返回 entry，找不到则返回 None
     """
 
-    if isinstance(har, str) and os.path.exists(har):
-        with open(har, "r", encoding="utf-8-sig") as f:
-            har = json.load(f)
-    elif not isinstance(har, dict):
-        raise ValueError("har must be a dict or a valid file path")
+    if isinstance(har, EntryIndex):
+        return har.get_entry(md5)
+
+    algorithms = get_lookup_algorithms(get_har_fingerprint_algorithm(har['log']) if isinstance(har, dict) else None)
+
+    if isinstance(har, str):
+        cache_path = find_valid_cache(har)
+        if cache_path:
+            with HarCache(cache_path) as cache:
+                return cache.get_entry(md5)
+
+    for entry in iter_har_entries(har):
+        if 'md5' in entry:
+            if entry['md5'] == md5:
+                return entry
+            continue
 
-    for entry in har['log']['entries']:
-        if get_md5_from_entry(entry) == md5:
+        # 未预处理的 entry，依次尝试 har 中记录的算法和旧算法（md5-full）
+        if any(compute_fingerprint(entry, algorithm) == md5 for algorithm in algorithms):
             return entry
 
     return None
@@ -130,7 +235,8 @@ def url_decode(target_url):
 if __name__ == '__main__':
     menu = ['1. 通过 md5 查找 entry',
             '2. 查找包含特定字符串的 entry',
-            '3. URL 解码', ]
+            '3. URL 解码',
+            '4. 通过倒排索引精确查找请求中的 value', ]
     menu_text = "\n".join(menu) + "\n请选择操作："
 
     while True:
@@ -172,6 +278,15 @@ if __name__ == '__main__':
                   f'')
             print(f'解码后的 url: \n{url_decode(url)}')
 
+        elif option == "4":
+            value = input("输入要查找的 value：")
+            if value == "":
+                print("无效输入，请重新输入")
+                continue
+
+            only_hash = input("只查找 md5 文件？(y/all, press Enter to y)")
+            get_entries_with_value(value, only_hash=only_hash.lower() != "all")
+
         else:
             print("无效输入，请重新输入")
 
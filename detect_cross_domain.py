@@ -1,9 +1,11 @@
 from urllib.parse import urlparse
 
+import instrumentation
 from global_config import bold_split
+from public_suffix import get_registrable_domain_from_netloc
 
 
-def get_domain(url, domain_level=0, with_suffix=False):
+def get_domain(url, domain_level=0, with_suffix=False, use_psl=False):
     """
     从 URL 中提取域名
     :param url: 完整的 URL
@@ -13,9 +15,13 @@ def get_domain(url, domain_level=0, with_suffix=False):
         2: 仅返回次级域名（二级域名）
         ...
     :param with_suffix: 是否包含域名后缀
+    :param use_psl: 根据公共后缀列表返回可注册域名（如 a.b.com.cn -> b.com.cn），此时忽略 domain_level 和 with_suffix
     :return: 返回提取到的域名，如果不存在则返回空字符串
     """
 
+    if use_psl:
+        return get_registrable_domain_from_netloc(urlparse(url).netloc)
+
     if domain_level == 0:
         return urlparse(url).netloc
 
@@ -32,7 +38,7 @@ def get_domain(url, domain_level=0, with_suffix=False):
         return domain_parts[domain_level - 1]
 
 
-def is_same_domain(url1, url2, level=2, with_suffix=False):
+def is_same_domain(url1, url2, level=2, with_suffix=False, use_psl=False):
     """
     检查两个 URL 是否来自同一个域名，忽略 www 前缀，并根据指定的 level 进行域名比较。
     :param level: 域名比较的级别
@@ -41,26 +47,56 @@ def is_same_domain(url1, url2, level=2, with_suffix=False):
         level 2: 二级域名比较 (常用)
         ...
     :param with_suffix: 比较时是否包含域名后缀（包含更顶级的域名）
+    :param use_psl: 根据公共后缀列表比较可注册域名（如 a.com.cn 和 b.com.cn 不是同一个域名），此时忽略 level 和 with_suffix
     :return: 两个 URL 是否来自同一个域名
     """
-    domain1 = get_domain(url1, domain_level=level, with_suffix=with_suffix)
-    domain2 = get_domain(url2, domain_level=level, with_suffix=with_suffix)
+    domain1 = get_domain(url1, domain_level=level, with_suffix=with_suffix, use_psl=use_psl)
+    domain2 = get_domain(url2, domain_level=level, with_suffix=with_suffix, use_psl=use_psl)
 
     return domain1 == domain2
 
 
-def group_by_domain(urls, level=2, with_suffix=False):
+def group_by_domain(urls, level=2, with_suffix=False, use_psl=False):
     """
     将 URL 列表按照域名进行分组
+    每个 URL 只计算一次域名，按域名放入哈希桶，线性时间完成分组，结果与 group_by_domain_pairwise 一致
+    :param urls: list[tuple(url, md5), tuple(url, md5), ...]
+    :param level: 同 is_same_domain 方法
+    :param with_suffix: 同 is_same_domain 方法
+    :param use_psl: 同 is_same_domain 方法
+    :return: 返回分组后的二维列表, 第二维每个子列表中的 url 为同一个 domain，[[same domain urls], [same domain urls], ...]
+        有多个 url 的分组在前，只有一个 url 的分组在后，组内按 urls 中的顺序排列，重复的 url 只保留一个
+    """
+    sw = instrumentation.stopwatch()
+    buckets = {}
+    for url in urls:
+        domain = get_domain(url[0], domain_level=level, with_suffix=with_suffix, use_psl=use_psl)
+        # 用 dict 作为有序集合，去掉重复的 url
+        buckets.setdefault(domain, {})[url] = None
+
+    groups = [list(bucket) for bucket in buckets.values()]
+
+    if sw:
+        sw.lap('group_by_domain')
+        instrumentation.metrics.incr('grouped_urls', len(urls))
+        instrumentation.metrics.incr('domain_groups', len(groups))
+
+    return [g for g in groups if len(g) > 1] + [g for g in groups if len(g) == 1]
+
+
+def group_by_domain_pairwise(urls, level=2, with_suffix=False, use_psl=False):
+    """
+    将 URL 列表按照域名进行分组（两两比较，O(n²)，仅作为 group_by_domain 的对照实现）
     :param urls: list[tuple(url, md5), tuple(url, md5), ...]
     :param level: 同 is_same_domain 方法
     :param with_suffix: 同 is_same_domain 方法
+    :param use_psl: 同 is_same_domain 方法
     :return: 返回分组后的二维列表, 第二维每个子列表中的 url 为同一个 domain，[[same domain urls], [same domain urls], ...]
     """
     res = []
     for i in range(len(urls)):
         for j in range(i + 1, len(urls)):
-            if is_same_domain(urls[i][0], urls[j][0], level=level, with_suffix=with_suffix):
+            if is_same_domain(urls[i][0], urls[j][0], level=level, with_suffix=with_suffix, use_psl=use_psl):
                 res.append([urls[i], urls[j]])
 
     res = merge_lists(res)
@@ -131,7 +167,40 @@ def test():
     for group in res2:
         print(group)
 
+    print(bold_split)
+
+    # a.com.cn 和 b.com.cn 在 level=2, with_suffix=False 时都会被当作 "com"，根据公共后缀列表则可以区分
+    urls_cn = [("https://a.com.cn/x", 7), ("https://b.com.cn/y", 8), ("https://www.a.com.cn/z", 9)]
+    print(group_by_domain(urls_cn, level=2, with_suffix=False))
+    print(group_by_domain(urls_cn, use_psl=True))
+
+
+def test_group_by_domain_equivalence(n_urls=300, rounds=20, seed=0):
+    """检查 group_by_domain 与两两比较的 group_by_domain_pairwise 的分组结果一致"""
+    import random
+
+    def normalize(groups):
+        return sorted(sorted(group) for group in groups)
+
+    rnd = random.Random(seed)
+    hosts = ['example.com', 'www.example.com', 'sub.example.com', 'example.org', 'a.b.example.org',
+             'a.com.cn', 'b.com.cn', 'localhost', '127.0.0.1', 'example.com:8080', 'EXAMPLE.com', '']
+
+    for _ in range(rounds):
+        urls = [(f"{rnd.choice(['http', 'https'])}://{rnd.choice(hosts)}/p{rnd.randint(0, 3)}", rnd.randint(0, 50))
+                for _ in range(rnd.randint(0, n_urls))]
+        for level, with_suffix, use_psl in [(level, with_suffix, False) for level in range(4)
+                                            for with_suffix in (True, False)] + [(2, False, True)]:
+            res = group_by_domain(urls, level=level, with_suffix=with_suffix, use_psl=use_psl)
+            expected = group_by_domain_pairwise(urls, level=level, with_suffix=with_suffix, use_psl=use_psl)
+            if normalize(res) != normalize(expected):
+                raise AssertionError(f'group_by_domain mismatch: level={level}, with_suffix={with_suffix}, '
+                                     f'use_psl={use_psl}')
+
+    print('group_by_domain is consistent with group_by_domain_pairwise')
+
 
 if __name__ == '__main__':
     test()
+    test_group_by_domain_equivalence()
     pass
@@ -0,0 +1,149 @@
+from collections import namedtuple
+from urllib.parse import urlparse, parse_qs
+
+import instrumentation
+from body_decoders import decode_content, decode_post_body, iter_json_leaves, parse_mime_type, \
+    LOCATION_POST_JSON, LOCATION_POST_FORM, LOCATION_POST_MULTIPART, LOCATION_POST_TEXT
+from global_config import response_body_mime_types, response_body_max_size
+
+# 字段所在的位置
+LOCATION_URL = 'url'  # url 中的查询参数
+LOCATION_HEADER = 'header'  # entry['request']['headers']
+LOCATION_COOKIE = 'cookie'  # entry['request']['cookies']
+LOCATION_COOKIE_HEADER = 'cookie_header'  # http header 中的 cookie 字符串
+# post body 中的位置（LOCATION_POST_JSON、LOCATION_POST_FORM、LOCATION_POST_MULTIPART、LOCATION_POST_TEXT）见 body_decoders.py
+LOCATION_RESPONSE_HEADER = 'response_header'  # entry['response']['headers']（Set-Cookie 除外）
+LOCATION_SET_COOKIE = 'set_cookie'  # 响应设置的 cookie（entry['response']['cookies'] 或 Set-Cookie header）
+LOCATION_RESPONSE_BODY = 'response_body'  # 响应 body 中的字段，见 extract_response_body_fields
+
+# 请求中的一个字段，value 保持原始类型（post body 的 json 中可能不是字符串）
+Field = namedtuple('Field', ['location', 'key', 'value'])
+
+
+def extract_fields(entry):
+    """
+    将请求解析为 (location, key, value) 字段列表，url、post body 等只解析一次，
+    供 find_tokens（keyname）和 get_values（compare）两种检测方式共用
+    :param entry: entry 字典
+    :return: Field 列表，按 url、headers、cookies、post body 的顺序
+    """
+    request = entry['request']
+
+    fields = extract_url_fields(request['url'])
+    fields.extend(extract_header_fields(request['headers']))
+    fields.extend(extract_cookie_fields(request['cookies']))
+    if 'postData' in request:
+        fields.extend(extract_post_body_fields(request['postData']))
+
+    return fields
+
+
+def extract_url_fields(url):
+    """从 URL 的查询参数中提取字段，同一个参数出现多次时每个值一个字段"""
+    query = urlparse(url).query
+    return [Field(LOCATION_URL, key, value)
+            for key, values in parse_qs(query).items()
+            for value in values]
+
+
+def extract_header_fields(headers):
+    """从 headers 列表中提取字段"""
+    return [Field(LOCATION_HEADER, header['name'], header['value']) for header in headers]
+
+
+def extract_cookie_fields(cookies):
+    """
+    从 cookies 中提取字段
+    :param cookies: 支持 cookies 列表（entry['request']['cookies']），或 http header 中的 cookie 字符串
+    """
+    if not cookies:
+        return []
+
+    if isinstance(cookies, str):
+        fields = []
+        for cookie in cookies.split(';'):
+            cookie_key, cookie_value = cookie.strip().split('=', maxsplit=1)
+            fields.append(Field(LOCATION_COOKIE_HEADER, cookie_key, cookie_value))
+        return fields
+
+    if isinstance(cookies, list):
+        return [Field(LOCATION_COOKIE, cookie['name'], cookie['value']) for cookie in cookies]
+
+    raise ValueError('cookies is not a string or list')
+
+
+def extract_post_body_fields(post_data):
+    """
+    从 post body 中提取字段，按 mimeType 和内容选择解码器，见 body_decoders.py：
+    json（展开嵌套的 dict 和 list，见 iter_json_leaves）、x-www-form-urlencoded、multipart/form-data、
+    text/plain 的 key=value 文本，以及其中 base64 编码、gzip / deflate 压缩的内容
+    """
+    return list(map(Field._make, decode_post_body(post_data)))
+
+
+def extract_response_fields(entry, include_body=True):
+    """
+    将响应解析为字段列表，用于查找由响应下发（之后在请求中使用）的 token
+    :param entry: entry 字典，需要包含 response（预处理生成的 .harc 缓存中没有 response）
+    :param include_body: 是否解析响应 body，只有 mimeType 在 response_body_mime_types 中、
+        且大小不超过 response_body_max_size 的 body 才会被解码
+    :return: Field 列表，按 headers、Set-Cookie、body 的顺序
+    """
+    response = entry.get('response')
+    if not response:
+        return []
+
+    headers = response.get('headers') or []
+    fields = [Field(LOCATION_RESPONSE_HEADER, header['name'], header['value'])
+              for header in headers if header['name'].lower() != 'set-cookie']
+
+    cookies = response.get('cookies')
+    if cookies:
+        fields.extend(Field(LOCATION_SET_COOKIE, cookie['name'], cookie['value']) for cookie in cookies)
+    else:
+        for header in headers:
+            if header['name'].lower() == 'set-cookie':
+                # Set-Cookie: name=value; Path=/; ...，可能有多个 cookie 以换行分隔
+                for line in header['value'].splitlines():
+                    name, sep, value = line.partition(';')[0].partition('=')
+                    if sep:
+                        fields.append(Field(LOCATION_SET_COOKIE, name.strip(), value.strip()))
+
+    if include_body and 'content' in response:
+        fields.extend(extract_response_body_fields(response['content']))
+
+    return fields
+
+
+def is_candidate_response_body(content):
+    """响应 body 是否可能包含 token：mimeType 是 json、文本或表单，且大小不超过 response_body_max_size"""
+    if not content.get('text'):
+        return False
+
+    mime_type, _ = parse_mime_type(content.get('mimeType'))
+    if mime_type not in response_body_mime_types and not mime_type.endswith('+json'):
+        return False
+
+    size = content.get('size')
+    if not isinstance(size, int) or size < 0:
+        size = len(content['text'])
+
+    return size <= response_body_max_size and len(content['text']) <= response_body_max_size
+
+
+def extract_response_body_fields(content):
+    """
+    从响应 body 中提取字段，图片、脚本等其他类型的 body 不会被读取或解码
+    解码方式同 post body（见 body_decoders.py），content['encoding'] 为 base64 时先解码
+    :param content: entry['response']['content']
+    :return: Field 列表，location 均为 LOCATION_RESPONSE_BODY
+    """
+    if not is_candidate_response_body(content):
+        if instrumentation.enabled:
+            instrumentation.metrics.incr('response_bodies_skipped')
+        return []
+
+    if instrumentation.enabled:
+        instrumentation.metrics.incr('response_bodies_decoded')
+
+    return [Field(LOCATION_RESPONSE_BODY, key, value) for _, key, value in decode_content(content)]
@@ -0,0 +1,243 @@
+import sys
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import compress, count, islice, repeat
+from operator import add, floordiv, itemgetter, mod, mul
+from urllib.parse import urlparse, parse_qsl
+
+from base import get_md5_from_entry
+from extract_fields import extract_cookie_fields, extract_post_body_fields, \
+    LOCATION_URL, LOCATION_HEADER, LOCATION_COOKIE
+from get_values import get_values_from_entry, is_stop_word, perfect_match_locations
+from global_config import min_token_len
+from har_reader import iter_har_entries
+
+_get_name = itemgetter('name')
+_get_value = itemgetter('value')
+
+
+def _get_query(url):
+    """与 urlparse(url).query 相同，常见的 url 不经过 urlparse 完整解析"""
+    if '\t' in url or '\r' in url or '\n' in url:
+        # urlparse 会先去掉这些字符
+        return urlparse(url).query
+
+    return url.partition('#')[0].partition('?')[2]
+
+
+def _is_value_key(location, key, enable_stopwords):
+    """不考虑 value 的长度时，这个字段的 value 是否会被 iter_value_fields 保留，规则与其一致"""
+    if location in perfect_match_locations:
+        if enable_stopwords and key and is_stop_word(key, 1):
+            return False
+    elif is_stop_word(key, enable_stopwords):
+        return False
+
+    return not (location == LOCATION_HEADER and key.lower() == 'cookie')
+
+
+class FieldBatch:
+    """
+    将一批 entry（通常是整个 har）的字段展开为列存储：每一行是一个字段，
+    entry id、(location, key) id、value id 各存在一个 array 中，(location, key) 和 value 去重后各保存一份
+    停用词过滤对每个不同的 (location, key) 只判断一次，最小长度对每个不同的 value 只判断一次，
+    再通过查表得到整列的过滤结果，不再对每个请求的每个字段逐一调用过滤函数
+    结果与逐个 entry 调用 get_values_from_entry 一致
+    """
+
+    def __init__(self):
+        self.md5s = []
+        self.entry_ids = array('I')
+        self.pair_ids = array('I')
+        self.value_ids = array('I')
+
+        # (location, key) -> id，value -> id，第一次访问时按插入的顺序编号
+        self._pair_index = defaultdict(count().__next__)
+        self._value_index = defaultdict(count().__next__)
+
+        # 按 id 排列的每个 (location, key) 的停用词判断结果（每种过滤模式一个）和每个 value 的长度，查询时增量计算
+        self._pair_ok = {}
+        self._value_lens = array('I')
+
+    def __len__(self):
+        """行（字段）数"""
+        return len(self.value_ids)
+
+    @property
+    def entry_count(self):
+        return len(self.md5s)
+
+    @property
+    def pairs(self):
+        """按 id 排列的 (location, key) 列表"""
+        return list(self._pair_index)
+
+    @property
+    def values(self):
+        """按 id 排列的 value 列表"""
+        return list(self._value_index)
+
+    def add_entry(self, entry):
+        """
+        添加一个 entry 的所有字段，字段与 extract_fields(entry) 一致，但不逐个创建 Field，
+        而是按 location 整列取出 key 和 value，通过 defaultdict 在 C 层完成去重和编号
+        :return: entry id（从 0 开始，与添加的顺序一致）
+        """
+        request = entry['request']
+        entry_id = len(self.md5s)
+        self.md5s.append(get_md5_from_entry(entry))
+
+        n_rows = len(self.value_ids)
+        query = _get_query(request['url'])
+        if query:
+            self._add_column(LOCATION_URL, parse_qsl(query))
+
+        headers = request['headers']
+        self._add_column(LOCATION_HEADER, zip(map(_get_name, headers), map(_get_value, headers)))
+
+        cookies = request['cookies']
+        if isinstance(cookies, list):
+            self._add_column(LOCATION_COOKIE, zip(map(_get_name, cookies), map(_get_value, cookies)))
+        else:
+            self._add_fields(extract_cookie_fields(cookies))
+
+        if 'postData' in request:
+            self._add_fields(extract_post_body_fields(request['postData']))
+
+        self.entry_ids.extend(repeat(entry_id, len(self.value_ids) - n_rows))
+
+        return entry_id
+
+    def _add_column(self, location, items):
+        """
+        :param items: 同一个 location 的 (key, value) 的可迭代对象，value 均为字符串
+        """
+        items = list(items)
+        if items:
+            keys, values = zip(*items)
+            self.pair_ids.extend(map(self._pair_index.__getitem__, zip(repeat(location), keys)))
+            self.value_ids.extend(map(self._value_index.__getitem__, values))
+
+    def _add_fields(self, fields):
+        """添加 Field 列表，post body 中的 value 可能不是字符串，与 iter_value_fields 一样转为字符串"""
+        if fields:
+            locations, keys, values = zip(*fields)
+            self.pair_ids.extend(map(self._pair_index.__getitem__, zip(locations, keys)))
+            self.value_ids.extend(map(self._value_index.__getitem__, map(str, values)))
+
+    @classmethod
+    def from_entries(cls, entries):
+        """
+        :param entries: entry 的可迭代对象
+        """
+        batch = cls()
+        for entry in entries:
+            batch.add_entry(entry)
+
+        return batch
+
+    @classmethod
+    def from_har(cls, har):
+        """
+        :param har: har 文件路径、har 字典或 entry 的迭代器（文件路径会流式读取）
+        """
+        return cls.from_entries(iter_har_entries(har))
+
+    def get_value_mask(self, enable_stopwords=1, min_len=min_token_len):
+        """
+        :param enable_stopwords: 同 get_values_from_entry
+        :param min_len: 最小 token 长度
+        :return: bytes，每一行一个字节，1 表示该行的 value 会被 get_values_from_entry 保留
+        """
+        n_rows = len(self)
+        if not n_rows:
+            return b''
+
+        # 每个不同的 (location, key) 只判断一次停用词，每个不同的 value 只计算一次长度
+        pair_ok = self._pair_ok.setdefault(enable_stopwords, bytearray())
+        if len(pair_ok) < len(self._pair_index):
+            pair_ok.extend(_is_value_key(location, key, enable_stopwords)
+                           for location, key in islice(self._pair_index, len(pair_ok), None))
+
+        if len(self._value_lens) < len(self._value_index):
+            self._value_lens.extend(map(len, islice(self._value_index, len(self._value_lens), None)))
+        value_ok = bytes(map(min_len.__le__, self._value_lens))
+
+        # 查表得到两列 0/1 字节，按位与合并
+        pair_col = bytes(map(pair_ok.__getitem__, self.pair_ids))
+        value_col = bytes(map(value_ok.__getitem__, self.value_ids))
+        mask = int.from_bytes(pair_col, 'little') & int.from_bytes(value_col, 'little')
+
+        return mask.to_bytes(n_rows, 'little')
+
+    def get_value_columns(self, enable_stopwords=1, min_len=min_token_len):
+        """
+        :return: (entry id 列, value id 列)，只包含保留的行，按 entry 的顺序，同一个 entry 中去重
+        """
+        mask = self.get_value_mask(enable_stopwords, min_len)
+
+        # (entry id, value id) 编码为一个整数后去重，不创建 tuple
+        n_values = len(self._value_index) or 1
+        keys = list(dict.fromkeys(compress(map(add, map(mul, self.entry_ids, repeat(n_values)), self.value_ids), mask)))
+
+        return array('I', map(floordiv, keys, repeat(n_values))), array('I', map(mod, keys, repeat(n_values)))
+
+    def iter_value_ids(self, enable_stopwords=1, min_len=min_token_len):
+        """
+        :return: 保留的 (entry id, value id) 的迭代器，按 entry 的顺序，同一个 entry 中去重
+        """
+        return zip(*self.get_value_columns(enable_stopwords, min_len))
+
+    def get_values(self, enable_stopwords=1, min_len=min_token_len):
+        """
+        :return: 列表，第 i 项为第 i 个 entry 的 values 列表（去重），与 get_values_from_entry 的结果一致（顺序可能不同）
+        """
+        entry_ids, value_ids = self.get_value_columns(enable_stopwords, min_len)
+        values = list(map(self.values.__getitem__, value_ids))
+
+        # entry id 列是有序的，按每个 entry 的起始位置切片
+        starts = [bisect_left(entry_ids, i) for i in range(self.entry_count)] + [len(values)]
+        return [values[start:end] for start, end in zip(starts, starts[1:])]
+
+    def iter_value_occurrences(self, enable_stopwords=1, min_len=min_token_len):
+        """
+        :return: (value, md5) 的迭代器，可以直接添加到 OccurrenceStore 中
+        """
+        values = self.values
+        md5s = self.md5s
+        return ((values[value_id], md5s[entry_id])
+                for entry_id, value_id in self.iter_value_ids(enable_stopwords, min_len))
+
+
+def get_values_from_har(har, enable_stopwords=1, min_len=min_token_len):
+    """
+    批量提取 har 中每个请求的 values
+    :param har: har 文件路径、har 字典或 entry 的迭代器（文件路径会流式读取）
+    :return: (md5 列表, values 列表的列表)，第 i 个请求的 md5 和 values
+    """
+    batch = FieldBatch.from_har(har)
+    return batch.md5s, batch.get_values(enable_stopwords=enable_stopwords, min_len=min_len)
+
+
+def test_field_batch_equivalence(har, min_lens=(0, 5, min_token_len)):
+    """检查 FieldBatch 与逐个 entry 调用 get_values_from_entry 的结果一致"""
+    entries = list(iter_har_entries(har))
+    batch = FieldBatch.from_entries(entries)
+
+    for enable_stopwords in (0, 1, 2):
+        for min_len in min_lens:
+            res = batch.get_values(enable_stopwords=enable_stopwords, min_len=min_len)
+            for i, entry in enumerate(entries):
+                expected = get_values_from_entry(entry, enable_stopwords=enable_stopwords, min_len=min_len)
+                if sorted(res[i]) != sorted(expected) or len(res[i]) != len(expected):
+                    raise AssertionError(f'FieldBatch mismatch: entry {i}, enable_stopwords={enable_stopwords}, '
+                                         f'min_len={min_len}')
+
+    print(f'FieldBatch is consistent with get_values_from_entry ({len(entries)} entries, {len(batch)} fields)')
+
+
+if __name__ == '__main__':
+    # python field_batch.py ./har_files/xxx_md5.har ...
+    for har_path in sys.argv[1:]:
+        test_field_batch_equivalence(har_path)
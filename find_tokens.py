@@ -1,32 +1,61 @@
-import json
-from urllib.parse import urlparse, parse_qs
+import instrumentation
+from extract_fields import extract_url_fields, extract_header_fields, extract_post_body_fields, \
+    LOCATION_URL, LOCATION_HEADER, LOCATION_POST_JSON, LOCATION_POST_FORM, LOCATION_POST_MULTIPART, LOCATION_POST_TEXT
+from key_matcher import token_key_matcher
 
-from base import is_token_key
+is_token_key = token_key_matcher.is_token_key
 
 
-def find_tokens_in_url(url, level=0, enable_stopwords=True):
+def find_tokens_in_fields(fields, level=0, enable_stopwords=True):
     """
-    从 URL 中提取 tokens
-    :param url: 完整的 URL
+    从 extract_fields 解析出的字段中，根据 keyname 提取 tokens
+    只考虑 url 参数、headers 和 post body，不考虑 cookies 列表（cookie 已经以字符串形式出现在 headers 中）
+    :param fields: Field 列表
     :param level: 检测等级
-    :return: 返回提取到的 tokens 字典
+    :return: 返回提取到的 tokens 字典，后出现的同名 key 会覆盖先出现的
     """
 
     tokens = {}
+    url_tokens = {}
+
+    for location, key, value in fields:
+        if location == LOCATION_URL:
+            if is_token_key(key, level, enable_stopwords):
+                if key in url_tokens:
+                    raise ValueError(f'values has more than one item: {[url_tokens[key], value]}')
+
+                url_tokens[key] = tokens[key] = value
 
-    query = urlparse(url).query
-    params = parse_qs(query)
+        elif location in (LOCATION_HEADER, LOCATION_POST_FORM, LOCATION_POST_MULTIPART, LOCATION_POST_TEXT):
+            if is_token_key(key, level, enable_stopwords):
+                tokens[key] = value
 
-    for key, values in params.items():
-        if is_token_key(key, level, enable_stopwords):
-            if len(values) != 1:
-                raise ValueError(f'values has more than one item: {values}')
+        elif location == LOCATION_POST_JSON:
+            if is_token_key(key, level, enable_stopwords) and value != '':
+                tokens[key] = value
 
-            tokens[key] = values[0]
+    if instrumentation.enabled:
+        # 以上每个 url、header、post body 字段都查询一次 keyname 缓存
+        instrumentation.metrics.add_cache_lookups('token_key', sum(
+            1 for field in fields if field.location in (LOCATION_URL, LOCATION_HEADER, LOCATION_POST_FORM,
+                                                        LOCATION_POST_MULTIPART, LOCATION_POST_TEXT,
+                                                        LOCATION_POST_JSON)))
+        instrumentation.metrics.incr('keyname_tokens', len(tokens))
 
     return tokens
 
 
+def find_tokens_in_url(url, level=0, enable_stopwords=True):
+    """
+    从 URL 中提取 tokens
+    :param url: 完整的 URL
+    :param level: 检测等级
+    :return: 返回提取到的 tokens 字典
+    """
+
+    return find_tokens_in_fields(extract_url_fields(url), level, enable_stopwords)
+
+
 def find_tokens_in_headers(headers, level=0, enable_stopwords=True):
     """
     从 headers 中提取 tokens
@@ -35,14 +64,7 @@ def find_tokens_in_headers(headers, level=0, enable_stopwords=True):
     :return: 返回提取到的 tokens 字典
     """
 
-    tokens = {}
-
-    for header in headers:
-        if is_token_key(header['name'], level, enable_stopwords):
-            # print(f"key: {header['name']}, value: {header['value']}")
-            tokens[header['name']] = header['value']
-
-    return tokens
+    return find_tokens_in_fields(extract_header_fields(headers), level, enable_stopwords)
 
 
 def find_tokens_in_post_body(post_data, level=0, enable_stopwords=True):
@@ -53,38 +75,5 @@ def find_tokens_in_post_body(post_data, level=0, enable_stopwords=True):
     :return: 返回提取到的 tokens 字典
     """
 
-    tokens = {}
-
-    # 暂先只考虑了从mimeType为 'application/json' , 'application/x-www-form-urlencoded' 的表单数据里找token
-    # 根据 application/json 类型 post data 里的 text 字典里的 key 来判断是否有 token 可能存在
-    if post_data['mimeType'] == 'application/json':
-        # 如果不以 { 或者 [ 开头，则返回
-        # sf_mad.har 有一段 text = 'datalist=...(部分可由base64解码)'，为避免 json.loads受影响用此方法将其过滤，详情见飞书
-        if not (post_data['text'].startswith('[') or post_data['text'].startswith('{')):
-            return tokens
-
-        text_dict = json.loads(post_data['text'])
-
-        # 如果解析出的是列表，并且列表不为空，则取出第一个元素
-        if isinstance(text_dict, list) and len(text_dict) > 0:
-            for t in text_dict:
-                for key, value in t.items():
-                    if is_token_key(key, level, enable_stopwords) and value != '':
-                        tokens[key] = value
-
-        elif isinstance(text_dict, dict):
-            for key, value in text_dict.items():
-                if is_token_key(key, level, enable_stopwords) and value != '':
-                    tokens[key] = value
-
-        else:
-            raise ValueError(f'post_data["text"] is not a dict or a list, but "{type(text_dict)}"')
-
-    # 根据 application/x-www-form-urlencoded 类型 post data 里的
-    # params 里的 name 来判断是否有 token 可能存在
-    elif post_data['mimeType'] == 'application/x-www-form-urlencoded':
-        for param in post_data['params']:
-            if is_token_key(param['name'], level, enable_stopwords):
-                tokens[param['name']] = param['value']
-
-    return tokens
+    # 解析方式见 extract_fields.extract_post_body_fields 和 body_decoders.py
+    return find_tokens_in_fields(extract_post_body_fields(post_data), level, enable_stopwords)
@@ -0,0 +1,134 @@
+import hashlib
+import json
+from multiprocessing import Pool
+
+from global_config import fingerprint_algorithm
+
+# 记录在 har['log'] 中的字段，表示 entry['md5'] 使用的指纹算法
+# 没有该字段的 har（旧的预处理结果）使用的是 md5-full
+fingerprint_field = '_fingerprint'
+legacy_algorithm = 'md5-full'
+
+# 并行计算时每个批次中每个进程分到的 entry 数
+parallel_batch_size = 256
+
+_engines = {}
+
+
+def register_fingerprint(name):
+    """
+    注册指纹算法
+    :param name: 算法名称，会被记录到 har['log']['_fingerprint'] 中
+    被注册的函数接收一个 entry（不含 md5 字段），返回 32 位十六进制字符串
+    """
+
+    def decorator(func):
+        _engines[name] = func
+        return func
+
+    return decorator
+
+
+@register_fingerprint('md5-full')
+def md5_full(entry):
+    """对整个 entry 进行 json 序列化（sort_keys=True）后计算 md5，与最初的预处理结果一致"""
+    entry_str = json.dumps(entry, ensure_ascii=False, sort_keys=True)
+    return hashlib.md5(entry_str.encode()).hexdigest()
+
+
+@register_fingerprint('blake2b-request')
+def blake2b_request(entry):
+    """
+    只对 startedDateTime、time 和 request 进行紧凑的规范化序列化后计算 blake2b（16 字节）
+    跳过了 response 等与检测无关、但往往很大的字段
+    """
+    canonical = [entry.get('startedDateTime'), entry.get('time'), entry['request']]
+    entry_str = json.dumps(canonical, ensure_ascii=False, sort_keys=True,
+                           separators=(',', ':'), check_circular=False)
+    return hashlib.blake2b(entry_str.encode(), digest_size=16).hexdigest()
+
+
+def get_fingerprint_engine(algorithm=None):
+    """
+    :param algorithm: 算法名称，为 None 时使用 global_config.fingerprint_algorithm
+    :return: 指纹函数
+    """
+    algorithm = algorithm or fingerprint_algorithm
+    if algorithm not in _engines:
+        raise ValueError(f'unknown fingerprint algorithm "{algorithm}", available: {list(_engines)}')
+
+    return _engines[algorithm]
+
+
+def get_har_fingerprint_algorithm(log_meta):
+    """返回 har 中记录的指纹算法，log_meta 为 har['log'] 或其中除 entries 外的字段"""
+    return log_meta.get(fingerprint_field, legacy_algorithm)
+
+
+def get_lookup_algorithms(algorithm=None):
+    """
+    按 md5 查找没有 md5 字段（未预处理）的 entry 时依次尝试的指纹算法
+    :param algorithm: har 中记录的算法，为 None 时使用 md5-full
+    :return: (algorithm, md5-full)，algorithm 为 md5-full 时只有一个
+    """
+    algorithm = algorithm or legacy_algorithm
+    if algorithm == legacy_algorithm:
+        return algorithm,
+
+    return algorithm, legacy_algorithm
+
+
+def compute_fingerprint(entry, algorithm=None):
+    """计算 entry 的指纹，entry 中已有的 md5 字段不参与计算"""
+    if 'md5' in entry:
+        entry = {k: v for k, v in entry.items() if k != 'md5'}
+
+    return get_fingerprint_engine(algorithm)(entry)
+
+
+def _fingerprint_batch(args):
+    algorithm, entries = args
+    engine = get_fingerprint_engine(algorithm)
+    return [engine(entry) for entry in entries]
+
+
+def iter_entries_with_fingerprint(entries, algorithm=None, workers=1):
+    """
+    为每个 entry 计算指纹并写入 entry['md5']
+    :param entries: entry 的迭代器
+    :param algorithm: 指纹算法，为 None 时使用 global_config.fingerprint_algorithm
+    :param workers: 进程数，大于 1 时分批并行计算，每批最多 workers * parallel_batch_size 个 entry
+        entry 需要序列化后传给子进程，md5-full 这类需要序列化整个 entry 的算法收益更明显
+    :return: entry 的迭代器
+    """
+    engine = get_fingerprint_engine(algorithm)
+    algorithm = algorithm or fingerprint_algorithm
+
+    if workers <= 1:
+        for entry in entries:
+            entry.pop('md5', None)
+            entry['md5'] = engine(entry)
+            yield entry
+        return
+
+    with Pool(workers) as pool:
+        batch = []
+        for entry in entries:
+            entry.pop('md5', None)
+            batch.append(entry)
+            if len(batch) >= workers * parallel_batch_size:
+                yield from _apply_batch(pool, algorithm, batch, workers)
+                batch = []
+
+        if batch:
+            yield from _apply_batch(pool, algorithm, batch, workers)
+
+
+def _apply_batch(pool, algorithm, batch, workers):
+    chunk_size = (len(batch) + workers - 1) // workers
+    chunks = [(algorithm, batch[i:i + chunk_size]) for i in range(0, len(batch), chunk_size)]
+    fingerprints = [fp for res in pool.map(_fingerprint_batch, chunks) for fp in res]
+
+    for entry, fp in zip(batch, fingerprints):
+        entry['md5'] = fp
+        yield entry
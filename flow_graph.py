@@ -0,0 +1,361 @@
+import argparse
+import csv
+import heapq
+import json
+import sys
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+import instrumentation
+from detect_cross_domain import get_domain
+from extract_fields import extract_fields
+from get_values import get_values_from_fields
+from global_config import min_token_len, bold_split, thin_split
+from har_reader import iter_har_entries
+
+# token 流向图中的一条边：value 第一次出现在 dst 域名时，它最近一次出现在 src 域名
+#   src / dst: 域名（同 group_by_domain 的分组依据）
+#   count: 经过这条边第一次到达 dst 的不同 value 个数
+#   first_seen: 第一次经过这条边的请求时间（unix 时间戳，秒）
+#   sample_value: 第一次经过这条边的 value
+FlowEdge = namedtuple('FlowEdge', ['src', 'dst', 'count', 'first_seen', 'sample_value'])
+
+
+def parse_started_time(started_date_time):
+    """
+    :param started_date_time: entry['startedDateTime']，ISO 8601，例如 2024-08-10T12:00:00.123Z
+    :return: unix 时间戳（秒），无法解析时返回 None
+    """
+    if not started_date_time:
+        return None
+
+    if started_date_time.endswith('Z'):
+        started_date_time = started_date_time[:-1] + '+00:00'
+    try:
+        dt = datetime.fromisoformat(started_date_time)
+    except ValueError:
+        return None
+
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def format_time(timestamp):
+    """unix 时间戳 -> ISO 8601（UTC）"""
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def iter_timed_entries(entries):
+    """
+    :param entries: entry 的可迭代对象
+    :return: (时间戳, 序号, entry) 的迭代器，没有 startedDateTime（如较早生成的 .harc 缓存）或无法解析时使用上一个 entry 的时间
+    """
+    timestamp = 0.0
+    for seq, entry in enumerate(entries):
+        parsed = parse_started_time(entry.get('startedDateTime'))
+        if parsed is not None:
+            timestamp = parsed
+        yield timestamp, seq, entry
+
+
+def iter_sorted_entries(entries, window=None):
+    """
+    按请求时间排序 entries，时间相同时保持原来的顺序
+    :param entries: entry 的可迭代对象
+    :param window: 为 None 时读取全部 entry 后排序；
+        否则使用大小为 window 的缓冲区（堆），适用于基本有序（浏览器导出的 har 大多按时间排列）的大文件，
+        内存占用与 window 成正比，乱序距离超过 window 的 entry 按读取的顺序输出
+    :return: (时间戳, 序号, entry) 的迭代器
+    """
+    timed = iter_timed_entries(entries)
+    if window is None:
+        # 序号唯一，排序不会比较 entry
+        yield from sorted(timed, key=lambda item: item[:2])
+        return
+
+    heap = []
+    for item in timed:
+        if len(heap) < window:
+            heapq.heappush(heap, (item[0], item[1], item))
+        else:
+            yield heapq.heappushpop(heap, (item[0], item[1], item))[2]
+
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def iter_corpus_entries(har_paths, window=None):
+    """
+    将多个抓包的 entries 按请求时间合并为一个有序的流，每个文件分别排序后通过 heapq.merge 归并
+    :return: (时间戳, 文件序号, entry) 的迭代器
+    """
+    streams = [((timestamp, file_id, seq, entry) for timestamp, seq, entry in
+                iter_sorted_entries(iter_har_entries(har_path), window=window))
+               for file_id, har_path in enumerate(har_paths)]
+
+    for timestamp, file_id, _, entry in heapq.merge(*streams, key=lambda item: item[:3]):
+        yield timestamp, file_id, entry
+
+
+class TokenFlowGraph:
+    """
+    token 在域名之间的流向图，按请求时间顺序逐个处理 entry，一次遍历增量构建：
+    - 节点：域名（同 group_by_domain 的分组依据），记录第一个请求的完整域名、第一次出现的时间和请求数
+    - 边：value 第一次出现在某个域名时，从它最近一次出现的域名连一条边到这个域名，
+      记录经过这条边的不同 value 个数、第一次经过的时间和第一个 value
+    每个 value 只保存它出现过的域名 id（按第一次出现的顺序，第一个即来源域名），边的属性按列存在 array 中，
+    邻接关系可以导出为 CSR（to_csr），适用于多个抓包合并的大规模数据
+    """
+
+    def __init__(self, level=2, use_psl=False, enable_stopwords=1, min_len=min_token_len):
+        """
+        :param level: 域名级别，同 group_by_domain
+        :param use_psl: 同 group_by_domain
+        :param enable_stopwords: 同 find_tokens_by_compare
+        :param min_len: 最小 token 长度
+        """
+        self.level = level
+        self.use_psl = use_psl
+        self.enable_stopwords = enable_stopwords
+        self.min_len = min_len
+
+        self.entry_count = 0
+        self.capture_count = 0
+
+        # 节点：域名 -> id，按 id 排列的域名、第一个请求的完整域名、第一次出现的时间、请求数
+        self._domain_index = {}
+        self.domains = []
+        self.netlocs = []
+        self.node_first_seen = array('d')
+        self.node_requests = array('I')
+        # netloc -> 节点 id，每个 netloc 只计算一次域名
+        self._netloc_ids = {}
+
+        # 边：(src id << 32 | dst id) -> 边 id，按 id 排列的各列
+        self._edge_index = {}
+        self.edge_src = array('I')
+        self.edge_dst = array('I')
+        self.edge_counts = array('I')
+        self.edge_first_seen = array('d')
+        self.edge_samples = []
+
+        # value -> 节点 id（只出现在一个域名中）或 [最近一次出现的节点 id, 按第一次出现的顺序排列的节点 id...]
+        self._values = {}
+
+    def __len__(self):
+        """边数"""
+        return len(self.edge_src)
+
+    @property
+    def node_count(self):
+        return len(self.domains)
+
+    def _get_node(self, url, timestamp):
+        netloc = urlparse(url).netloc
+        node = self._netloc_ids.get(netloc)
+        if node is None:
+            domain = get_domain(url, domain_level=self.level, use_psl=self.use_psl)
+            node = self._domain_index.get(domain)
+            if node is None:
+                node = self._domain_index[domain] = len(self.domains)
+                self.domains.append(domain)
+                self.netlocs.append(netloc)
+                self.node_first_seen.append(timestamp)
+                self.node_requests.append(0)
+            self._netloc_ids[netloc] = node
+
+        self.node_requests[node] += 1
+        return node
+
+    def _add_edge(self, src, dst, timestamp, value):
+        key = src << 32 | dst
+        edge = self._edge_index.get(key)
+        if edge is None:
+            self._edge_index[key] = len(self.edge_src)
+            self.edge_src.append(src)
+            self.edge_dst.append(dst)
+            self.edge_counts.append(1)
+            self.edge_first_seen.append(timestamp)
+            self.edge_samples.append(value)
+        else:
+            self.edge_counts[edge] += 1
+
+    def add_entry(self, entry, timestamp, fields=None):
+        """
+        处理一个 entry，调用方需要按 timestamp 从小到大的顺序添加（见 iter_sorted_entries）
+        :param timestamp: 请求时间（unix 时间戳，秒）
+        :param fields: extract_fields(entry) 的结果，已经解析过时传入，避免重复解析
+        """
+        self.entry_count += 1
+        node = self._get_node(entry['request']['url'], timestamp)
+
+        if fields is None:
+            fields = extract_fields(entry)
+
+        states = self._values
+        for value in get_values_from_fields(fields, enable_stopwords=self.enable_stopwords, min_len=self.min_len):
+            state = states.get(value)
+            if state is None:
+                states[sys.intern(value)] = node
+            elif state.__class__ is int:
+                if state != node:
+                    self._add_edge(state, node, timestamp, value)
+                    states[value] = [node, state, node]
+            elif node != state[0]:
+                # value 出现过的域名通常只有几个，列表比 set 更紧凑
+                if node not in state[1:]:
+                    self._add_edge(state[0], node, timestamp, value)
+                    state.append(node)
+                state[0] = node
+
+    def feed(self, timed_entries):
+        """
+        :param timed_entries: (时间戳, ..., entry) 的迭代器，例如 iter_sorted_entries、iter_corpus_entries 的结果
+        :return: self
+        """
+        sw = instrumentation.stopwatch()
+        n_entries = self.entry_count
+        for item in timed_entries:
+            self.add_entry(item[-1], item[0])
+
+        if sw:
+            sw.lap('flow_graph')
+            instrumentation.metrics.incr('flow_entries', self.entry_count - n_entries)
+
+        return self
+
+    def end_capture(self):
+        """一个抓包处理完毕，清空 value 的状态（节点和边保留），之后的抓包中再次出现的 value 视为新的 value"""
+        self._values = {}
+        self.capture_count += 1
+
+    def get_origin(self, value):
+        """:return: 第一次出现 value 的域名（本抓包中），没有出现过时返回 None"""
+        state = self._values.get(value)
+        if state is None:
+            return None
+
+        return self.domains[state if state.__class__ is int else state[1]]
+
+    def get_path(self, value):
+        """:return: value 出现过的域名列表，按第一次出现的顺序（本抓包中）"""
+        state = self._values.get(value)
+        if state is None:
+            return []
+
+        return [self.domains[state]] if state.__class__ is int else [self.domains[node] for node in state[1:]]
+
+    def get_edge(self, edge):
+        return FlowEdge(self.domains[self.edge_src[edge]], self.domains[self.edge_dst[edge]], self.edge_counts[edge],
+                        self.edge_first_seen[edge], self.edge_samples[edge])
+
+    def get_edges(self):
+        """:return: FlowEdge 列表，按第一次经过的时间排列"""
+        return [self.get_edge(edge) for edge in range(len(self))]
+
+    def to_csr(self):
+        """
+        邻接关系的 CSR 表示
+        :return: (indptr, dst, edge_ids)，节点 i 的出边为 dst[indptr[i]:indptr[i + 1]]，对应的边 id 为 edge_ids 中的同一段
+        """
+        edge_ids = array('I', sorted(range(len(self)), key=self.edge_src.__getitem__))
+        sorted_src = array('I', map(self.edge_src.__getitem__, edge_ids))
+        indptr = array('I', (bisect_left(sorted_src, node) for node in range(self.node_count + 1)))
+
+        return indptr, array('I', map(self.edge_dst.__getitem__, edge_ids)), edge_ids
+
+    def successors(self, domain):
+        """:return: 从 domain 流出的边（FlowEdge 列表），按第一次经过的时间排列"""
+        node = self._domain_index.get(domain)
+        if node is None:
+            return []
+
+        return [self.get_edge(edge) for edge in range(len(self)) if self.edge_src[edge] == node]
+
+    def to_dict(self):
+        """:return: 可以直接保存为 json 的图"""
+        return {
+            'level': self.level,
+            'use_psl': self.use_psl,
+            'entry_count': self.entry_count,
+            'capture_count': self.capture_count,
+            'nodes': [{'id': node, 'domain': domain, 'netloc': self.netlocs[node],
+                       'first_seen': format_time(self.node_first_seen[node]), 'requests': self.node_requests[node]}
+                      for node, domain in enumerate(self.domains)],
+            'edges': [{'src': self.edge_src[edge], 'dst': self.edge_dst[edge], 'count': self.edge_counts[edge],
+                       'first_seen': format_time(self.edge_first_seen[edge]), 'sample_value': self.edge_samples[edge]}
+                      for edge in range(len(self))],
+        }
+
+    def save_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+
+    def save_edges_csv(self, path):
+        """每条边一行：src, dst, count, first_seen, sample_value，src / dst 为完整的域名"""
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(FlowEdge._fields)
+            writer.writerows((self.domains[src], self.domains[dst], n, format_time(first_seen), sample)
+                             for src, dst, n, first_seen, sample in
+                             zip(self.edge_src, self.edge_dst, self.edge_counts, self.edge_first_seen,
+                                 self.edge_samples))
+
+
+def build_flow_graph(har_paths, level=2, use_psl=False, enable_stopwords=1, window=None, merge_captures=False):
+    """
+    构建多个抓包的 token 流向图
+    :param har_paths: har 文件路径（或 har 字典、entry 的迭代器）列表
+    :param window: 同 iter_sorted_entries
+    :param merge_captures: 为 True 时把所有抓包按时间合并为一个流，不同抓包中相同的 value 视为同一个 token；
+        否则逐个抓包处理，每个抓包结束后清空 value 的状态，只累计节点和边
+    :return: TokenFlowGraph
+    """
+    graph = TokenFlowGraph(level=level, use_psl=use_psl, enable_stopwords=enable_stopwords)
+    if merge_captures:
+        graph.feed(iter_corpus_entries(har_paths, window=window))
+        graph.end_capture()
+    else:
+        for har_path in har_paths:
+            graph.feed(iter_sorted_entries(iter_har_entries(har_path), window=window))
+            graph.end_capture()
+
+    return graph
+
+
+def print_flow_graph(graph):
+    for edge in graph.get_edges():
+        print(f"{edge.src} -> {edge.dst}\n"
+              f"first seen: {format_time(edge.first_seen)}, values: {edge.count}, sample: {edge.sample_value}\n"
+              f"{thin_split}")
+
+    print(f"{graph.node_count} domains, {len(graph)} edges, {graph.entry_count} entries\n{bold_split}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='token 在域名之间的流向图')
+    parser.add_argument('har_files', nargs='+', help='har 文件路径')
+    parser.add_argument('--level', type=int, default=2, help='域名级别，同 group_by_domain')
+    parser.add_argument('--psl', action='store_true', help='按公共后缀列表计算可注册域名')
+    parser.add_argument('--stopwords', type=int, default=1, choices=[0, 1, 2], help='停用词过滤模式')
+    parser.add_argument('--window', type=int, default=None, help='排序缓冲区大小，不指定时读取整个文件后排序')
+    parser.add_argument('--merge-captures', action='store_true', help='把所有抓包按时间合并为一个流')
+    parser.add_argument('-o', '--output', default=None, help='图的输出路径（json）')
+    parser.add_argument('--csv', default=None, help='边的输出路径（csv）')
+    args = parser.parse_args()
+
+    flow_graph = build_flow_graph(args.har_files, level=args.level, use_psl=args.psl,
+                                  enable_stopwords=args.stopwords, window=args.window,
+                                  merge_captures=args.merge_captures)
+    print_flow_graph(flow_graph)
+
+    if args.output:
+        flow_graph.save_json(args.output)
+        print(f'graph saved to |{args.output}|')
+    if args.csv:
+        flow_graph.save_edges_csv(args.csv)
+        print(f'edges saved to |{args.csv}|')
@@ -1,76 +1,97 @@
-import json
-from urllib.parse import urlparse, parse_qs
+import instrumentation
+from extract_fields import Field, extract_fields, extract_url_fields, extract_header_fields, extract_cookie_fields, \
+    extract_post_body_fields, LOCATION_HEADER, LOCATION_COOKIE, LOCATION_POST_JSON, LOCATION_POST_FORM, \
+    LOCATION_POST_MULTIPART, LOCATION_POST_TEXT
+from global_config import min_token_len, perfect_match_post_body_fields
+from key_matcher import stop_word_filter
 
-from global_config import stop_words_key, min_token_len
+is_stop_word = stop_word_filter.is_stop_word
 
+# 这些位置中的 key name 在启用过滤时始终使用完美匹配，见 global_config.perfect_match_post_body_fields
+perfect_match_locations = (LOCATION_COOKIE, LOCATION_POST_FORM)
+if perfect_match_post_body_fields:
+    perfect_match_locations += (LOCATION_POST_MULTIPART, LOCATION_POST_TEXT)
 
-def get_values_from_entry(entry, enable_stopwords=1, min_len=min_token_len):
+
+def get_values_from_entry(entry, enable_stopwords=1, min_len=min_token_len, fields=None):
     """
     从 entry 中提取 values
     :param min_len: 最小 token 长度
     :param entry: entry 字典
     :param enable_stopwords: 是否启用过滤, 0: 不启用, 1: 启用（key name 完美匹配）, 2: 启用（key name 中包含其一）
+    :param fields: extract_fields(entry) 的结果，已经解析过时传入，避免重复解析
     :return: 返回提取到的 values 列表
     """
 
-    values_url = get_values_from_url(entry['request']['url'],
-                                     enable_stopwords=enable_stopwords,
-                                     min_len=min_len)
+    if fields is None:
+        fields = extract_fields(entry)
 
-    values_headers = get_values_from_headers(entry['request']['headers'],
-                                             enable_stopwords=enable_stopwords,
-                                             min_len=min_len)
+    return get_values_from_fields(fields, enable_stopwords=enable_stopwords, min_len=min_len)
 
-    values_cookies = get_values_from_cookies(entry['request']['cookies'],
-                                             enable_stopwords=enable_stopwords,
-                                             min_len=min_len)
 
-    values_post_body = get_values_from_post_body(entry['request']['postData'],
-                                                 enable_stopwords=enable_stopwords,
-                                                 min_len=min_len)
+def get_values_from_fields(fields, enable_stopwords=1, min_len=min_token_len):
+    """
+    从 extract_fields 解析出的字段中提取 values
+    :param fields: Field 列表
+    :param enable_stopwords: 同 get_values_from_entry
+        注意 cookies 列表和表单类 post body（x-www-form-urlencoded、multipart、key=value 文本）中的 key name
+        在启用过滤时始终使用完美匹配，见 perfect_match_locations
+    :param min_len: 最小 token 长度
+    :return: 返回提取到的 values 列表（去重）
+    """
 
-    # try:
-    #     values_cookies = get_values_from_cookies(entry['request']['cookies'], enable_stopwords)
-    # except ValueError as e:
-    #     print(f"error: {e}")
-    #     print(f"entry: {json.dumps(entry, ensure_ascii=False, sort_keys=True, indent=2)}")
+    values = list(set(field.value for field in iter_value_fields(fields, enable_stopwords, min_len)))
+    if instrumentation.enabled:
+        instrumentation.metrics.incr('fields', len(fields))
+        instrumentation.metrics.incr('values', len(values))
 
-    return list(set(values_url + values_headers + values_cookies + values_post_body))
+    return values
 
 
-def get_values_from_headers(headers, enable_stopwords=1, min_len=min_token_len):
+def iter_value_fields(fields, enable_stopwords=1, min_len=min_token_len):
     """
-    从 headers 中提取 values
-    :param min_len: 最小 token 长度
-    :param headers: headers 字典
-    :param enable_stopwords: 是否启用过滤
-    :return: 返回提取到的 values 列表
+    过滤规则同 get_values_from_fields，但保留每个 value 所在的位置和 key name（不去重）
+    :return: Field 的迭代器，value 已转为字符串
     """
 
-    values = []
+    if instrumentation.enabled and enable_stopwords in (1, 2):
+        # 启用过滤时每个字段查询一次停用词缓存，cookies 列表和表单中 key name 为空的字段除外
+        instrumentation.metrics.add_cache_lookups('stop_word', sum(
+            1 for location, key, _ in fields if key or location not in perfect_match_locations))
 
-    for header_item in headers:
-        # print(f"debug: header_item: {header_item}")
-        if enable_stopwords == 1 and header_item['name'].lower() in stop_words_key:
-            continue
-        if enable_stopwords == 2 and any(key_name in header_item['name'].lower() for key_name in stop_words_key):
+    for location, key, value in fields:
+        if location in perfect_match_locations:
+            if enable_stopwords and key and is_stop_word(key, 1):
+                continue
+        elif is_stop_word(key, enable_stopwords):
             continue
 
-        if header_item['name'].lower() == 'cookie':
+        if location == LOCATION_HEADER and key.lower() == 'cookie':
             # cookie 以字符串形式重复出现在 headers 中
             # 已经在 entry['request']['cookies'] 中提取过了
-            # values.extend(get_values_from_cookies(header_item['value'], enable_stopwords))
             continue
 
-        if len(header_item['value']) < min_len:
+        if location in (LOCATION_POST_JSON, LOCATION_POST_FORM):
+            value = str(value)
+
+        if len(value) < min_len:
             continue
 
-        # if header_item['value'].find('iPhone10,3') != -1:
-        #     print(f'debug: key: {header_item["name"]}, value: {header_item["value"]}')
+        yield Field(location, key, value)
 
-        values.append(header_item['value'])
 
-    return values
+def get_values_from_headers(headers, enable_stopwords=1, min_len=min_token_len):
+    """
+    从 headers 中提取 values
+    :param min_len: 最小 token 长度
+    :param headers: headers 字典
+    :param enable_stopwords: 是否启用过滤
+    :return: 返回提取到的 values 列表
+    """
+
+    return get_values_from_fields(extract_header_fields(headers),
+                                  enable_stopwords=enable_stopwords,
+                                  min_len=min_len)
 
 
 def get_values_from_cookies(cookies, enable_stopwords=1, min_len=min_token_len):
@@ -82,40 +103,9 @@ def get_values_from_cookies(cookies, enable_stopwords=1, min_len=min_token_len):
     :return: 返回提取到的 values 列表
     """
 
-    values = []
-
-    if not cookies:
-        return values
-
-    if isinstance(cookies, str):  # http header 中的 cookie 字符串，位于 entry['request']['headers'] 中的 cookie 字段
-        cookie_list = [c.strip() for c in cookies.split(';')]
-
-        for cookie in cookie_list:
-            cookie_key, cookie_value = cookie.split('=', maxsplit=1)
-
-            if enable_stopwords == 1 and cookie_key.lower() in stop_words_key:
-                continue
-            if enable_stopwords == 2 and any(key_name in cookie_key.lower() for key_name in stop_words_key):
-                continue
-
-            if len(cookie_value) < min_len:
-                continue
-
-            values.append(cookie_value)
-
-    elif isinstance(cookies, list):  # cookies 列表，位于 entry['request']['cookies']
-        for cookie in cookies:
-            if enable_stopwords and cookie['name'].lower() in stop_words_key:
-                continue
-            if len(cookie['value']) < min_len:
-                continue
-
-            values.append(cookie['value'])
-
-    else:
-        raise ValueError('cookies is not a string or list')
-
-    return list(set(values))
+    return get_values_from_fields(extract_cookie_fields(cookies),
+                                  enable_stopwords=enable_stopwords,
+                                  min_len=min_len)
 
 
 def get_values_from_url(url, enable_stopwords=1, min_len=min_token_len):
@@ -127,28 +117,9 @@ def get_values_from_url(url, enable_stopwords=1, min_len=min_token_len):
     :return: 返回提取到的 values 列表
     """
 
-    res_values = []
-
-    query = urlparse(url).query
-    params = parse_qs(query)
-
-    for key, values in params.items():
-        if enable_stopwords == 1 and key.lower() in stop_words_key:
-            continue
-        elif enable_stopwords == 2 and any(key_name in key.lower() for key_name in stop_words_key):
-            continue
-
-        for value in values:
-            if len(value) < min_len:
-                continue
-
-            # for debug
-            # if value.find('com.tencent.xin') != -1:
-            #     print(f'key: {key}, value: {values}')
-
-            res_values.append(value)
-
-    return list(set(res_values))
+    return get_values_from_fields(extract_url_fields(url),
+                                  enable_stopwords=enable_stopwords,
+                                  min_len=min_len)
 
 
 def get_values_from_post_body(post_data, enable_stopwords=1, min_len=min_token_len):
@@ -160,52 +131,6 @@ def get_values_from_post_body(post_data, enable_stopwords=1, min_len=min_token_l
     :return: 返回提取到的 values 列表
     """
 
-    values = []
-
-    if post_data['mimeType'] == 'application/json':
-        if not (post_data['text'].startswith('[') or post_data['text'].startswith('{')):
-            return values
-
-        post_data_text = json.loads(post_data['text'])
-        if isinstance(post_data_text, dict):
-            for key, value in post_data_text.items():
-                if enable_stopwords == 1 and key.lower() in stop_words_key:
-                    continue
-                if enable_stopwords == 2 and any(key_name in key.lower() for key_name in stop_words_key):
-                    continue
-
-                if len(str(value)) < min_len:
-                    continue
-
-                values.append(str(value))
-
-        elif isinstance(post_data_text, list):
-            for list_item in post_data_text:
-                if isinstance(list_item, dict):
-                    for key, value in list_item.items():
-                        if enable_stopwords == 1 and key.lower() in stop_words_key:
-                            continue
-                        if enable_stopwords == 2 and any(key_name in key.lower() for key_name in stop_words_key):
-                            continue
-
-                        if len(str(value)) < min_len:
-                            continue
-
-                        values.append(str(value))
-                else:
-                    raise ValueError(f'list_item is not a dict, but {type(list_item)}')
-
-        else:
-            raise ValueError(f'post_data_text is not a dict or list, but {type(post_data_text)}')
-
-    elif post_data['mimeType'] == 'application/x-www-form-urlencoded':
-        for param in post_data['params']:
-            if enable_stopwords and param['name'] and param['name'].lower() in stop_words_key:
-                continue
-
-            if len(str(param['value'])) < min_len:
-                continue
-
-            values.append(str(param['value']))
-
-    return list(set(values))
+    return get_values_from_fields(extract_post_body_fields(post_data),
+                                  enable_stopwords=enable_stopwords,
+                                  min_len=min_len)
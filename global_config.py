@@ -14,11 +14,48 @@ stop_words_key = list({s.lower() for s in (['accept-encoding', 'connection', 'co
                                             'Proxy-Connection', 'Connection', 'app_ver', 'version'] +
                                            stop_words_key_wait_list)})
 
+# 启用停用词过滤时，cookie 和表单字段的 key name 始终使用完美匹配（见 get_values.perfect_match_locations）
+# multipart 和 key=value 文本中的字段与表单字段相同，也使用完美匹配；
+# 这会改变包含这两种 post body 的抓包的 compare 结果（之前按 enable_stopwords 的模式匹配），设为 False 时恢复之前的结果
+perfect_match_post_body_fields = True
+
 # stop_words_value = list({s.lower() for s in [' ', '\%']}) # 进一步过滤掉不符合token条件的value
 
 # 提取的 token value 的最小长度
 min_token_len = 8
 
+# post body 中 json 的遍历限制，见 body_decoders.iter_json_leaves
+json_max_depth = 8  # 最多展开的嵌套层数，更深的部分跳过
+json_max_nodes = 10000  # 最多访问的节点数，超过后停止遍历
+json_max_str_len = 8192  # 超过该长度的字符串不作为 value（通常是内嵌的文件、图片等）
+json_max_body_size = 16 << 20  # 超过该大小（字符数）的 json body 不解析
+
+# post body 解码器的限制，见 body_decoders.py
+body_decoder_max_bytes = 1 << 20  # 默认每个解码器处理的 body 的最大长度（字符数），超过时跳过该解码器
+body_decoder_max_nesting = 2  # base64、压缩数据解码之后再次解码的最大层数
+body_decompress_max_size = 4 << 20  # 解压 gzip / deflate 时最多输出的字节数
+base64_min_len = 24  # 尝试作为 base64 解码的 value 的最小长度（还需要带填充的长度是 4 的倍数，且不是十六进制字符串）
+
+# 响应 body 的解析，见 extract_fields.extract_response_fields
+response_body_mime_types = ['application/json', 'text/json', 'text/plain', 'application/x-www-form-urlencoded']
+response_body_max_size = 1 << 20  # 超过该大小的响应 body 不解析
+# 响应头的停用词，这些响应头中的 value（时间、缓存校验值、服务器信息等）不作为下发的 token，
+# 启用过滤时始终使用完美匹配（其中 age、date 等较短的词包含匹配时容易误伤）
+stop_words_response_key = list({s.lower() for s in ['date', 'expires', 'last-modified', 'etag', 'server', 'age',
+                                                    'vary', 'via', 'content-type', 'content-length',
+                                                    'content-encoding', 'transfer-encoding', 'connection',
+                                                    'keep-alive', 'cache-control', 'pragma', 'accept-ranges',
+                                                    'strict-transport-security', 'x-content-type-options',
+                                                    'x-frame-options', 'x-xss-protection',
+                                                    'access-control-allow-origin', 'access-control-allow-headers',
+                                                    'access-control-allow-methods', 'access-control-expose-headers',
+                                                    'access-control-max-age', 'x-powered-by']})
+
+# 预处理时 entry 指纹（entry['md5']）使用的算法，见 fingerprint.py，会记录在 har['log']['_fingerprint'] 中
+#   md5-full: 整个 entry 序列化后计算 md5（旧的预处理结果、未预处理的 har 使用此算法）
+#   blake2b-request: 只对 startedDateTime 和 request 计算 blake2b，速度更快，需要手动启用，启用后 md5 与之前的结果不同
+fingerprint_algorithm = 'md5-full'
+
 # 主机名屏蔽列表
 hostname_blacklist = ['localhost', '127.0.0.1', '0.0.0.0']
 
@@ -0,0 +1,180 @@
+import json
+import mmap
+import os
+import struct
+from array import array
+
+from base import get_md5_from_entry
+
+# har 缓存文件（.harc）格式，只保存检测用到的请求侧字段，可以直接 mmap 后按需解码单个 entry
+#
+# |header      magic(8) + entry 数量 + 各区段的偏移（见 _header_struct）
+# |records     每个 entry 一条紧凑 json: {"md5", "startedDateTime", "request": {"url", "headers", "cookies", "postData"}}
+# |md5 table   每个 entry 的 md5，16 字节二进制
+# |offsets     每条 record 在文件中的起始偏移（uint64），共 count + 1 个，最后一个为 records 区段的结尾
+# |meta        har['log'] 中除 entries 以外的字段（json）
+
+# 最后一个字节为格式版本，records 中的字段变化时递增，旧版本的缓存不再使用
+# 版本 2: records 中加入 startedDateTime
+cache_magic = b'HARC\x00\x00\x00\x02'
+cache_suffix = '.harc'
+
+# magic, count, md5_table_offset, offsets_offset, meta_offset, meta_length
+_header_struct = struct.Struct('<8sQQQQQ')
+
+# 缓存中保存的 request 字段
+cached_request_fields = ('url', 'headers', 'cookies', 'postData')
+
+
+def get_cache_path(har_path):
+    """返回 har 文件对应的缓存文件路径，例如 xxx_md5.har -> xxx_md5.harc"""
+    if har_path.endswith(cache_suffix):
+        return har_path
+
+    return os.path.splitext(har_path)[0] + cache_suffix
+
+
+def find_valid_cache(har_path):
+    """
+    查找 har 文件对应的、可用的缓存文件
+    :return: 缓存文件存在、格式版本与当前一致且不比 har 文件旧时返回其路径，否则返回 None
+    """
+    cache_path = get_cache_path(har_path)
+    if not os.path.exists(cache_path):
+        return None
+
+    if cache_path != har_path and os.path.exists(har_path) \
+            and os.path.getmtime(cache_path) < os.path.getmtime(har_path):
+        return None
+
+    with open(cache_path, 'rb') as f:
+        if f.read(len(cache_magic)) != cache_magic:
+            return None
+
+    return cache_path
+
+
+def slim_entry(entry):
+    """只保留检测用到的请求侧字段、md5 和请求时间（token 流向图按时间排序）"""
+    request = entry['request']
+    record = {'md5': get_md5_from_entry(entry)}
+    if 'startedDateTime' in entry:
+        record['startedDateTime'] = entry['startedDateTime']
+    record['request'] = {k: request[k] for k in cached_request_fields if k in request}
+
+    return record
+
+
+def write_har_cache(entries, cache_path, log_meta=None):
+    """
+    将 entries 写入缓存文件，先写入临时文件再重命名，中途中断不会留下损坏的缓存
+    :param entries: entry 的迭代器，没有 md5 的 entry 会自动计算
+    :param cache_path: 缓存文件路径
+    :param log_meta: har['log'] 中除 entries 以外的字段
+    :return: 写入的 entry 数量
+    """
+    offsets = array('Q')
+    md5_table = bytearray()
+
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(b'\x00' * _header_struct.size)
+
+        for entry in entries:
+            record = slim_entry(entry)
+            offsets.append(f.tell())
+            md5_table += bytes.fromhex(record['md5'])
+            f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode())
+
+        offsets.append(f.tell())
+        md5_table_offset = f.tell()
+        f.write(md5_table)
+
+        offsets_offset = f.tell()
+        f.write(offsets.tobytes())
+
+        meta = json.dumps(log_meta or {}, ensure_ascii=False, separators=(',', ':')).encode()
+        meta_offset = f.tell()
+        f.write(meta)
+
+        f.seek(0)
+        f.write(_header_struct.pack(cache_magic, len(offsets) - 1,
+                                    md5_table_offset, offsets_offset, meta_offset, len(meta)))
+
+    os.replace(tmp_path, cache_path)
+
+    return len(offsets) - 1
+
+
+class HarCache:
+    """
+    只读的 har 缓存文件，使用 mmap 打开，按需解码单个 entry
+    """
+
+    def __init__(self, cache_path):
+        self.har_path = cache_path
+        with open(cache_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count, md5_table_offset, offsets_offset, meta_offset, meta_length = \
+            _header_struct.unpack_from(self._mm, 0)
+        if magic != cache_magic:
+            self._mm.close()
+            raise ValueError(f'"{cache_path}" is not a valid har cache file or was written by an older version, '
+                             f'regenerate it with pre_process.py')
+
+        self._count = count
+        self._md5_table_offset = md5_table_offset
+        self._offsets = array('Q')
+        self._offsets.frombytes(self._mm[offsets_offset:offsets_offset + (count + 1) * 8])
+        self.log_meta = json.loads(self._mm[meta_offset:meta_offset + meta_length])
+        self._md5_to_pos = None
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def get_md5(self, i):
+        start = self._md5_table_offset + i * 16
+        return self._mm[start:start + 16].hex()
+
+    def get_entry_at(self, i):
+        """返回第 i 个 entry"""
+        return json.loads(self._mm[self._offsets[i]:self._offsets[i + 1]])
+
+    def iter_entries(self):
+        for i in range(self._count):
+            yield self.get_entry_at(i)
+
+    def __iter__(self):
+        return self.iter_entries()
+
+    def get_entry(self, md5):
+        """通过 md5 获取 entry，找不到返回 None；第一次调用时会根据 md5 表建立索引"""
+        if self._md5_to_pos is None:
+            md5_to_pos = {}
+            table = self._mm[self._md5_table_offset:self._md5_table_offset + self._count * 16]
+            for i in range(self._count):
+                md5_to_pos.setdefault(table[i * 16:(i + 1) * 16], i)
+            self._md5_to_pos = md5_to_pos
+
+        try:
+            pos = self._md5_to_pos.get(bytes.fromhex(md5))
+        except ValueError:
+            return None
+
+        return None if pos is None else self.get_entry_at(pos)
+
+
+def iter_cache_entries(cache_path):
+    """遍历缓存文件中的 entries，遍历结束后关闭文件"""
+    with HarCache(cache_path) as cache:
+        yield from cache.iter_entries()
@@ -0,0 +1,160 @@
+import os
+
+from base import get_md5_from_entry
+from fingerprint import compute_fingerprint, get_har_fingerprint_algorithm, get_lookup_algorithms
+from har_cache import HarCache, find_valid_cache, cache_suffix
+from har_reader import HarEntryReader, iter_har_entries, read_entry_at
+
+
+class EntryIndex:
+    """
+    单个 har 的 entry 索引，只遍历一次 entries 构建
+    md5 -> entry（或 entry 在文件中的位置）和 url，
+    用于替代对 har['log']['entries'] 的反复线性查找（get_entry_by_md5）
+    """
+
+    def __init__(self, har=None, har_path=None, keep_entries=True, algorithm=None):
+        """
+        :param har: har 文件路径、har 字典或 entry 的迭代器，为 None 时创建空索引，之后通过 add 添加
+        :param har_path: har 文件路径（可选，仅用于打印）
+        :param keep_entries: 是否保留 entry 本身，为 False 时只保留 url 等信息以节省内存；
+            har 为文件路径时会记录每个 entry 的位置（.har 中的字节偏移，或 .harc 缓存中的 md5 表），get_entry 时按需读取
+        :param algorithm: entry 没有 md5 时使用的指纹算法，为 None 时使用 har 字典中记录的算法（见 base.get_md5_from_entry）
+        """
+        if har_path is None and isinstance(har, str):
+            har_path = har
+        if algorithm is None and isinstance(har, dict):
+            algorithm = get_har_fingerprint_algorithm(har['log'])
+
+        self.har_path = har_path
+        self.keep_entries = keep_entries
+        self._lookup_algorithms = get_lookup_algorithms(algorithm)
+        self._entry_list = []
+        self._entries = {}
+        self._urls = {}
+        # 未预处理的 entry 按其他算法（md5-full）得到的 md5 -> 索引中的 md5，兼容之前的结果
+        self._aliases = {}
+        # 不保留 entry 时，md5 -> entry 在 .har 文件中的字节偏移；从 .harc 缓存构建时为缓存路径
+        self._offsets = {}
+        self._cache_path = None
+
+        if har is None:
+            return
+
+        if isinstance(har, str) and not keep_entries:
+            self._cache_path = har if har.endswith(cache_suffix) else find_valid_cache(har)
+            if self._cache_path is None:
+                for offset, entry in HarEntryReader(har).iter_with_offsets():
+                    self._offsets.setdefault(self.add(entry), offset)
+                return
+
+        for entry in iter_har_entries(har):
+            self.add(entry)
+
+    @classmethod
+    def from_har(cls, har, keep_entries=True):
+        """
+        :param har: har 文件路径、har 字典、entry 的迭代器或 EntryIndex
+        :param keep_entries: 同 __init__，har 为 EntryIndex 时忽略
+        :return: EntryIndex
+        """
+        if isinstance(har, cls):
+            return har
+
+        return cls(har, keep_entries=keep_entries)
+
+    def add(self, entry):
+        """将一个 entry 加入索引，返回它的 md5"""
+        has_md5 = 'md5' in entry
+        md5 = get_md5_from_entry(entry, self._lookup_algorithms[0])
+        if self.keep_entries:
+            self._entry_list.append(entry)
+
+        # 重复的 entry（md5 相同）保留第一次出现的，与 get_entry_by_md5 的行为一致
+        if md5 in self._urls:
+            return md5
+
+        if self.keep_entries:
+            self._entries[md5] = entry
+        self._urls[md5] = entry['request']['url']
+
+        if not has_md5:
+            for algorithm in self._lookup_algorithms[1:]:
+                self._aliases.setdefault(compute_fingerprint(entry, algorithm), md5)
+
+        return md5
+
+    def indexing(self, entries):
+        """边遍历 entries 边建立索引，用于和其他单次遍历的分析函数共用一次读取"""
+        for entry in entries:
+            self.add(entry)
+            yield entry
+
+    def __len__(self):
+        return len(self._urls)
+
+    def __contains__(self, md5):
+        return md5 in self._urls or md5 in self._aliases
+
+    def __iter__(self):
+        return iter(self._urls)
+
+    def iter_entries(self):
+        """按 har 中的顺序返回所有 entry"""
+        if not self.keep_entries:
+            raise ValueError("entries are not kept in this EntryIndex")
+
+        return iter(self._entry_list)
+
+    def resolve(self, md5):
+        """返回 md5 在索引中对应的 md5（兼容 md5-full 得到的 md5），找不到返回 None"""
+        if md5 in self._urls:
+            return md5
+
+        return self._aliases.get(md5)
+
+    def get_entry(self, md5):
+        """通过 md5 获取 entry，找不到返回 None；不保留 entry 时从文件中读取"""
+        md5 = self.resolve(md5)
+        if md5 is None:
+            return None
+
+        if self.keep_entries:
+            return self._entries[md5]
+
+        if md5 in self._offsets:
+            entry = read_entry_at(self.har_path, self._offsets[md5])
+            entry.setdefault('md5', md5)
+            return entry
+
+        if self._cache_path:
+            with HarCache(self._cache_path) as cache:
+                return cache.get_entry(md5)
+
+        raise ValueError("entries are not kept in this EntryIndex")
+
+    def get_url(self, md5):
+        return self._urls[self.resolve(md5)]
+
+
+# 最多缓存的 EntryIndex 个数，避免在 ./har_files 中逐个查找时把所有 har 都留在内存里
+_index_cache_size = 4
+_index_cache = {}
+
+
+def get_entry_index(har_path):
+    """
+    获取 har 文件对应的 EntryIndex，按 (路径, 修改时间) 缓存，文件改动后会重新构建
+    :param har_path: har 文件路径
+    :return: EntryIndex
+    """
+    key = (os.path.abspath(har_path), os.path.getmtime(har_path))
+    index = _index_cache.get(key)
+    if index is None:
+        # 只保留 md5 -> 位置和 url，多个大 har 同时缓存时不会把所有 entry 留在内存里
+        index = EntryIndex.from_har(har_path, keep_entries=False)
+        if len(_index_cache) >= _index_cache_size:
+            _index_cache.pop(next(iter(_index_cache)))
+        _index_cache[key] = index
+
+    return index
@@ -0,0 +1,252 @@
+import codecs
+import json
+import os
+
+from base import is_har_file
+from har_cache import find_valid_cache, iter_cache_entries, cache_suffix
+
+# 每次从文件中读取的字符数
+read_chunk_size = 1 << 20
+# 按偏移读取单个 entry 时第一次读取的字节数
+entry_read_size = 64 << 10
+
+_whitespace = ' \t\n\r'
+
+
+class HarEntryReader:
+    """
+    流式读取 har 文件中的 log.entries，每次只解析一个 entry，
+    内存占用只与单个 entry 的大小有关，与整个 har 文件的大小无关
+
+    log 中除 entries 以外的字段（version, creator, pages 等）会被解析并保存在 log_meta 中，
+    出现在 entries 之后的字段要在 entries 遍历完成后才能拿到
+    """
+
+    def __init__(self, har_path, chunk_size=read_chunk_size):
+        self.har_path = har_path
+        self.chunk_size = chunk_size
+        self.log_meta = {}
+        self._decoder = json.JSONDecoder()
+        self._file = None
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        # iter_with_offsets 时记录 entry 在文件中的字节偏移：_buf[_mark] 对应的字节偏移为 _mark_bytes
+        self._track_offsets = False
+        self._mark = 0
+        self._mark_bytes = 0
+        self.entry_offset = None
+
+    def __iter__(self):
+        # har 文件开头可能带有 BOM，使用 utf-8-sig 打开
+        with open(self.har_path, "r", encoding="utf-8-sig") as f:
+            self._file = f
+            self._buf, self._pos, self._eof = '', 0, False
+            self._mark, self._mark_bytes = 0, self._get_bom_size()
+            try:
+                yield from self._iter_root()
+            finally:
+                self._file = None
+
+    def iter_with_offsets(self):
+        """
+        同 __iter__，返回 (entry 在文件中的字节偏移, entry)，之后可以通过 read_entry_at 按需读取单个 entry
+        """
+        self._track_offsets = True
+        try:
+            for entry in self:
+                yield self.entry_offset, entry
+        finally:
+            self._track_offsets = False
+
+    def _get_bom_size(self):
+        if not self._track_offsets:
+            return 0
+
+        with open(self.har_path, 'rb') as f:
+            return len(codecs.BOM_UTF8) if f.read(len(codecs.BOM_UTF8)) == codecs.BOM_UTF8 else 0
+
+    def _advance_mark(self, pos):
+        """将 _mark 移动到 pos，累计经过的字节数，每个字符只编码一次"""
+        self._mark_bytes += len(self._buf[self._mark:pos].encode('utf-8'))
+        self._mark = pos
+
+    def _fill(self, size=None):
+        """继续读取文件，返回是否读到了新内容"""
+        if self._eof:
+            return False
+
+        # 丢弃已经解析过的部分
+        if self._pos:
+            if self._track_offsets:
+                self._advance_mark(self._pos)
+                self._mark = 0
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+
+        chunk = self._file.read(size or self.chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+
+        self._buf += chunk
+        return True
+
+    def _peek(self):
+        """跳过空白字符，返回下一个字符，文件结束时返回空字符串"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _whitespace:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        ch = self._peek()
+        if ch == '' or ch not in chars:
+            raise ValueError(f'Invalid har file "{self.har_path}": expect {chars!r}, got {ch!r}')
+        self._pos += 1
+        return ch
+
+    def _decode(self):
+        """解析下一个完整的 json 值，数据不够时继续读取文件"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # 按当前缓冲区大小成倍读取，保证超大 entry 的解析次数是对数级的
+                if self._fill(max(self.chunk_size, len(self._buf))):
+                    continue
+                raise
+
+            # 数字等值可能恰好在缓冲区末尾被截断，需要确认后面还有内容
+            if end == len(self._buf) and self._fill():
+                continue
+
+            self._pos = end
+            return value
+
+    def _iter_object(self):
+        """遍历 json 对象，依次返回 key，value 需要由调用者自行消费"""
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+
+        while True:
+            key = self._decode()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def _iter_root(self):
+        for key in self._iter_object():
+            if key != 'log':
+                self._decode()
+                continue
+
+            for log_key in self._iter_object():
+                if log_key == 'entries':
+                    yield from self._iter_array()
+                else:
+                    self.log_meta[log_key] = self._decode()
+
+    def _iter_array(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+
+        while True:
+            if self._track_offsets:
+                self._peek()
+                self._advance_mark(self._pos)
+                self.entry_offset = self._mark_bytes
+            yield self._decode()
+            if self._expect(',]') == ']':
+                return
+
+
+def read_entry_at(har_path, offset, read_size=entry_read_size):
+    """
+    读取 har 文件中从 offset 开始的一个 entry
+    :param offset: entry 在文件中的字节偏移，见 HarEntryReader.iter_with_offsets
+    :param read_size: 第一次读取的字节数，entry 不完整时成倍读取
+    :return: entry
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    with open(har_path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            chunk = f.read(max(read_size, len(buf)))
+            buf += text_decoder.decode(chunk, final=not chunk)
+            try:
+                # entry 是 json 对象，以 } 结尾，不会出现数字被截断的情况
+                return decoder.raw_decode(buf)[0]
+            except json.JSONDecodeError:
+                if not chunk:
+                    raise
+
+
+def iter_har_entries(har, chunk_size=read_chunk_size, use_cache=True):
+    """
+    遍历 har 中的 entries
+    :param har: har 文件路径、har 字典、EntryIndex，或者 entry 的迭代器
+        文件路径会以流式的方式读取，不会一次性加载整个 har
+    :param chunk_size: 流式读取时每次读取的字符数
+    :param use_cache: har 文件存在预处理生成的 .harc 缓存时，直接从缓存读取
+        注意缓存中的 entry 只有 md5、startedDateTime 和 request 中的 url、headers、cookies、postData，没有 response，
+        是否使用缓存取决于有没有运行过预处理；需要 response 或完整 entry 的调用方（response_harvest、子串搜索等）
+        必须传入 use_cache=False，并检查 entry 中有 response。har 本身是 .harc 路径时总是从缓存读取
+    :return: entry 的迭代器
+    """
+    if isinstance(har, str):
+        if har.endswith(cache_suffix) and os.path.exists(har):
+            return iter_cache_entries(har)
+
+        cache_path = find_valid_cache(har) if use_cache else None
+        if cache_path:
+            return iter_cache_entries(cache_path)
+
+        if not os.path.exists(har):
+            raise ValueError("har is not a dict or a valid file path")
+        return iter(HarEntryReader(har, chunk_size=chunk_size))
+
+    if isinstance(har, dict):
+        return iter(har['log']['entries'])
+
+    if hasattr(har, 'iter_entries'):
+        return har.iter_entries()
+
+    if hasattr(har, '__iter__'):
+        return iter(har)
+
+    raise ValueError("har is not a dict, a valid file path or an iterable of entries")
+
+
+def get_har_name(har):
+    """返回 har 的名字，用于打印"""
+    if isinstance(har, str):
+        return os.path.basename(har)
+
+    har_path = getattr(har, 'har_path', None)
+    if har_path:
+        return os.path.basename(har_path)
+
+    return 'har'
+
+
+def list_har_files(har_dir="./har_files", only_hash=True):
+    """
+    列出目录下（不递归）待分析的 har 文件，见 base.is_har_file
+    :param har_dir: 目录
+    :param only_hash: 只返回预处理过的（带 _md5 后缀的）文件
+    :return: 文件路径列表
+    """
+    return [os.path.join(har_dir, f) for f in os.listdir(har_dir)
+            if is_har_file(os.path.join(har_dir, f), only_hash=only_hash)]
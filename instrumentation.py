@@ -0,0 +1,194 @@
+import json
+import time
+from contextlib import contextmanager
+from time import perf_counter
+
+# 是否启用统计，关闭时各处的统计代码只有一次 if 判断；
+# 调用方在函数开始时读取一次（instrumentation.enabled），不要 from instrumentation import enabled
+enabled = False
+
+
+class Metrics:
+    """
+    一次运行中的统计：
+    - timers: 各阶段的耗时（调用次数、总耗时、单次最大耗时）
+    - counters: entry / value / 分组等计数
+    - caches: 各个缓存的命中率
+        register_cache 的缓存：缓存自己只在未命中时计数，查询次数由调用方（启用统计时）记录
+        register_lru_cache 的缓存：使用 functools.lru_cache 的 cache_info
+    """
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self._cache_lookups = {}
+        self._cache_misses_funcs = {}
+        self._lru_cache_info_funcs = {}
+        self._cache_baselines = {}
+        self.start_time = time.time()
+
+    def reset(self):
+        """清空统计，缓存的命中数从现在开始计算"""
+        self.timers = {}
+        self.counters = {}
+        self._cache_lookups = {}
+        self._cache_baselines = {name: func() for name, func in self._cache_misses_funcs.items()}
+        for name, func in self._lru_cache_info_funcs.items():
+            info = func()
+            self._cache_baselines[name] = (info.hits, info.misses)
+        self.start_time = time.time()
+
+    def register_cache(self, name, get_misses):
+        """
+        :param get_misses: 返回缓存累计未命中次数的函数，查询次数通过 add_cache_lookups 记录
+        """
+        self._cache_misses_funcs[name] = get_misses
+        self._cache_baselines[name] = get_misses()
+
+    def register_lru_cache(self, name, cache_info):
+        """
+        :param cache_info: lru_cache 包装后的函数的 cache_info
+        """
+        self._lru_cache_info_funcs[name] = cache_info
+        info = cache_info()
+        self._cache_baselines[name] = (info.hits, info.misses)
+
+    def add_time(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+    def incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_cache_lookups(self, name, n):
+        self._cache_lookups[name] = self._cache_lookups.get(name, 0) + n
+
+    def get_cache_stats(self):
+        """:return: dict, key: 缓存名, value: {hits, misses, hit_rate}"""
+        stats = {}
+        for name, func in self._cache_misses_funcs.items():
+            misses = func() - self._cache_baselines[name]
+            hits = max(self._cache_lookups.get(name, 0) - misses, 0)
+            stats[name] = {'hits': hits, 'misses': misses}
+
+        for name, func in self._lru_cache_info_funcs.items():
+            info = func()
+            base_hits, base_misses = self._cache_baselines[name]
+            stats[name] = {'hits': info.hits - base_hits, 'misses': info.misses - base_misses}
+
+        for item in stats.values():
+            total = item['hits'] + item['misses']
+            item['hit_rate'] = item['hits'] / total if total else None
+
+        return stats
+
+    def snapshot(self):
+        """:return: 可以直接保存为 json 的统计结果"""
+        return {
+            'start_time': self.start_time,
+            'wall_time_s': time.time() - self.start_time,
+            'timers': {name: {'count': count, 'total_s': total, 'max_s': max_s}
+                       for name, (count, total, max_s) in self.timers.items()},
+            'counters': dict(self.counters),
+            'caches': self.get_cache_stats(),
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), ensure_ascii=False, **kwargs)
+
+    def to_prometheus(self, prefix='cross_domain_', labels=None):
+        """
+        Prometheus 文本格式
+        :param labels: 附加到每个指标上的标签，例如 {'har': 'xxx_md5.har'}
+        """
+        extra = ''.join(f',{k}="{_escape_label(v)}"' for k, v in (labels or {}).items())
+        lines = []
+
+        def add_metric(name, metric_type, samples):
+            lines.append(f'# TYPE {prefix}{name} {metric_type}')
+            for label_name, label_value, value in samples:
+                lines.append(f'{prefix}{name}{{{label_name}="{_escape_label(label_value)}"{extra}}} {value}')
+
+        snapshot = self.snapshot()
+        timers = snapshot['timers']
+        add_metric('stage_seconds_total', 'counter', [('stage', k, v['total_s']) for k, v in timers.items()])
+        add_metric('stage_calls_total', 'counter', [('stage', k, v['count']) for k, v in timers.items()])
+        add_metric('stage_seconds_max', 'gauge', [('stage', k, v['max_s']) for k, v in timers.items()])
+        add_metric('events_total', 'counter', [('name', k, v) for k, v in snapshot['counters'].items()])
+
+        caches = snapshot['caches']
+        add_metric('cache_hits_total', 'counter', [('cache', k, v['hits']) for k, v in caches.items()])
+        add_metric('cache_misses_total', 'counter', [('cache', k, v['misses']) for k, v in caches.items()])
+        add_metric('cache_hit_ratio', 'gauge',
+                   [('cache', k, v['hit_rate']) for k, v in caches.items() if v['hit_rate'] is not None])
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
+
+
+class Stopwatch:
+    """连续计时，每次 lap 记录从上一次 lap（或创建）到现在的耗时"""
+
+    def __init__(self):
+        self._last = perf_counter()
+
+    def lap(self, name):
+        now = perf_counter()
+        metrics.add_time(name, now - self._last)
+        self._last = now
+
+    def skip(self):
+        """不记录从上一次 lap 到现在的耗时（已经由其他地方记录）"""
+        self._last = perf_counter()
+
+
+def stopwatch():
+    """启用统计时返回 Stopwatch，否则返回 None，调用方用 if sw: sw.lap(...) 记录"""
+    return Stopwatch() if enabled else None
+
+
+def enable(flag=True):
+    global enabled
+    enabled = flag
+
+
+@contextmanager
+def collect():
+    """
+    在 with 块中启用统计，开始时清空之前的统计，结束时恢复原来的启用状态
+    with instrumentation.collect() as m:
+        ...
+    print(m.to_json())
+    """
+    global enabled
+    previous = enabled
+    metrics.reset()
+    enabled = True
+    try:
+        yield metrics
+    finally:
+        enabled = previous
+
+
+def print_summary(m=None):
+    """按总耗时从大到小打印各阶段耗时、计数和缓存命中率"""
+    snapshot = (m or metrics).snapshot()
+    for name, timer in sorted(snapshot['timers'].items(), key=lambda item: -item[1]['total_s']):
+        print(f"    {name:<24} {timer['total_s'] * 1000:10.2f} ms  calls: {timer['count']}")
+    for name, value in snapshot['counters'].items():
+        print(f"    {name:<24} {value}")
+    for name, stats in snapshot['caches'].items():
+        hit_rate = 'n/a' if stats['hit_rate'] is None else f"{stats['hit_rate']:.1%}"
+        print(f"    cache {name:<18} hits: {stats['hits']}, misses: {stats['misses']}, hit rate: {hit_rate}")
@@ -0,0 +1,166 @@
+import re
+import sys
+import time
+from urllib.parse import urlparse, parse_qs
+
+import instrumentation
+from global_config import token_key_names, token_others, stop_words_key, stop_words_response_key
+
+# 结果缓存的最大条目数，超过后清空重新缓存
+matcher_cache_size = 1 << 16
+
+
+def compile_substring_pattern(words):
+    """将多个关键词编译为一个正则，一次扫描即可判断字符串中是否包含其中任意一个"""
+    if not words:
+        # 不会匹配任何字符串
+        return re.compile(r'(?!)')
+
+    # 长的关键词放在前面，避免短的关键词抢先匹配
+    return re.compile('|'.join(re.escape(w) for w in sorted(set(words), key=len, reverse=True)))
+
+
+class TokenKeyMatcher:
+    """
+    根据 keyname 判断是否为 token，与 base.is_token_key 的结果一致
+    关键词在创建时编译好：停用词和精确匹配使用 set，包含匹配使用一个正则，
+    每个 keyname 只计算一次各个检测等级的结果并缓存
+    """
+
+    def __init__(self, key_names=token_key_names, others=token_others, stop_words=stop_words_key):
+        self._stop_words = frozenset(w.lower() for w in stop_words)
+        self._key_names = frozenset(key_names)
+        self._key_pattern = compile_substring_pattern(key_names)
+        self._other_pattern = compile_substring_pattern(others)
+        self._cache = {}
+        # 缓存未命中次数，查询次数由调用方在启用统计时记录（见 instrumentation）
+        self.misses = 0
+
+    def _classify(self, param_keyname):
+        """
+        :return: (是否为停用词, 各检测等级的结果)
+        """
+        key = param_keyname.lower()
+        exact = key in self._key_names
+        contains_key = exact or self._key_pattern.search(key) is not None
+        contains_other = self._other_pattern.search(key) is not None
+
+        return key in self._stop_words, (exact, contains_key, contains_key or contains_other)
+
+    def is_token_key(self, param_keyname, level=0, enable_stopwords=True):
+        """
+        判断参数名是否为token，参数同 base.is_token_key
+        """
+        try:
+            is_stop_word, levels = self._cache[param_keyname]
+        except (KeyError, TypeError):
+            # 只有字符串会被缓存，其他类型都会走到这里
+            if not isinstance(param_keyname, str):
+                if param_keyname is None:
+                    return False
+                raise ValueError(f"param_keyname is not a string, but {type(param_keyname)}")
+
+            self.misses += 1
+            if len(self._cache) >= matcher_cache_size:
+                self._cache.clear()
+            is_stop_word, levels = self._cache[param_keyname] = self._classify(param_keyname)
+
+        if enable_stopwords and is_stop_word:
+            return False
+
+        return levels[min(level, 2)]
+
+
+token_key_matcher = TokenKeyMatcher()
+instrumentation.metrics.register_cache('token_key', lambda: token_key_matcher.misses)
+
+
+class StopWordFilter:
+    """
+    根据 keyname 判断是否为停用词，对应 get_values 中 enable_stopwords 的两种模式：
+        1: keyname（忽略大小写）与停用词完全一致，使用 set 查找
+        2: keyname 中包含任意一个停用词，使用编译好的正则一次扫描
+    每个 keyname 只计算一次两种模式的结果并缓存
+    """
+
+    def __init__(self, stop_words=stop_words_key):
+        self._stop_words = frozenset(w.lower() for w in stop_words)
+        self._pattern = compile_substring_pattern(self._stop_words)
+        self._cache = {}
+        # 同 TokenKeyMatcher.misses
+        self.misses = 0
+
+    def _classify(self, key):
+        key = key.lower()
+        return key in self._stop_words, self._pattern.search(key) is not None
+
+    def is_stop_word(self, key, enable_stopwords=1):
+        """
+        :param key: keyname
+        :param enable_stopwords: 0: 不过滤, 1: 完全一致, 2: 包含其一，其他值不过滤（与原来的判断方式一致）
+        :return: 是否应该被过滤掉
+        """
+        if enable_stopwords != 1 and enable_stopwords != 2:
+            return False
+
+        try:
+            exact, contains = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            if len(self._cache) >= matcher_cache_size:
+                self._cache.clear()
+            exact, contains = self._cache[key] = self._classify(key)
+
+        return exact if enable_stopwords == 1 else contains
+
+
+stop_word_filter = StopWordFilter()
+instrumentation.metrics.register_cache('stop_word', lambda: stop_word_filter.misses)
+
+# 响应头的停用词，见 response_harvest.py
+response_stop_word_filter = StopWordFilter(stop_words_response_key)
+
+
+def bench_is_token_key(har_paths, level=2, repeat=3):
+    """
+    对比 base.is_token_key 和 TokenKeyMatcher 的耗时，keyname 取自 har 中的 url 参数、headers 和 post body
+    :param har_paths: har 文件路径列表
+    :param level: 检测等级
+    :param repeat: 重复次数，取最快的一次
+    """
+    from base import is_token_key
+    from har_reader import iter_har_entries
+
+    keys = []
+    for har_path in har_paths:
+        for entry in iter_har_entries(har_path):
+            request = entry['request']
+            keys.extend(parse_qs(urlparse(request['url']).query).keys())
+            keys.extend(header['name'] for header in request['headers'])
+            keys.extend(param['name'] for param in request.get('postData', {}).get('params', []))
+
+    for enable_stopwords in (True, False):
+        matcher = TokenKeyMatcher()
+        expected = [is_token_key(k, level, enable_stopwords) for k in keys]
+        got = [matcher.is_token_key(k, level, enable_stopwords) for k in keys]
+        if expected != got:
+            raise AssertionError('TokenKeyMatcher is not consistent with base.is_token_key')
+
+        costs = []
+        for func in (is_token_key, TokenKeyMatcher().is_token_key):
+            best = float('inf')
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                for k in keys:
+                    func(k, level, enable_stopwords)
+                best = min(best, time.perf_counter() - start_time)
+            costs.append(best)
+
+        print(f'keys: {len(keys)} ({len(set(keys))} distinct), level: {level}, enable_stopwords: {enable_stopwords}\n'
+              f'    base.is_token_key: {costs[0] * 1000:.2f}ms\n'
+              f'    TokenKeyMatcher:   {costs[1] * 1000:.2f}ms ({costs[0] / costs[1]:.1f}x)')
+
+
+if __name__ == '__main__':
+    # python key_matcher.py ./har_files/xxx_md5.har ...
+    bench_is_token_key(sys.argv[1:])
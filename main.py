@@ -1,13 +1,20 @@
-import json
 import os
 import time
 
+import instrumentation
 from base import get_md5_from_entry, select_test_files_by_date
-from debug_tools import get_entry_by_md5
-from find_tokens import find_tokens_in_url, find_tokens_in_headers, find_tokens_in_post_body
-from get_values import get_values_from_entry
+from extract_fields import extract_fields
+from find_tokens import find_tokens_in_fields
+from flow_graph import TokenFlowGraph, iter_sorted_entries
+from get_values import get_values_from_fields
 from global_config import bold_split, thin_split
+from har_cache import cache_suffix
 from detect_cross_domain import *
+from har_index import EntryIndex
+from har_reader import iter_har_entries, get_har_name, list_har_files
+from occurrence_store import OccurrenceStore
+from response_harvest import ResponseTokenHarvester
+from streaming_detection import find_cross_domain_tokens_streaming
 
 
 def find_tokens_by_keyname(har, enable_print=False, enable_stopwords=True):
@@ -15,48 +22,20 @@ def find_tokens_by_keyname(har, enable_print=False, enable_stopwords=True):
     遍历 HAR 中记录的请求，在请求头和 url 中查找 token
     :param enable_stopwords: 使用停用词过滤
     :param enable_print: 是否打印详细信息到控制台
-    :param har: har 文件路径或 har 字典
+    :param har: har 文件路径、har 字典、EntryIndex 或 entry 的迭代器（文件路径会流式读取）
     :return: dict
         key: 请求的 md5
         value: 这条请求中根据 key name 发现的 tokens 的 dict
                 这个 dict 的 key 是 token 的 keyname，value 是 token 的值
     """
 
-    if isinstance(har, str) and os.path.exists(har):
-        with open(har, "r", encoding="utf-8-sig") as f:
-            har = json.load(f)
-    elif not isinstance(har, dict):
-        raise ValueError("har is not a dict or a valid file path")
+    res_keyname, _ = find_tokens_by_both(har,
+                                         enable_keyname=True,
+                                         enable_compare=False,
+                                         enable_print=enable_print,
+                                         keyname_stopwords=enable_stopwords)
 
-    tokens_found = 0
-    res = {}
-    for entry in har['log']['entries']:
-        url = entry['request']['url']
-        md5 = get_md5_from_entry(entry)
-        headers = entry['request']['headers']
-        post_data = entry['request']['postData']
-
-        tokens_url = find_tokens_in_url(url, level=2,
-                                        enable_stopwords=enable_stopwords)
-        tokens_headers = find_tokens_in_headers(headers, level=2,
-                                                enable_stopwords=enable_stopwords)
-        tokens_post_body = find_tokens_in_post_body(post_data, level=2,
-                                                    enable_stopwords=enable_stopwords)
-
-        # tokens 是一个字典，key 是 token 的 keyname，value 是 token 的值
-        tokens = {**tokens_url, **tokens_headers, **tokens_post_body}  # 合并两个字典
-        if tokens:
-            tokens_found += 1
-            res[md5] = tokens
-            if enable_print:
-                print(f"url: {url}")
-                # print(f"entry md5: {md5}")
-                print(f"tokens found: {tokens}\n{thin_split}")
-
-    if enable_print:
-        print(f"Tokens found (found / total entries): {tokens_found}/{len(har['log']['entries'])}")
-
-    return res
+    return res_keyname
 
 
 def find_tokens_by_compare(har, enable_print=False, show_skip_info=True, only_multi=False, enable_stopwords=1):
@@ -64,52 +43,162 @@ def find_tokens_by_compare(har, enable_print=False, show_skip_info=True, only_mu
     通过比较的方式，查找 har 中的 tokens
     :param show_skip_info: 是否打印被跳过的 value 的信息
     :param enable_stopwords: 使用停用词过滤
-    :param har: har 文件路径或 har 字典
+    :param har: har 文件路径、har 字典、EntryIndex 或 entry 的迭代器（文件路径会流式读取）
     :param enable_print: 是否打印详细信息到控制台
     :param only_multi: 只打印、返回多次出现的 tokens
         如果设置为 False，将会能覆盖到根据 keyname 找到的所有 tokens
     :return: 字典, key: token value, value: md5 list, 出现这个 value 的请求的 md5 列表
+        实际返回 OccurrenceStore，只读接口与字典一致，内存占用更小
     """
 
-    if isinstance(har, str) and os.path.exists(har):
-        with open(har, "r", encoding="utf-8-sig") as f:
-            har = json.load(f)
-    elif not isinstance(har, dict):
-        raise ValueError("har is not a dict or a valid file path")
+    _, res_compare = find_tokens_by_both(har,
+                                         enable_keyname=False,
+                                         enable_compare=True,
+                                         enable_print=enable_print,
+                                         show_skip_info=show_skip_info,
+                                         only_multi=only_multi,
+                                         compare_stopwords=enable_stopwords)
 
-    value_dict = {}
+    return res_compare
 
-    for entry in har['log']['entries']:
-        md5 = get_md5_from_entry(entry)
 
-        values = get_values_from_entry(entry, enable_stopwords=enable_stopwords)
+def find_tokens_by_both(har, enable_keyname=True, enable_compare=True, enable_print=False, show_skip_info=True,
+                        only_multi=False, keyname_stopwords=True, compare_stopwords=1):
+    """
+    只遍历一次 entries，每个请求只解析一次（extract_fields），同时完成 keyname 和 compare 两种方式的查找
+    :param har: har 文件路径、har 字典、EntryIndex 或 entry 的迭代器（文件路径会流式读取）
+    :param enable_keyname: 是否根据 keyname 查找，同 find_tokens_by_keyname
+    :param enable_compare: 是否通过比较的方式查找，同 find_tokens_by_compare
+    :param enable_print: 是否打印详细信息到控制台
+    :param show_skip_info: 同 find_tokens_by_compare
+    :param only_multi: 同 find_tokens_by_compare
+    :param keyname_stopwords: keyname 方式的停用词过滤
+    :param compare_stopwords: compare 方式的停用词过滤
+    :return: (find_tokens_by_keyname 的结果, find_tokens_by_compare 的结果)，未启用的方式返回空字典
+    """
 
-        if values:
-            for value in values:
-                value_dict.setdefault(value, []).append(md5)
+    har_name = get_har_name(har)
+
+    tokens_found = 0
+    entry_count = 0
+    res_keyname = {}
+    # value -> md5 列表，使用紧凑的 OccurrenceStore 代替 dict[str, list[str]]
+    value_dict = OccurrenceStore()
+
+    # 启用统计时记录各阶段耗时，read_entry 为等待下一个 entry 的时间（读取、解析 har）
+    sw = instrumentation.stopwatch()
+
+    for entry in iter_har_entries(har):
+        if sw:
+            sw.lap('read_entry')
+        entry_count += 1
+        md5 = get_md5_from_entry(entry)
+        fields = extract_fields(entry)
+        if sw:
+            sw.lap('extract_fields')
+
+        if enable_keyname:
+            # tokens 是一个字典，key 是 token 的 keyname，value 是 token 的值
+            tokens = find_tokens_in_fields(fields, level=2, enable_stopwords=keyname_stopwords)
+            if sw:
+                sw.lap('find_tokens_in_fields')
+            if tokens:
+                tokens_found += 1
+                res_keyname[md5] = tokens
+                if enable_print:
+                    print(f"url: {entry['request']['url']}")
+                    # print(f"entry md5: {md5}")
+                    print(f"tokens found: {tokens}\n{thin_split}")
+
+        if enable_compare:
+            values = get_values_from_fields(fields, enable_stopwords=compare_stopwords)
+            if sw:
+                sw.lap('get_values_from_fields')
+
+            if values:
+                for value in values:
+                    value_dict.add(value, md5)
+                if sw:
+                    sw.lap('occurrence_add')
+
+    if sw:
+        instrumentation.metrics.incr('entries', entry_count)
+        instrumentation.metrics.incr('keyname_entries', tokens_found)
+
+    if enable_keyname and enable_print:
+        print(f"Tokens found (found / total entries): {tokens_found}/{entry_count}")
+
+    if not enable_compare:
+        return res_keyname, value_dict
 
     if enable_print:
-        for k, v in value_dict.items():
-            if only_multi and len(v) == 1:
+        for k in value_dict:
+            if only_multi and value_dict.get_count(k) == 1:
                 continue
-            print(f"value: {k}\nappeared in request (md5): {v}\n{bold_split}")
+            print(f"value: {k}\nappeared in request (md5): {value_dict[k]}\n{bold_split}")
 
-        multi_count = len([v for v in value_dict.values() if len(v) > 1])
+        multi_count = value_dict.get_multi_count()
         print(f"find {len(value_dict)} values, "
-              f'{multi_count} appeared more than once in "{os.path.basename(har)}"\n'
+              f'{multi_count} appeared more than once in "{har_name}"\n'
               f"{bold_split}")
 
     if only_multi:
         if show_skip_info:
-            skipped_values = [k for k, v in value_dict.items() if len(v) == 1]
+            skipped_values = list(value_dict.iter_single())
             if skipped_values:
                 print(f"Skipped values by 'only_multi': {skipped_values}")
             else:
                 print(f"No value skipped by 'only_multi'")
 
-        value_dict = {k: v for k, v in value_dict.items() if len(v) > 1}
+        value_dict = value_dict.filter_multi()
+
+    return res_keyname, value_dict
+
 
-    return value_dict
+def find_cross_domain_tokens(har, enable_print=False, show_skip_info=False, only_multi=True, enable_stopwords=1,
+                             use_psl=False):
+    """
+    通过比较的方式查找 har 中的 tokens，并按域名分组，返回出现在多个域名中的 tokens
+    :param har: har 文件路径、har 字典或 entry 的迭代器（文件路径会流式读取）
+    :param enable_print: 同 find_tokens_by_compare
+    :param show_skip_info: 同 find_tokens_by_compare
+    :param only_multi: 同 find_tokens_by_compare
+    :param enable_stopwords: 同 find_tokens_by_compare
+    :param use_psl: 按公共后缀列表得到的可注册域名分组，见 group_by_domain
+    :return: 字典, key: token value, value: group_by_domain 的分组结果，只包含分组数大于 1 的 value
+    """
+
+    # 在 find_tokens_by_compare 遍历 entries 的同时建立 md5 索引，后续按 md5 取 url 不再线性查找；
+    # 索引只保留 url 等信息，不保留 entry 本身
+    entry_index = EntryIndex(har_path=har if isinstance(har, str) else None, keep_entries=False)
+
+    res_compare = find_tokens_by_compare(entry_index.indexing(iter_har_entries(har)),
+                                         enable_print=enable_print,
+                                         show_skip_info=show_skip_info,
+                                         only_multi=only_multi,
+                                         enable_stopwords=enable_stopwords)
+
+    sw = instrumentation.stopwatch()
+    res = {}
+    for value, md5_list in res_compare.items():
+        if len(md5_list) > 1:
+            if sw:
+                sw.lap('occurrence_lookup')
+            url_list = [(entry_index.get_url(md5), md5) for md5 in md5_list]
+            if sw:
+                sw.lap('md5_to_url')
+                instrumentation.metrics.incr('md5_lookups', len(md5_list))
+            groups = group_by_domain(url_list, level=2, with_suffix=False, use_psl=use_psl)
+            if sw:
+                # group_by_domain 自己记录耗时
+                sw.skip()
+            if len(groups) > 1:
+                res[value] = groups
+
+    if sw:
+        instrumentation.metrics.incr('cross_domain_values', len(res))
+
+    return res
 
 
 def test_cross_domain_detection(file_list=None,
@@ -118,54 +207,104 @@ def test_cross_domain_detection(file_list=None,
                                 show_skip_info=False,
                                 show_entry_md5=False,
                                 only_multi=True,
-                                enable_stopwords=1):
+                                enable_stopwords=1,
+                                use_psl=False,
+                                streaming=False,
+                                memory_budget=None,
+                                metrics_dir=None,
+                                show_issuer=False,
+                                show_flow=False):
     """
     测试跨域请求检测
+    :param streaming: 使用流式检测（见 streaming_detection.py），内存占用与不同 value 的个数成正比，
+        show_entry_md5 时每个分组只打印部分 md5
+    :param memory_budget: 流式检测的内存预算（字节），超过时聚合结果落盘
+    :param metrics_dir: 不为 None 时启用统计（见 instrumentation.py），每个文件打印各阶段耗时，
+        并在该目录中保存 <文件名>.metrics.json 和 <文件名>.prom
+    :param show_issuer: 打印每个跨域 token 第一次由哪个响应下发（见 response_harvest.py），需要再读取一次完整的 har
+    :param show_flow: 按请求时间打印每个跨域 token 依次出现的域名（见 flow_graph.py），需要再读取一次 har
     """
 
+    def do_test_with_metrics(har_path):
+        if metrics_dir is None:
+            do_test(har_path)
+            return
+
+        with instrumentation.collect() as metrics:
+            do_test(har_path)
+
+        file_name = os.path.basename(har_path)
+        print(f'Metrics of "{file_name}":')
+        instrumentation.print_summary(metrics)
+        print(bold_split)
+
+        os.makedirs(metrics_dir, exist_ok=True)
+        with open(os.path.join(metrics_dir, f'{file_name}.metrics.json'), 'w', encoding='utf-8') as f:
+            f.write(metrics.to_json(indent=2))
+        with open(os.path.join(metrics_dir, f'{file_name}.prom'), 'w', encoding='utf-8') as f:
+            f.write(metrics.to_prometheus(labels={'har': file_name}))
+
     def do_test(har_path):
         start_time = time.time()
         file_name = os.path.basename(har_path)
-        with open(har_path, "r", encoding="utf-8-sig") as f:
-            har = json.load(f)
 
         print(f'\n{bold_split}\n'
               f'Find tokens by compare, processing "{file_name}"...\n'
               f'{bold_split}')
 
-        res_compare = find_tokens_by_compare(har,
-                                             enable_print=enable_verbose_print,
-                                             show_skip_info=show_skip_info,
-                                             only_multi=only_multi,
-                                             enable_stopwords=enable_stopwords)
-
-        value_domain = {}
-        for value, md5_list in res_compare.items():
-            if len(md5_list) > 1:
-                url_list = []
-                for md5 in md5_list:
-                    url = get_entry_by_md5(har, md5)['request']['url']
-                    url_list.append((url, md5))
-
-                value_domain[value] = url_list
-
-        have_cross_domain = False
-        for value, url_list in value_domain.items():
-            res = group_by_domain(url_list, level=2, with_suffix=False)
-            if len(res) > 1:
-                have_cross_domain = True
+        if streaming:
+            cross_domain_res = find_cross_domain_tokens_streaming(har_path,
+                                                                  enable_stopwords=enable_stopwords,
+                                                                  use_psl=use_psl,
+                                                                  memory_budget=memory_budget)
+        else:
+            cross_domain_res = find_cross_domain_tokens(har_path,
+                                                        enable_print=enable_verbose_print,
+                                                        show_skip_info=show_skip_info,
+                                                        only_multi=only_multi,
+                                                        enable_stopwords=enable_stopwords,
+                                                        use_psl=use_psl)
+
+        harvester = None
+        if show_issuer and cross_domain_res and har_path.endswith(cache_suffix):
+            # 只有 .harc 缓存（原 har 文件不存在）时没有 response，无法查找下发 token 的响应
+            print(f'show_issuer skipped: {cache_suffix} cache has no response, use the original har file instead')
+        elif show_issuer and cross_domain_res:
+            harvester = ResponseTokenHarvester(enable_stopwords=enable_stopwords)
+            harvester.feed(iter_har_entries(har_path, use_cache=False))
+
+        flow_graph = None
+        if show_flow and cross_domain_res:
+            flow_graph = TokenFlowGraph(use_psl=use_psl, enable_stopwords=enable_stopwords)
+            flow_graph.feed(iter_sorted_entries(iter_har_entries(har_path)))
+
+        for value, res in cross_domain_res.items():
+            if streaming:
+                group_domain = [group.netloc for group in res]
+                group_len = [group.count for group in res]
+            else:
                 group_domain = [get_domain(group[0][0], domain_level=0) for group in res]
+                group_len = [len(g) for g in res]
+
+            print(f"value: {value}")
+
+            if show_entry_md5:
+                print(f"group by domain: {res}")
 
-                print(f"value: {value}")
+            print(f"domain of each group: {group_domain}\n"
+                  f"len of each group: {group_len}")
 
-                if show_entry_md5:
-                    print(f"group by domain: {res}")
+            if harvester is not None:
+                issuer = harvester.get_issuer(value)
+                if issuer is not None:
+                    print(f"issued by: {get_domain(issuer.url, domain_level=0)} ({issuer.location}: {issuer.key})")
 
-                print(f"domain of each group: {group_domain}\n"
-                      f"len of each group: {[len(g) for g in res]}\n"
-                      f"{thin_split}")
+            if flow_graph is not None:
+                print(f"flow: {' -> '.join(flow_graph.get_path(value))}")
 
-        if not have_cross_domain:
+            print(thin_split)
+
+        if not cross_domain_res:
             print(f'No cross domain detected in "{file_name}".\n{bold_split}')
 
         print(f'Test "{file_name}" done, time cost: {time.time() - start_time:.2f}s\n'
@@ -184,26 +323,24 @@ def test_cross_domain_detection(file_list=None,
           f'    show_skip_info: {show_skip_info}\n'
           f'    only_multi: {only_multi}\n'
           f'    enable_stopwords: {enable_stopwords}\n'
+          f'    use_psl: {use_psl}\n'
+          f'    streaming: {streaming}\n'
+          f'    metrics_dir: {metrics_dir}\n'
+          f'    show_issuer: {show_issuer}\n'
+          f'    show_flow: {show_flow}\n'
           f'{bold_split}\n')
 
     if file_list is None:
         count = 0
 
-        har_files = os.listdir("./har_files")
-        for har_file in har_files:
-            if not har_file.endswith(".har"):
-                continue
-            if only_hash and not har_file.endswith("_md5.har"):
-                continue
-
-            har_path = os.path.join("./har_files", har_file)
-            do_test(har_path)
+        for har_path in list_har_files("./har_files", only_hash=only_hash):
+            do_test_with_metrics(har_path)
             count += 1
 
         print(f'HAR files tested: {count}\n{bold_split}')
     else:
         for har_path in file_list:
-            do_test(har_path)
+            do_test_with_metrics(har_path)
 
         print(f'HAR files tested: {len(file_list)}\n{bold_split}')
 
@@ -226,9 +363,13 @@ def test_keyname(file_list=None):
 
 
 def compare_2_methods_res(har_path):
-    res_by_keyname = find_tokens_by_keyname(har_path,
-                                            enable_print=False,
-                                            enable_stopwords=True)
+    # 两种方法共用一次遍历，每个请求只解析一次
+    res_by_keyname, res_by_compare = find_tokens_by_both(har_path,
+                                                         enable_print=False,
+                                                         show_skip_info=True,
+                                                         only_multi=True,
+                                                         keyname_stopwords=True,
+                                                         compare_stopwords=True)
 
     values_by_keyname = []
     for md5, key_value in res_by_keyname.items():
@@ -237,11 +378,6 @@ def compare_2_methods_res(har_path):
 
     values_by_keyname = list(set(values_by_keyname))
 
-    res_by_compare = find_tokens_by_compare(har_path,
-                                            enable_print=False,
-                                            only_multi=True,
-                                            enable_stopwords=True)
-
     values_by_compare = list(res_by_compare.keys())
 
     values_same = [v for v in values_by_keyname if v in values_by_compare]
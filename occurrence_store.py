@@ -0,0 +1,171 @@
+import sys
+import tracemalloc
+from array import array
+from collections.abc import Mapping
+
+# 每个 md5 以 16 字节的摘要保存
+_DIGEST_SIZE = 16
+
+
+class OccurrenceStore(Mapping):
+    """
+    value -> 出现该 value 的请求的 md5 列表，用于替代 find_tokens_by_compare 中的 value_dict（dict[str, list[str]]）
+    - value 被 intern，每个 value 对应一个整数 id
+    - 每个请求对应一个整数 entry id，md5 以 16 字节摘要保存在一个 bytearray 中
+    - 每次出现保存在两个 array 中（entry id、同一个 value 的下一次出现），同一个 value 的出现组成链表，
+      不为每个 value 单独分配 list
+    与 dict 的只读接口一致（items、keys、values、get、in、len），取值时返回 md5（十六进制字符串）列表
+    """
+
+    def __init__(self):
+        self._value_ids = {}
+        # 每个 value 的第一次、最后一次出现的位置和出现次数
+        self._head = array('I')
+        self._tail = array('I')
+        self._count = array('I')
+        self._multi_count = 0
+
+        # 每次出现的 entry id 和同一个 value 的下一次出现的位置，位置 0 不使用，next 为 0 表示没有下一次出现
+        self._occ_entry = array('I', [0])
+        self._occ_next = array('I', [0])
+
+        self._digests = bytearray()
+        self._last_md5 = None
+        self._last_entry_id = 0
+
+    def _get_entry_id(self, md5):
+        # 同一个请求的所有 value 是连续添加的，只需要和上一个 md5 比较
+        if md5 == self._last_md5:
+            return self._last_entry_id
+
+        digest = bytes.fromhex(md5)
+        if len(digest) != _DIGEST_SIZE:
+            raise ValueError(f'md5 should be {_DIGEST_SIZE} bytes, but {md5}')
+
+        self._last_md5 = md5
+        self._last_entry_id = len(self._digests) // _DIGEST_SIZE
+        self._digests += digest
+
+        return self._last_entry_id
+
+    def add(self, value, md5):
+        """记录 value 出现在 md5 对应的请求中，相当于 value_dict.setdefault(value, []).append(md5)"""
+        occ = len(self._occ_entry)
+        self._occ_entry.append(self._get_entry_id(md5))
+        self._occ_next.append(0)
+
+        value_id = self._value_ids.get(value)
+        if value_id is None:
+            self._value_ids[sys.intern(value)] = len(self._head)
+            self._head.append(occ)
+            self._tail.append(occ)
+            self._count.append(1)
+            return
+
+        self._occ_next[self._tail[value_id]] = occ
+        self._tail[value_id] = occ
+        self._count[value_id] += 1
+        if self._count[value_id] == 2:
+            self._multi_count += 1
+
+    def _get_md5(self, entry_id):
+        start = entry_id * _DIGEST_SIZE
+        return self._digests[start:start + _DIGEST_SIZE].hex()
+
+    def _iter_occurrences(self, value_id):
+        occ = self._head[value_id]
+        while occ:
+            yield occ
+            occ = self._occ_next[occ]
+
+    def get_count(self, value):
+        """value 出现的次数，不需要生成 md5 列表"""
+        return self._count[self._value_ids[value]]
+
+    def __getitem__(self, value):
+        return [self._get_md5(self._occ_entry[occ]) for occ in self._iter_occurrences(self._value_ids[value])]
+
+    def __contains__(self, value):
+        return value in self._value_ids
+
+    def __iter__(self):
+        return iter(self._value_ids)
+
+    def __len__(self):
+        return len(self._value_ids)
+
+    def get_multi_count(self):
+        """出现多于一次的 value 的个数"""
+        return self._multi_count
+
+    def iter_single(self):
+        """只出现一次的 value 的迭代器"""
+        count = self._count
+        return (value for value, value_id in self._value_ids.items() if count[value_id] == 1)
+
+    def filter_multi(self):
+        """
+        只保留出现多于一次的 value，相当于 {k: v for k, v in value_dict.items() if len(v) > 1}
+        :return: 新的 OccurrenceStore
+        """
+        res = OccurrenceStore()
+        for value, value_id in self._value_ids.items():
+            if self._count[value_id] > 1:
+                for occ in self._iter_occurrences(value_id):
+                    entry_id = self._occ_entry[occ]
+                    start = entry_id * _DIGEST_SIZE
+                    res.add(value, self._digests[start:start + _DIGEST_SIZE].hex())
+
+        return res
+
+
+def bench_occurrence_store(har_paths, enable_stopwords=1):
+    """
+    对比 dict[str, list[str]] 和 OccurrenceStore 保存 find_tokens_by_compare 结果时的内存占用（tracemalloc）
+    :param har_paths: har 文件路径列表
+    :param enable_stopwords: 同 find_tokens_by_compare
+    """
+    from base import get_md5_from_entry
+    from get_values import get_values_from_entry
+    from har_reader import iter_har_entries
+
+    pairs = []
+    for har_path in har_paths:
+        for entry in iter_har_entries(har_path):
+            md5 = get_md5_from_entry(entry)
+            pairs.extend((value, md5) for value in get_values_from_entry(entry, enable_stopwords=enable_stopwords))
+
+    # value、md5 字符串在两种结构中都是新建的，与实际运行时一样计入各自的内存占用
+    pairs = [(value.encode(), md5.encode()) for value, md5 in pairs]
+
+    def build_dict():
+        value_dict = {}
+        for value, md5 in pairs:
+            value_dict.setdefault(value.decode(), []).append(md5.decode())
+        return value_dict
+
+    def build_store():
+        store = OccurrenceStore()
+        for value, md5 in pairs:
+            store.add(value.decode(), md5.decode())
+        return store
+
+    sizes = []
+    for build in (build_dict, build_store):
+        tracemalloc.start()
+        res = build()
+        sizes.append(tracemalloc.get_traced_memory()[0])
+        tracemalloc.stop()
+        del res
+
+    if dict(build_store().items()) != build_dict():
+        raise AssertionError('OccurrenceStore is not consistent with dict')
+
+    print(f'occurrences: {len(pairs)}, values: {len(build_store())}\n'
+          f'    dict:            {sizes[0] / 1024:.1f} KiB\n'
+          f'    OccurrenceStore: {sizes[1] / 1024:.1f} KiB ({sizes[0] / sizes[1]:.1f}x smaller)')
+
+
+if __name__ == '__main__':
+    # python occurrence_store.py ./har_files/xxx_md5.har ...
+    bench_occurrence_store(sys.argv[1:])
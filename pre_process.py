@@ -1,28 +1,85 @@
 import hashlib
 import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from fingerprint import iter_entries_with_fingerprint, fingerprint_field
+from global_config import fingerprint_algorithm
+from har_cache import write_har_cache, get_cache_path, find_valid_cache
+from har_reader import HarEntryReader
+from search_index import SearchIndex, search_index_path
+
+
+# 预处理清单的文件名，保存在 har 目录下，记录每个源文件的处理结果
+manifest_file_name = 'preprocess_manifest.json'
+manifest_version = 1
+
+
+def add_md5_to_entries(har_path, output_format='har', algorithm=fingerprint_algorithm, workers=1, force=False):
+    """
+    为 har 中的每个 entry 添加 md5（entry 的指纹），使用的算法会记录在 har['log']['_fingerprint'] 中
+    :param har_path: har 文件路径
+    :param algorithm: 指纹算法，见 fingerprint.py
+    :param workers: 计算指纹的进程数，大于 1 时并行计算
+    :param output_format: 输出格式
+        har: 带 md5 的完整 har 文件（xxx_md5.har）
+        harc: 只包含请求侧字段的紧凑缓存文件（xxx_md5.harc），见 har_cache.py，读取时会被自动使用；
+            输入已经是 _md5.har 时，会为其生成对应的缓存文件
+    :param force: 输出文件已存在时是否重新生成（源文件有变化时使用）
+    :return: 输出文件路径
+    """
+    if output_format not in ('har', 'harc'):
+        raise ValueError(f'output_format must be "har" or "harc", but "{output_format}"')
 
-def add_md5_to_entries(har_path):
     if har_path.endswith('_md5.har'):
-        print(f"MD5 already added to entries: |{har_path}|")
-        return har_path
+        if output_format == 'har':
+            print(f"MD5 already added to entries: |{har_path}|")
+            return har_path
+
+        # 已经有 md5 的 har，只需要生成缓存（已有的缓存比 har 文件旧或格式版本过旧时重新生成）
+        new_file_path = get_cache_path(har_path)
+        if not force and find_valid_cache(har_path):
+            print(f"Cache already exists: |{new_file_path}|")
+            return new_file_path
+
+        reader = HarEntryReader(har_path)
+        write_har_cache(reader, new_file_path, log_meta=reader.log_meta)
+        print(f"Cache created. |{har_path}| --> |{new_file_path}|")
+        return new_file_path
 
     new_file_path = har_path.replace('.har', '_md5.har')
-    if os.path.exists(new_file_path):
+    if output_format == 'harc':
+        new_file_path = get_cache_path(new_file_path)
+
+    if not force and os.path.exists(new_file_path) \
+            and (output_format == 'har' or find_valid_cache(new_file_path)):
         print(f"MD5 already added to entries: |{har_path}|")
         return new_file_path
 
-    with open(har_path, "r", encoding="utf-8-sig") as f:
-        har = json.load(f)
+    # 流式读取、逐个 entry 写出，内存占用与 har 文件大小无关
+    reader = HarEntryReader(har_path)
+    reader.log_meta[fingerprint_field] = algorithm
+    entries = iter_entries_with_fingerprint(reader, algorithm=algorithm, workers=workers)
+    if output_format == 'harc':
+        write_har_cache(entries, new_file_path, log_meta=reader.log_meta)
+    else:
+        # 先写临时文件再重命名，中断时不会留下不完整的输出
+        tmp_path = new_file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('{\n  "log": {\n    "entries": [')
 
-    for entry in har['log']['entries']:
-        entry_str = json.dumps(entry, ensure_ascii=False, sort_keys=True)
-        entry_hash = hashlib.md5(entry_str.encode()).hexdigest()
-        entry['md5'] = entry_hash
+            for i, entry in enumerate(entries):
+                entry_str = json.dumps(entry, ensure_ascii=False, sort_keys=True, indent=2)
+                f.write(('\n      ' if i == 0 else ',\n      ') + entry_str.replace('\n', '\n      '))
 
-    with open(new_file_path, 'w', encoding='utf-8') as f:
-        json.dump(har, f, ensure_ascii=False, sort_keys=True, indent=2)
+            f.write('\n    ]')
+            # log 中的其他字段（version, creator, pages 等）
+            for key, value in sorted(reader.log_meta.items()):
+                value_str = json.dumps(value, ensure_ascii=False, sort_keys=True, indent=2)
+                f.write(f',\n    {json.dumps(key)}: ' + value_str.replace('\n', '\n    '))
+            f.write('\n  }\n}\n')
+        os.replace(tmp_path, new_file_path)
 
     print(f"MD5 added to entries."
           f"|{har_path}| --> |{new_file_path}|")
@@ -30,19 +87,191 @@ def add_md5_to_entries(har_path):
     return new_file_path
 
 
-def add_md5_all():
-    har_files_dir = os.listdir("./har_files")
-    for har_file in har_files_dir:
-        if har_file.endswith('.har'):
-            old_file_path = f"./har_files/{har_file}"
-            new_file_path = add_md5_to_entries(old_file_path)
-            if new_file_path != old_file_path:
-                os.rename(old_file_path, f"./har_files/filtered_no_md5/{har_file}")
+def get_file_hash(file_path, chunk_size=1 << 20):
+    """计算文件内容的 blake2b 哈希（16 字节，十六进制）"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def load_manifest(manifest_path):
+    """
+    读取预处理清单
+    :return: dict, key: 源文件名, value: 处理记录，见 _process_har_file
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != manifest_version:
+        raise ValueError(f'unsupported manifest version: {manifest.get("version")}, |{manifest_path}|')
+
+    return manifest['files']
+
+
+def save_manifest(manifest_path, records):
+    """先写临时文件再重命名，中断时清单始终是完整的"""
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': manifest_version, 'files': records}, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _process_har_file(har_path, output_format, algorithm, workers, force):
+    """在子进程中处理一个 har 文件，返回清单中的记录"""
+    stat = os.stat(har_path)
+    content_hash = get_file_hash(har_path)
+    output_path = add_md5_to_entries(har_path, output_format=output_format, algorithm=algorithm,
+                                     workers=workers, force=force)
+
+    return {
+        'source': har_path,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'content_hash': content_hash,
+        'output': output_path,
+        'output_format': output_format,
+        'algorithm': algorithm,
+        'processed_at': time.time(),
+    }
+
+
+def _need_process(har_path, record, output_format, algorithm):
+    """
+    判断源文件是否需要（重新）处理
+    :return: (是否需要处理, 是否需要覆盖已有的输出)
+    """
+    if record is None:
+        # 清单中没有记录（新文件，或清单出现之前处理过的文件），已有的输出是完整的，可以直接使用
+        return True, False
+
+    if record['output_format'] != output_format or record['algorithm'] != algorithm:
+        return True, True
+
+    if not os.path.exists(record['output']):
+        return True, True
+
+    if output_format == 'harc' and not find_valid_cache(record['output']):
+        # 旧版本格式的缓存
+        return True, True
+
+    stat = os.stat(har_path)
+    if stat.st_size == record['size'] and stat.st_mtime == record['mtime']:
+        return False, False
+
+    # size 或 mtime 变化时再比较内容哈希，只是 touch 过的文件不重新处理
+    if stat.st_size == record['size'] and get_file_hash(har_path) == record['content_hash']:
+        record['mtime'] = stat.st_mtime
+        return False, False
+
+    return True, True
+
+
+def add_md5_all(output_format='har', algorithm=fingerprint_algorithm, workers=1, jobs=1,
+                har_dir='./har_files', manifest_path=None, build_search_index=False):
+    """
+    增量预处理 har_dir 下的 har 文件，处理结果记录在清单（har_dir/preprocess_manifest.json）中：
+    源文件路径、大小、mtime、内容哈希、输出路径、输出格式、指纹算法
+    只处理清单中没有的、内容有变化的，或输出格式/指纹算法与清单不一致的文件；
+    每处理完一个文件就原子地写一次清单，中断后重新运行会从未完成的文件继续
+    处理完的源文件（不带 md5）会被移动到 har_dir/filtered_no_md5/ 下
+    :param output_format: 输出格式，见 add_md5_to_entries
+    :param algorithm: 指纹算法，见 fingerprint.py
+    :param workers: 每个文件计算指纹的进程数，jobs 大于 1 时忽略（子进程中不再创建进程池）
+    :param jobs: 同时处理的文件数，大于 1 时每个文件在一个子进程中处理
+    :param har_dir: har 文件目录
+    :param manifest_path: 清单路径，为 None 时使用 har_dir/preprocess_manifest.json
+    :param build_search_index: 是否同时更新输出文件的子串搜索索引，见 search_index.py
+    :return: 本次处理的源文件名列表
+    """
+    if manifest_path is None:
+        manifest_path = os.path.join(har_dir, manifest_file_name)
+
+    records = load_manifest(manifest_path)
+
+    # 之前生成的 xxx_md5.har 是其他源文件的输出，不作为新的源文件再处理一次（结果不会变化）；
+    # 输出格式改变时除外，需要为它生成新格式的输出
+    outputs = {os.path.abspath(record['output']) for record in records.values()
+               if record['output'] != record['source'] and record['output_format'] == output_format}
+
+    tasks = {}
+    for har_file in sorted(os.listdir(har_dir)):
+        if not har_file.endswith('.har') or os.path.abspath(os.path.join(har_dir, har_file)) in outputs:
+            continue
+
+        need, force = _need_process(os.path.join(har_dir, har_file), records.get(har_file), output_format, algorithm)
+        if need:
+            tasks[har_file] = force
+
+    # xxx.har 本次会重新生成 xxx_md5.har(c)，不再处理旧的 xxx_md5.har，避免用旧内容覆盖新的输出
+    for har_file in list(tasks):
+        if har_file.endswith('_md5.har') and har_file[:-len('_md5.har')] + '.har' in tasks:
+            del tasks[har_file]
+
+    # 跳过的文件可能更新了 mtime
+    save_manifest(manifest_path, records)
+
+    def on_done(har_file, record):
+        if record['output'] != record['source'] and not har_file.endswith('_md5.har'):
+            archived_path = os.path.join(har_dir, 'filtered_no_md5', har_file)
+            os.makedirs(os.path.dirname(archived_path), exist_ok=True)
+            os.replace(record['source'], archived_path)
+            record['archived'] = archived_path
+
+        records[har_file] = record
+        save_manifest(manifest_path, records)
+
+    if jobs <= 1:
+        for har_file, force in tasks.items():
+            on_done(har_file, _process_har_file(os.path.join(har_dir, har_file), output_format,
+                                                algorithm, workers, force))
+    else:
+        # 每个文件已经在一个子进程中处理，子进程中只用一个进程计算指纹，避免嵌套的进程池
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(_process_har_file, os.path.join(har_dir, har_file), output_format,
+                                       algorithm, 1, force): har_file
+                       for har_file, force in tasks.items()}
+            for future in as_completed(futures):
+                on_done(futures[future], future.result())
+
+    print(f"{len(tasks)} file(s) processed, manifest: |{manifest_path}|")
+
+    if build_search_index:
+        with SearchIndex(search_index_path) as index:
+            for record in records.values():
+                _index_record(index, record)
+
+    return list(tasks)
+
+
+def _index_record(index, record):
+    """将清单中一条记录的输出文件加入搜索索引，输出为 .harc 时从源文件读取完整的 entry"""
+    output_path = record['output']
+    if not os.path.exists(output_path) or index.is_up_to_date(output_path):
+        return
+
+    source_path = None
+    if not output_path.endswith('.har'):
+        source_path = record.get('archived', record['source'])
+        if not os.path.exists(source_path):
+            return
+
+    index.index_har(output_path, source_path=source_path, algorithm=record['algorithm'])
+    print(f"Search index updated: |{output_path}|")
 
 
 if __name__ == '__main__':
     user_input = input("This script will add MD5 hash to each entry in all HAR files in ./har_files directory.\n"
                        "Press y to continue: ")
     if user_input.lower() == 'y':
-        add_md5_all()
+        output_format = input("Output format, har (full har file) / harc (compact cache), press Enter to har: ")
+        workers = input("Number of processes to compute fingerprints, press Enter to 1: ")
+        jobs = input("Number of files to process at the same time, press Enter to 1: ")
+        build_search_index = input("Build substring search index? (y/n, press Enter to n): ")
+        add_md5_all(output_format=output_format.lower() or 'har', workers=int(workers or 1), jobs=int(jobs or 1),
+                    build_search_index=build_search_index.lower() == 'y')
     pass
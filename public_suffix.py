@@ -0,0 +1,126 @@
+import ipaddress
+import os
+from functools import lru_cache
+
+import instrumentation
+
+# 随代码一起提供的公共后缀列表（离线子集），可以替换为完整的 public_suffix_list.dat
+public_suffix_list_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'public_suffix_list.dat')
+
+# 按 netloc 缓存可注册域名的条目数
+registrable_domain_cache_size = 1 << 16
+
+# trie 节点中表示规则类型的特殊 key（域名中的 label 不会包含这些字符）
+_RULE = '$rule'
+_EXCEPTION = '$exception'
+
+
+class PublicSuffixTrie:
+    """
+    公共后缀列表的 trie，按 label 从右到左存储，例如 com.cn 存储为 cn -> com
+    支持普通规则、通配规则（*.example）和例外规则（!a.example），匹配方式与 publicsuffix.org 的算法一致
+    """
+
+    def __init__(self, rules):
+        self._root = {}
+        for rule in rules:
+            self.add_rule(rule)
+
+    @classmethod
+    def from_file(cls, path=public_suffix_list_path):
+        with open(path, 'r', encoding='utf-8') as f:
+            rules = [line.split()[0] for line in f if line.strip() and not line.startswith('//')]
+
+        return cls(rules)
+
+    def add_rule(self, rule):
+        rule = rule.strip().lower()
+        is_exception = rule.startswith('!')
+        if is_exception:
+            rule = rule[1:]
+
+        node = self._root
+        for label in reversed(rule.split('.')):
+            node = node.setdefault(label, {})
+
+        node[_EXCEPTION if is_exception else _RULE] = True
+
+    def get_public_suffix_length(self, labels):
+        """
+        :param labels: 按从右到左顺序排列的 label 列表
+        :return: 公共后缀包含的 label 个数，没有规则匹配时使用默认规则 "*"，返回 1
+        """
+        suffix_length = 1
+        node = self._root
+        for i, label in enumerate(labels):
+            if '*' in node and _RULE in node['*']:
+                suffix_length = max(suffix_length, i + 1)
+
+            node = node.get(label)
+            if node is None:
+                break
+
+            if _EXCEPTION in node:
+                # 例外规则优先，公共后缀为例外规则去掉最左边的 label
+                return i
+            if _RULE in node:
+                suffix_length = max(suffix_length, i + 1)
+
+        return suffix_length
+
+    def get_registrable_domain(self, hostname):
+        """
+        返回 hostname 的可注册域名（公共后缀 + 一级），例如 a.b.com.cn -> b.com.cn
+        :return: hostname 本身就是公共后缀时返回空字符串
+        """
+        labels = hostname.split('.')
+        labels.reverse()
+        suffix_length = self.get_public_suffix_length(labels)
+        if len(labels) <= suffix_length:
+            return ''
+
+        return '.'.join(reversed(labels[:suffix_length + 1]))
+
+
+_default_trie = None
+
+
+def get_default_trie():
+    """加载随代码提供的公共后缀列表，只加载一次"""
+    global _default_trie
+    if _default_trie is None:
+        _default_trie = PublicSuffixTrie.from_file()
+
+    return _default_trie
+
+
+def get_hostname_from_netloc(netloc):
+    """从 netloc 中去掉用户信息和端口号，转为小写，例如 'user@API.example.com:8080' -> 'api.example.com'"""
+    hostname = netloc.rpartition('@')[2]
+    if hostname.startswith('['):
+        # ipv6
+        return hostname[1:hostname.find(']')].lower()
+
+    return hostname.partition(':')[0].rstrip('.').lower()
+
+
+@lru_cache(maxsize=registrable_domain_cache_size)
+def get_registrable_domain_from_netloc(netloc):
+    """
+    返回 netloc 的可注册域名，结果按 netloc 缓存
+    IP 地址、localhost 等没有可注册域名的主机名返回主机名本身，便于作为分组的 key
+    """
+    hostname = get_hostname_from_netloc(netloc)
+    if not hostname:
+        return ''
+
+    try:
+        ipaddress.ip_address(hostname)
+        return hostname
+    except ValueError:
+        pass
+
+    return get_default_trie().get_registrable_domain(hostname) or hostname
+
+
+instrumentation.metrics.register_lru_cache('registrable_domain', get_registrable_domain_from_netloc.cache_info)
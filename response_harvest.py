@@ -0,0 +1,197 @@
+import json
+import sys
+from collections import namedtuple
+from urllib.parse import urlparse
+
+from base import get_md5_from_entry
+from detect_cross_domain import get_domain
+from extract_fields import extract_fields, extract_response_fields, LOCATION_RESPONSE_HEADER
+from get_values import get_values_from_fields, iter_value_fields
+from global_config import min_token_len, bold_split, thin_split
+from har_cache import cache_suffix
+from har_reader import iter_har_entries
+from key_matcher import response_stop_word_filter
+
+# 下发 token 的响应
+#   md5: 响应所在 entry 的 md5，url: 对应请求的 url
+#   location / key: value 在响应中的位置（response_header、set_cookie、response_body）和 key name
+Issuer = namedtuple('Issuer', ['md5', 'url', 'location', 'key'])
+
+# 一个由响应下发、之后在请求中使用的 value
+#   issuer: 第一次下发该 value 的响应（Issuer）
+#   uses: 之后在请求中使用该 value 的 (md5, url) 列表，按出现的顺序
+IssuedToken = namedtuple('IssuedToken', ['value', 'issuer', 'uses'])
+
+
+class ResponseTokenHarvester:
+    """
+    按 entry 的顺序，记录每个 value 第一次出现在哪个响应中（headers、Set-Cookie、body），
+    以及之后哪些请求使用了这个 value，从而把 token 的下发和之后（可能跨域）的使用关联起来
+    每个 entry 先处理请求再处理响应，同一个 entry 的响应中下发的 value 只与之后的请求关联
+    之前已经在请求中出现过的 value（例如客户端生成的设备 id 被响应回显）不是由响应下发的，不记录；
+    启用过滤时，Date、ETag 等响应头（global_config.stop_words_response_key，完美匹配）中的 value 也不记录
+    响应 body 只在 mimeType 为 json、文本、表单且大小不超过限制时才解码，见 extract_fields.extract_response_fields
+    """
+
+    def __init__(self, enable_stopwords=1, min_len=min_token_len, include_body=True):
+        """
+        :param enable_stopwords: 同 find_tokens_by_compare，同时用于请求和响应中的 value
+        :param min_len: 最小 token 长度
+        :param include_body: 是否解析响应 body
+        """
+        self.enable_stopwords = enable_stopwords
+        self.min_len = min_len
+        self.include_body = include_body
+
+        self.entry_count = 0
+        # 每个 entry 的 (md5, url)
+        self._entries = []
+        # value -> (entry 序号, location, key)，只记录第一次下发
+        self._issuers = {}
+        # value -> 使用该 value 的请求的 entry 序号列表
+        self._uses = {}
+        # 已经在请求中出现过的 value
+        self._request_values = set()
+
+    def add_entry(self, entry, fields=None):
+        """
+        处理一个 entry，entry 需要包含 response
+        :param fields: extract_fields(entry) 的结果，已经解析过时传入，避免重复解析
+        """
+        if 'response' not in entry:
+            raise ValueError(f'entry has no response (read from a {cache_suffix} cache?), '
+                             f'use iter_har_entries(har, use_cache=False) on the original har file')
+
+        entry_id = len(self._entries)
+        self._entries.append((get_md5_from_entry(entry), entry['request']['url']))
+        self.entry_count += 1
+
+        if fields is None:
+            fields = extract_fields(entry)
+
+        issuers = self._issuers
+        request_values = self._request_values
+        for value in get_values_from_fields(fields, enable_stopwords=self.enable_stopwords, min_len=self.min_len):
+            if value in issuers:
+                self._uses.setdefault(value, []).append(entry_id)
+            else:
+                request_values.add(sys.intern(value))
+
+        for location, key, value in iter_value_fields(extract_response_fields(entry, include_body=self.include_body),
+                                                      enable_stopwords=self.enable_stopwords, min_len=self.min_len):
+            if value in issuers or value in request_values:
+                continue
+            if location == LOCATION_RESPONSE_HEADER and self.enable_stopwords \
+                    and response_stop_word_filter.is_stop_word(key, 1):
+                continue
+
+            issuers[sys.intern(value)] = (entry_id, location, key)
+
+    def feed(self, entries):
+        """处理多个 entry，返回 self"""
+        for entry in entries:
+            self.add_entry(entry)
+
+        return self
+
+    def get_issuer(self, value):
+        """:return: 第一次下发 value 的响应（Issuer），没有响应下发过时返回 None"""
+        item = self._issuers.get(value)
+        if item is None:
+            return None
+
+        entry_id, location, key = item
+        return Issuer(*self._entries[entry_id], location, key)
+
+    def get_result(self, only_cross_domain=False, level=2, use_psl=False):
+        """
+        :param only_cross_domain: 只返回在与下发的响应不同的域名中使用过的 value，只保留这些域名中的使用
+        :param level: 同 group_by_domain
+        :param use_psl: 同 group_by_domain
+        :return: 字典, key: token value, value: IssuedToken，只包含下发之后在请求中使用过的 value
+        """
+        res = {}
+        for value, use_ids in self._uses.items():
+            issuer = self.get_issuer(value)
+            uses = [self._entries[i] for i in use_ids]
+            if only_cross_domain:
+                issuer_domain = get_domain(issuer.url, domain_level=level, use_psl=use_psl)
+                uses = [use for use in uses if get_domain(use[1], domain_level=level, use_psl=use_psl) != issuer_domain]
+                if not uses:
+                    continue
+
+            res[value] = IssuedToken(value, issuer, uses)
+
+        return res
+
+
+def harvest_response_tokens(har, enable_stopwords=1, include_body=True, only_cross_domain=False, use_psl=False):
+    """
+    查找由响应下发、之后在请求中使用的 tokens，见 ResponseTokenHarvester
+    :param har: har 文件路径、har 字典或 entry 的迭代器（文件路径会流式读取，不使用没有 response 的 .harc 缓存）
+    :return: 字典, key: token value, value: IssuedToken
+    """
+    if isinstance(har, str) and har.endswith(cache_suffix):
+        raise ValueError(f'{cache_suffix} cache has no response, use the original har file instead')
+
+    harvester = ResponseTokenHarvester(enable_stopwords=enable_stopwords, include_body=include_body)
+    harvester.feed(iter_har_entries(har, use_cache=False))
+
+    return harvester.get_result(only_cross_domain=only_cross_domain, use_psl=use_psl)
+
+
+def print_issued_tokens(res):
+    for value, token in res.items():
+        print(f"value: {value}\n"
+              f"issued by: {urlparse(token.issuer.url).netloc} ({token.issuer.location}: {token.issuer.key}) "
+              f"| md5: {token.issuer.md5}\n"
+              f"used by: {[urlparse(url).netloc for _, url in token.uses]}\n"
+              f"{thin_split}")
+
+    print(f"{len(res)} values issued by responses and used in later requests\n{bold_split}")
+
+
+def test_response_harvest():
+    """
+    检查 ResponseTokenHarvester：
+    - 客户端先在请求中发送、再被响应回显的设备 id 不是由响应下发的
+    - Date 响应头的 value 之后出现在 If-Modified-Since 中，不作为下发的 token
+    - 响应 body 中下发、之后在其他域名的请求中使用的 token 被正确关联
+    """
+    device_id = 'dev-7f3a9c2e5b1d4086'
+    token = 'Qx7Lm2Rt5Wp8Kz3NaB4c'
+    date = 'Sat, 10 Aug 2024 12:00:00 GMT'
+
+    def make_entry(url, headers=(), response_headers=(), response_body=None):
+        response = {'status': 200, 'headers': [{'name': k, 'value': v} for k, v in response_headers], 'cookies': []}
+        if response_body is not None:
+            response['content'] = {'mimeType': 'application/json', 'text': json.dumps(response_body)}
+        return {'startedDateTime': '2024-08-10T12:00:00.000Z',
+                'request': {'method': 'GET', 'url': url, 'cookies': [],
+                            'headers': [{'name': k, 'value': v} for k, v in headers]},
+                'response': response}
+
+    entries = [
+        make_entry(f'https://api.alpha.com/login?did={device_id}',
+                   response_headers=[('Date', date), ('ETag', '"5f1d2c3b4a596877"')],
+                   response_body={'did': device_id, 'token': token}),
+        make_entry(f'https://log.beta.com/report?did={device_id}',
+                   headers=[('X-Auth', token), ('If-Modified-Since', date)]),
+    ]
+
+    res = ResponseTokenHarvester().feed(entries).get_result()
+    if list(res) != [token]:
+        raise AssertionError(f'unexpected issued tokens: {list(res)}')
+
+    issuer = res[token].issuer
+    if (issuer.location, issuer.key) != ('response_body', 'token') or \
+            [url for _, url in res[token].uses] != [entries[1]['request']['url']]:
+        raise AssertionError(f'unexpected issuer or uses: {res[token]}')
+
+    print('ResponseTokenHarvester test passed')
+
+
+if __name__ == '__main__':
+    # python response_harvest.py ./har_files/xxx_md5.har ...
+    for har_path in sys.argv[1:]:
+        print_issued_tokens(harvest_response_tokens(har_path, enable_stopwords=2, only_cross_domain=True))
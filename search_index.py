@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+from base import get_md5_from_entry
+from har_cache import cache_suffix
+from har_reader import iter_har_entries, list_har_files
+
+search_index_path = r'./search_index.sqlite'
+
+# 一次 executemany 写入的 entry 数
+insert_batch_size = 1000
+
+# 索引中 entry 文本的格式版本，serialize_entry 的格式变化时递增，旧版本的索引会被清空后重新建立
+# 版本 2: 紧凑、sort_keys 的 json（版本 1 为 indent=2）
+search_index_version = 2
+
+
+def serialize_entry(entry):
+    """
+    entry 的文本形式，子串搜索基于它：索引中保存的文本与没有索引时逐个 entry 搜索的文本完全相同，
+    同一个查询串不会因为 har 是否已索引而得到不同的结果；打印时再由 get_context_lines 格式化
+    """
+    return json.dumps(entry, ensure_ascii=False, sort_keys=True)
+
+
+def get_context_lines(entry_text, target_str, print_context=5):
+    """
+    将 serialize_entry 的文本格式化为缩进的 json，返回第一处包含 target_str 的行及其前后各 print_context 行
+    target_str 跨越多个字段（格式化后不在同一行中）时，返回紧凑文本中匹配处前后的片段
+    :return: 行列表，不包含 target_str 时返回空列表
+    """
+    lines = json.dumps(json.loads(entry_text), ensure_ascii=False, indent=2, sort_keys=True).split('\n')
+    for i, line in enumerate(lines):
+        if target_str in line:
+            return lines[max(i - print_context, 0):i + print_context + 1]
+
+    pos = entry_text.find(target_str)
+    if pos < 0:
+        return []
+
+    margin = 80 * (print_context + 1)
+    return [entry_text[max(pos - margin, 0):pos + len(target_str) + margin]]
+
+
+class SearchIndex:
+    """
+    对 har 中所有 entry（包括 response）文本的子串搜索索引，使用 SQLite FTS5 的 trigram 分词（区分大小写）
+    查询时不需要重新解析任何 har，长度小于 3 的查询串无法使用 trigram，会退回到对已存储文本的逐条比较
+    har 文件以绝对路径保存，搜索结果中的 har_path 也是绝对路径
+    """
+
+    def __init__(self, db_path=search_index_path):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS har_files (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                indexed_at REAL NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS entry_text USING fts5(
+                file_id UNINDEXED, md5 UNINDEXED, text, tokenize = 'trigram case_sensitive 1'
+            );
+        """)
+
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] != search_index_version:
+            # 文本格式不同的旧索引，清空后所有文件都会在下次 update 时重新索引
+            with self._conn:
+                self._conn.execute('DELETE FROM entry_text')
+                self._conn.execute('DELETE FROM har_files')
+                self._conn.execute(f'PRAGMA user_version = {search_index_version}')
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def is_up_to_date(self, har_path):
+        """har 已经索引过，且之后没有变化"""
+        har_path = os.path.abspath(har_path)
+        row = self._conn.execute('SELECT size, mtime FROM har_files WHERE path = ?', (har_path,)).fetchone()
+        if row is None or not os.path.exists(har_path):
+            return False
+
+        stat = os.stat(har_path)
+        return row == (stat.st_size, stat.st_mtime)
+
+    def index_har(self, har_path, source_path=None, algorithm=None, force=False):
+        """
+        索引一个 har 文件（会替换它之前的索引结果），在一个事务中完成
+        :param har_path: 搜索结果中使用的 har 路径
+        :param source_path: 实际读取 entries 的完整 har 文件，默认为 har_path；
+            预处理输出为只包含请求侧字段的 .harc 时，从源文件读取完整的 entry，md5 按 algorithm 计算
+        :param algorithm: 源文件中的 entry 没有 md5 时使用的指纹算法，默认为 md5-full，见 base.get_md5_from_entry
+        :param force: 是否在文件没有变化时也重新索引
+        :return: 是否重新索引了
+        """
+        if not force and source_path is None and self.is_up_to_date(har_path):
+            return False
+
+        har_path = os.path.abspath(har_path)
+        if source_path is None:
+            source_path = har_path
+        if source_path.endswith(cache_suffix):
+            raise ValueError(f'{cache_suffix} cache has no response, pass the original har file as source_path')
+        stat = os.stat(har_path)
+
+        with self._conn:
+            self._remove(har_path)
+            file_id = self._conn.execute('INSERT INTO har_files (path, size, mtime, indexed_at) VALUES (?, ?, ?, ?)',
+                                         (har_path, stat.st_size, stat.st_mtime, time.time())).lastrowid
+
+            batch = []
+            # 需要完整的 entry（包括 response），不使用只包含请求侧字段的缓存
+            for entry in iter_har_entries(source_path, use_cache=False):
+                batch.append((file_id, get_md5_from_entry(entry, algorithm), serialize_entry(entry)))
+                if len(batch) >= insert_batch_size:
+                    self._insert(batch)
+                    batch = []
+            self._insert(batch)
+
+        return True
+
+    def _insert(self, rows):
+        self._conn.executemany('INSERT INTO entry_text (file_id, md5, text) VALUES (?, ?, ?)', rows)
+
+    def _remove(self, har_path):
+        har_path = os.path.abspath(har_path)
+        row = self._conn.execute('SELECT id FROM har_files WHERE path = ?', (har_path,)).fetchone()
+        if row is not None:
+            self._conn.execute('DELETE FROM entry_text WHERE file_id = ?', row)
+            self._conn.execute('DELETE FROM har_files WHERE id = ?', row)
+
+    def remove_har(self, har_path):
+        """从索引中删除一个 har 文件"""
+        with self._conn:
+            self._remove(har_path)
+
+    def update(self, har_paths, enable_print=True):
+        """增量更新索引，返回重新索引的文件列表"""
+        updated = []
+        for har_path in har_paths:
+            if har_path.endswith(cache_suffix):
+                if enable_print:
+                    print(f"skip |{har_path}|: {cache_suffix} cache has no response")
+                continue
+
+            start_time = time.time()
+            if self.index_har(har_path):
+                updated.append(har_path)
+                if enable_print:
+                    print(f"indexed |{har_path}| in {time.time() - start_time:.2f}s")
+
+        return updated
+
+    def search(self, target_str, har_paths=None):
+        """
+        查找文本中包含 target_str 的 entry
+        :param har_paths: 只在这些 har 文件中查找，为 None 时查找所有已索引的文件
+        :return: (har_path, md5, entry_text) 的迭代器，按 har 路径和 entry 顺序
+        """
+        if len(target_str) >= 3:
+            # trigram 索引上的短语查询即为子串匹配，双引号需要转义
+            query = ('SELECT f.path, t.md5, t.text FROM entry_text t JOIN har_files f ON t.file_id = f.id '
+                     'WHERE entry_text MATCH ? ORDER BY f.path, t.rowid')
+            params = ('"' + target_str.replace('"', '""') + '"',)
+        else:
+            query = ('SELECT f.path, t.md5, t.text FROM entry_text t JOIN har_files f ON t.file_id = f.id '
+                     'WHERE instr(t.text, ?) > 0 ORDER BY f.path, t.rowid')
+            params = (target_str,)
+
+        har_paths = None if har_paths is None else set(os.path.abspath(har_path) for har_path in har_paths)
+        for har_path, md5, text in self._conn.execute(query, params):
+            if har_paths is None or har_path in har_paths:
+                yield har_path, md5, text
+
+
+def update_search_index(har_dir='./har_files', only_hash=True, db_path=search_index_path):
+    """增量更新 har_dir 下所有 har 文件的搜索索引，返回重新索引的文件列表"""
+    with SearchIndex(db_path) as index:
+        return index.update(list_har_files(har_dir, only_hash=only_hash))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='har entry 的子串搜索索引')
+    parser.add_argument('target', nargs='?', help='要查找的字符串，不指定时只更新索引')
+    parser.add_argument('--dir', default='./har_files', help='har 文件目录')
+    parser.add_argument('--all', action='store_true', help='同时索引不带 _md5 后缀的 har 文件')
+    parser.add_argument('--context', type=int, default=5, help='打印匹配行前后的行数')
+    parser.add_argument('--db', default=search_index_path, help='索引数据库路径')
+    args = parser.parse_args()
+
+    update_search_index(args.dir, only_hash=not args.all, db_path=args.db)
+
+    if args.target:
+        with SearchIndex(args.db) as search_index:
+            for path, entry_md5, entry_text in search_index.search(args.target):
+                print(f"{os.path.basename(path)} | {entry_md5}")
+                print('\n'.join(get_context_lines(entry_text, args.target, args.context)))
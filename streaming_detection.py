@@ -0,0 +1,265 @@
+import os
+import sqlite3
+import sys
+import tempfile
+from collections import namedtuple
+from urllib.parse import urlparse
+
+from base import get_md5_from_entry
+from detect_cross_domain import get_domain
+from extract_fields import extract_fields
+from get_values import get_values_from_fields
+from har_reader import iter_har_entries
+
+# 一个 value 在一个域名分组中的聚合结果
+#   domain: 分组的域名（同 group_by_domain 的分组依据）
+#   netloc: 分组中第一个请求的完整域名（与 do_test 打印的 "domain of each group" 一致）
+#   count: 分组中的请求数
+#   md5_samples: 分组中最先出现的若干个请求的 md5
+StreamGroup = namedtuple('StreamGroup', ['domain', 'netloc', 'count', 'md5_samples'])
+
+# 估算内存占用时，每个 value、每个分组、每个 md5 样本的额外开销（字节）
+_VALUE_OVERHEAD = 300
+_GROUP_OVERHEAD = 250
+_SAMPLE_OVERHEAD = 90
+
+_SPILL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS agg (
+    value TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    vseq INTEGER NOT NULL,
+    gseq INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    netloc TEXT NOT NULL,
+    samples TEXT NOT NULL,
+    n_samples INTEGER NOT NULL,
+    PRIMARY KEY (value, domain)
+)
+"""
+
+
+class StreamingCrossDomainDetector:
+    """
+    流式的跨域 token 检测：逐个 entry 更新 value -> {域名: 请求数, md5 样本} 的聚合结果，
+    不需要完整的 har、所有 value 的 md5 列表，也不需要之后再按 md5 查 url，内存占用与不同 value 的个数成正比
+    估算的内存占用超过 memory_budget 时，将当前的聚合结果合并到磁盘上的 SQLite 临时文件中并清空内存
+    结果与 find_cross_domain_tokens 一致，区别是每个分组只保留请求数和部分 md5，
+    以及 md5 完全相同的重复 entry 会被重复计数
+    """
+
+    def __init__(self, level=2, use_psl=False, enable_stopwords=1, sample_size=3, memory_budget=None, spill_dir=None):
+        """
+        :param level: 分组的域名级别，同 group_by_domain
+        :param use_psl: 同 group_by_domain
+        :param enable_stopwords: 同 find_tokens_by_compare
+        :param sample_size: 每个分组保留的 md5 个数
+        :param memory_budget: 聚合结果的内存预算（字节，估算值），为 None 时不落盘
+        :param spill_dir: 落盘文件所在目录，为 None 时使用系统临时目录
+        """
+        self.level = level
+        self.use_psl = use_psl
+        self.enable_stopwords = enable_stopwords
+        self.sample_size = sample_size
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+
+        self.entry_count = 0
+        self.spill_count = 0
+
+        # value -> [value 第一次出现的序号, {domain: [分组第一次出现的序号, 请求数, netloc, md5 样本列表]}]
+        self._values = {}
+        self._seq = 0
+        self._memory = 0
+
+        self._spill_path = None
+        self._spill_conn = None
+
+    def add_entry(self, entry):
+        """处理一个 entry"""
+        self.entry_count += 1
+        md5 = get_md5_from_entry(entry)
+        url = entry['request']['url']
+        values = get_values_from_fields(extract_fields(entry), enable_stopwords=self.enable_stopwords)
+        if not values:
+            return
+
+        domain = get_domain(url, domain_level=self.level, with_suffix=False, use_psl=self.use_psl)
+        netloc = urlparse(url).netloc
+
+        for value in values:
+            item = self._values.get(value)
+            if item is None:
+                self._seq += 1
+                item = self._values[sys.intern(value)] = [self._seq, {}]
+                self._memory += _VALUE_OVERHEAD + len(value)
+
+            group = item[1].get(domain)
+            if group is None:
+                self._seq += 1
+                item[1][domain] = [self._seq, 1, netloc, [md5]]
+                self._memory += _GROUP_OVERHEAD + len(domain) + len(netloc) + _SAMPLE_OVERHEAD
+                continue
+
+            group[1] += 1
+            if len(group[3]) < self.sample_size:
+                group[3].append(md5)
+                self._memory += _SAMPLE_OVERHEAD
+
+        if self.memory_budget is not None and self._memory > self.memory_budget:
+            self.spill()
+
+    def feed(self, entries):
+        """处理多个 entry，返回 self"""
+        for entry in entries:
+            self.add_entry(entry)
+
+        return self
+
+    def spill(self):
+        """将内存中的聚合结果合并到磁盘上的临时文件中，并清空内存"""
+        if not self._values:
+            return
+
+        if self._spill_conn is None:
+            fd, self._spill_path = tempfile.mkstemp(prefix='cross_domain_', suffix='.sqlite', dir=self.spill_dir)
+            os.close(fd)
+            self._spill_conn = sqlite3.connect(self._spill_path)
+            self._spill_conn.execute('PRAGMA journal_mode=OFF')
+            self._spill_conn.execute('PRAGMA synchronous=OFF')
+            self._spill_conn.execute(_SPILL_SCHEMA)
+
+        # 合并时保留第一次出现的序号、netloc 和 md5 样本，请求数相加；样本最多多出 sample_size 个，读取时截断
+        with self._spill_conn:
+            self._spill_conn.executemany(
+                'INSERT INTO agg (value, domain, vseq, gseq, count, netloc, samples, n_samples) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (value, domain) DO UPDATE SET '
+                '    vseq = MIN(vseq, excluded.vseq), '
+                '    count = count + excluded.count, '
+                '    samples = CASE WHEN n_samples >= ? THEN samples ELSE samples || \',\' || excluded.samples END, '
+                '    n_samples = n_samples + excluded.n_samples',
+                ((value, domain, vseq, gseq, count, netloc, ','.join(samples), len(samples), self.sample_size)
+                 for value, (vseq, groups) in self._values.items()
+                 for domain, (gseq, count, netloc, samples) in groups.items()))
+
+        self._values = {}
+        self._memory = 0
+        self.spill_count += 1
+
+    def _iter_groups(self):
+        """按 value 第一次出现的顺序返回 (value, [(domain, gseq, count, netloc, md5 样本)])"""
+        if self._spill_conn is None:
+            for value, (_, groups) in self._values.items():
+                yield value, [(domain, *group) for domain, group in groups.items()]
+            return
+
+        self.spill()
+
+        value = None
+        groups = []
+        # 同一个 value 不同分组的 vseq 可能不同（落盘之后才出现的分组），按最小的 vseq 排序
+        for row in self._spill_conn.execute(
+                'SELECT value, domain, gseq, count, netloc, samples FROM ('
+                '    SELECT *, MIN(vseq) OVER (PARTITION BY value) AS first_seq, '
+                '        COUNT(*) OVER (PARTITION BY value) AS n_groups FROM agg'
+                ') WHERE n_groups > 1 ORDER BY first_seq, gseq'):
+            if row[0] != value:
+                if groups:
+                    yield value, groups
+                value = row[0]
+                groups = []
+            groups.append((row[1], row[2], row[3], row[4], row[5].split(',')[:self.sample_size]))
+
+        if groups:
+            yield value, groups
+
+    def get_result(self):
+        """
+        :return: 字典, key: token value, value: StreamGroup 列表，只包含分组数大于 1 的 value
+            分组的顺序与 group_by_domain 一致：有多个请求的分组在前，只有一个请求的分组在后，各自按第一次出现的顺序
+        """
+        res = {}
+        for value, groups in self._iter_groups():
+            if len(groups) < 2:
+                continue
+
+            groups = [StreamGroup(domain, netloc, count, md5_samples)
+                      for domain, _, count, netloc, md5_samples in sorted(groups, key=lambda g: g[1])]
+            res[value] = [g for g in groups if g.count > 1] + [g for g in groups if g.count == 1]
+
+        return res
+
+    def close(self):
+        """删除落盘的临时文件"""
+        if self._spill_conn is not None:
+            self._spill_conn.close()
+            self._spill_conn = None
+            os.remove(self._spill_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def find_cross_domain_tokens_streaming(har, enable_stopwords=1, use_psl=False, sample_size=3, memory_budget=None):
+    """
+    find_cross_domain_tokens 的流式版本，见 StreamingCrossDomainDetector
+    :param har: har 文件路径、har 字典或 entry 的迭代器（文件路径会流式读取）
+    :return: 字典, key: token value, value: StreamGroup 列表，只包含分组数大于 1 的 value
+    """
+    with StreamingCrossDomainDetector(use_psl=use_psl, enable_stopwords=enable_stopwords, sample_size=sample_size,
+                                      memory_budget=memory_budget) as detector:
+        return detector.feed(iter_har_entries(har)).get_result()
+
+
+def test_streaming_equivalence(n_entries=2000, seeds=(0, 1), memory_budgets=(None, 64 << 10)):
+    """
+    在 benchmark.generate_synthetic_har 生成的 har 上检查流式检测与 find_cross_domain_tokens 的结果一致：
+    - value 集合、每个分组的域名、netloc、请求数、md5 样本和分组的顺序相同（包括落盘的情况）
+    - md5 完全相同的重复 entry（每个 entry 出现两次）：find_cross_domain_tokens 中 group_by_domain 会去掉重复的
+      (url, md5)，流式检测重复计数，每个分组的请求数为前者的两倍
+    """
+    import copy
+    from benchmark import generate_synthetic_har
+    from main import find_cross_domain_tokens
+
+    def expected_groups(groups, factor=1):
+        return [(get_domain(group[0][0], domain_level=2), urlparse(group[0][0]).netloc, len(group) * factor)
+                for group in groups]
+
+    for seed in seeds:
+        har = generate_synthetic_har(n_entries=n_entries, seed=seed)
+        expected = find_cross_domain_tokens(har)
+
+        for memory_budget in memory_budgets:
+            res = find_cross_domain_tokens_streaming(har, memory_budget=memory_budget)
+            if res.keys() != expected.keys():
+                raise AssertionError(f'streaming values mismatch: seed={seed}, memory_budget={memory_budget}')
+
+            for value, groups in expected.items():
+                stream_groups = res[value]
+                if [(g.domain, g.netloc, g.count) for g in stream_groups] != expected_groups(groups) or \
+                        [g.md5_samples for g in stream_groups] != [[md5 for _, md5 in group[:3]] for group in groups]:
+                    raise AssertionError(f'streaming groups mismatch: seed={seed}, memory_budget={memory_budget}, '
+                                         f'value={value}')
+
+        # 每个 entry 出现两次，md5 相同
+        entries = har['log']['entries']
+        duplicated = {'log': {'entries': [copy.deepcopy(entry) for entry in entries for _ in range(2)]}}
+        res = find_cross_domain_tokens_streaming(duplicated)
+        if res.keys() != expected.keys():
+            raise AssertionError(f'streaming values mismatch with duplicated entries: seed={seed}')
+
+        for value, groups in expected.items():
+            # 请求数翻倍后，只有一个请求的分组会移到有多个请求的分组中，按域名比较
+            stream_counts = {(g.domain, g.netloc, g.count) for g in res[value]}
+            if stream_counts != set(expected_groups(groups, factor=2)):
+                raise AssertionError(f'streaming counts mismatch with duplicated entries: seed={seed}, value={value}')
+
+    print('find_cross_domain_tokens_streaming is consistent with find_cross_domain_tokens')
+
+
+if __name__ == '__main__':
+    test_streaming_equivalence()
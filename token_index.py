@@ -0,0 +1,241 @@
+import argparse
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from urllib.parse import urlparse
+
+from base import get_md5_from_entry
+from extract_fields import extract_fields
+from get_values import iter_value_fields
+from global_config import min_token_len
+from har_reader import iter_har_entries, list_har_files
+from public_suffix import get_registrable_domain_from_netloc
+
+token_index_path = r'./token_index.sqlite'
+
+# 一次 executemany 写入的行数
+insert_batch_size = 10000
+
+# value 的一次出现：所在 har 文件、entry 的 md5、请求的主机名与可注册域名、字段位置与 key name
+Occurrence = namedtuple('Occurrence', ['har_path', 'md5', 'hostname', 'domain', 'location', 'key'])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS har_files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    enable_stopwords INTEGER NOT NULL,
+    min_len INTEGER NOT NULL,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS occurrences (
+    value TEXT NOT NULL,
+    file_id INTEGER NOT NULL REFERENCES har_files(id),
+    md5 TEXT NOT NULL,
+    hostname TEXT,
+    domain TEXT,
+    location TEXT NOT NULL,
+    key TEXT
+);
+CREATE INDEX IF NOT EXISTS occurrences_value ON occurrences(value);
+CREATE INDEX IF NOT EXISTS occurrences_file ON occurrences(file_id);
+"""
+
+
+def iter_occurrences(har, enable_stopwords=1, min_len=min_token_len):
+    """
+    遍历 har 中所有 value 的出现位置，过滤规则与 get_values_from_entry 一致（compare 检测方式）
+    :param har: har 文件路径、har 字典或 entry 的迭代器
+    :return: (value, md5, hostname, domain, location, key) 的迭代器，同一个 entry 中重复的行只出现一次
+    """
+    for entry in iter_har_entries(har):
+        md5 = get_md5_from_entry(entry)
+        parsed = urlparse(entry['request']['url'])
+        hostname = parsed.hostname
+        domain = get_registrable_domain_from_netloc(parsed.netloc)
+
+        rows = {}
+        for location, key, value in iter_value_fields(extract_fields(entry), enable_stopwords, min_len):
+            rows.setdefault((value, location, key), None)
+
+        for value, location, key in rows:
+            yield value, md5, hostname, domain, location, key
+
+
+class TokenIndex:
+    """
+    跨 har 文件的 value 倒排索引，保存在本地 SQLite 数据库中：value -> (har 文件, md5, 域名, 位置)
+    按文件的 size / mtime 增量更新，只重新索引新增或有变化的 har，查询时不需要再解析任何 har
+    har 文件以绝对路径保存，查询结果中的 har_path 也是绝对路径
+    """
+
+    def __init__(self, db_path=token_index_path):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def is_up_to_date(self, har_path, enable_stopwords=1, min_len=min_token_len):
+        """har 已经以相同的参数索引过，且之后没有变化"""
+        har_path = os.path.abspath(har_path)
+        row = self._conn.execute('SELECT size, mtime, enable_stopwords, min_len FROM har_files WHERE path = ?',
+                                 (har_path,)).fetchone()
+        if row is None:
+            return False
+
+        stat = os.stat(har_path)
+        return row == (stat.st_size, stat.st_mtime, enable_stopwords, min_len)
+
+    def index_har(self, har_path, enable_stopwords=1, min_len=min_token_len, force=False):
+        """
+        索引一个 har 文件（会替换它之前的索引结果），在一个事务中完成，中断时不会留下一半的结果
+        :param enable_stopwords: 停用词过滤模式，见 get_values_from_entry
+        :param min_len: 最小 token 长度
+        :param force: 是否在文件没有变化时也重新索引
+        :return: 是否重新索引了
+        """
+        if not force and self.is_up_to_date(har_path, enable_stopwords, min_len):
+            return False
+
+        har_path = os.path.abspath(har_path)
+        stat = os.stat(har_path)
+        with self._conn:
+            self._remove(har_path)
+            file_id = self._conn.execute(
+                'INSERT INTO har_files (path, size, mtime, enable_stopwords, min_len, indexed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (har_path, stat.st_size, stat.st_mtime, enable_stopwords, min_len, time.time())).lastrowid
+
+            batch = []
+            for value, md5, hostname, domain, location, key in iter_occurrences(har_path, enable_stopwords, min_len):
+                batch.append((value, file_id, md5, hostname, domain, location, key))
+                if len(batch) >= insert_batch_size:
+                    self._insert(batch)
+                    batch = []
+            self._insert(batch)
+
+        return True
+
+    def _insert(self, rows):
+        self._conn.executemany('INSERT INTO occurrences (value, file_id, md5, hostname, domain, location, key) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def _remove(self, har_path):
+        har_path = os.path.abspath(har_path)
+        row = self._conn.execute('SELECT id FROM har_files WHERE path = ?', (har_path,)).fetchone()
+        if row is not None:
+            self._conn.execute('DELETE FROM occurrences WHERE file_id = ?', row)
+            self._conn.execute('DELETE FROM har_files WHERE id = ?', row)
+
+    def remove_har(self, har_path):
+        """从索引中删除一个 har 文件"""
+        with self._conn:
+            self._remove(har_path)
+
+    def update(self, har_paths, enable_stopwords=1, min_len=min_token_len, prune=True, enable_print=True):
+        """
+        增量更新索引
+        :param har_paths: har 文件路径列表
+        :param prune: 是否删除已经不存在的 har 文件的索引
+        :return: 重新索引的文件列表
+        """
+        updated = []
+        for har_path in har_paths:
+            start_time = time.time()
+            if self.index_har(har_path, enable_stopwords, min_len):
+                updated.append(har_path)
+                if enable_print:
+                    print(f"indexed |{har_path}| in {time.time() - start_time:.2f}s")
+
+        if prune:
+            for har_path in self.get_har_paths():
+                if not os.path.exists(har_path):
+                    self.remove_har(har_path)
+
+        return updated
+
+    def get_index_params(self):
+        """
+        :return: 已索引的文件最常使用的参数 {'enable_stopwords', 'min_len'}，索引为空时返回 None
+        """
+        row = self._conn.execute('SELECT enable_stopwords, min_len FROM har_files '
+                                 'GROUP BY enable_stopwords, min_len ORDER BY COUNT(*) DESC LIMIT 1').fetchone()
+        if row is None:
+            return None
+
+        return {'enable_stopwords': row[0], 'min_len': row[1]}
+
+    def get_har_paths(self):
+        """已索引的 har 文件路径列表"""
+        return [row[0] for row in self._conn.execute('SELECT path FROM har_files ORDER BY path')]
+
+    def lookup(self, value):
+        """
+        查询一个 value 的所有出现位置
+        :return: Occurrence 列表
+        """
+        rows = self._conn.execute(
+            'SELECT f.path, o.md5, o.hostname, o.domain, o.location, o.key '
+            'FROM occurrences o JOIN har_files f ON o.file_id = f.id '
+            'WHERE o.value = ? ORDER BY f.path, o.rowid', (value,))
+        return [Occurrence(*row) for row in rows]
+
+    def get_domains(self, value):
+        """
+        一个 value 被发送到了哪些域名
+        :return: dict, key: 可注册域名, value: 出现该 value 的 har 文件路径列表
+        """
+        res = {}
+        for har_path, domain in self._conn.execute(
+                'SELECT DISTINCT f.path, o.domain FROM occurrences o JOIN har_files f ON o.file_id = f.id '
+                'WHERE o.value = ? ORDER BY o.domain, f.path', (value,)):
+            res.setdefault(domain, []).append(har_path)
+
+        return res
+
+    def find_multi_domain_values(self, min_domains=2):
+        """
+        所有被发送到不少于 min_domains 个可注册域名的 value（跨所有已索引的 har 文件）
+        :return: dict, key: value, value: 域名个数
+        """
+        rows = self._conn.execute('SELECT value, COUNT(DISTINCT domain) AS n FROM occurrences '
+                                  'GROUP BY value HAVING n >= ? ORDER BY n DESC, value', (min_domains,))
+        return dict(rows.fetchall())
+
+
+def update_token_index(har_dir='./har_files', only_hash=True, db_path=token_index_path, enable_stopwords=1,
+                       min_len=min_token_len):
+    """增量更新 har_dir 下所有 har 文件的索引，返回重新索引的文件列表"""
+    with TokenIndex(db_path) as index:
+        return index.update(list_har_files(har_dir, only_hash=only_hash), enable_stopwords, min_len)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='跨 har 文件的 value 倒排索引')
+    parser.add_argument('values', nargs='*', help='要查询的 value，不指定时只更新索引')
+    parser.add_argument('--dir', default='./har_files', help='har 文件目录')
+    parser.add_argument('--all', action='store_true', help='同时索引不带 _md5 后缀的 har 文件')
+    parser.add_argument('--stopwords', type=int, default=1, choices=[0, 1, 2], help='停用词过滤模式')
+    parser.add_argument('--db', default=token_index_path, help='索引数据库路径')
+    args = parser.parse_args()
+
+    update_token_index(args.dir, only_hash=not args.all, db_path=args.db, enable_stopwords=args.stopwords)
+
+    with TokenIndex(args.db) as token_index:
+        for target in args.values:
+            print(f"{target}:")
+            for occurrence in token_index.lookup(target):
+                print(f"    {os.path.basename(occurrence.har_path)} | {occurrence.md5} | {occurrence.domain} | "
+                      f"{occurrence.location}: {occurrence.key}")
@@ -0,0 +1,434 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from urllib.parse import urlparse
+
+from base import get_md5_from_entry
+from detect_cross_domain import get_domain
+from extract_fields import extract_fields
+from find_tokens import find_tokens_in_fields
+from get_values import get_values_from_fields
+from global_config import thin_split
+from har_reader import iter_har_entries, list_har_files
+
+watch_state_path = r'./watch_state.sqlite'
+
+# NDJSON 文件的扩展名，每行一个 entry
+ndjson_ext = '.ndjson'
+
+# NDJSON 每处理多少行提交一次状态
+commit_batch_size = 1000
+
+# 一次新的发现
+#   method: 'compare'（value 出现在新的域名中，且该 value 已经出现在其他域名中）或 'keyname'（第一次根据 keyname 发现的 token）
+#   value: token 的值
+#   key: keyname 方式中 token 的 key name，compare 方式为 None
+#   domain: 分组的域名，netloc: 请求的完整域名，md5: 请求的 md5
+#   known_domains: 这个 value 之前出现过的域名
+#   source: 来源文件路径
+Sighting = namedtuple('Sighting', ['method', 'value', 'key', 'domain', 'netloc', 'md5', 'known_domains', 'source'])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS source_entries (
+    path TEXT NOT NULL,
+    md5 TEXT NOT NULL,
+    PRIMARY KEY (path, md5)
+);
+CREATE TABLE IF NOT EXISTS value_domains (
+    value TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    netloc TEXT NOT NULL,
+    first_md5 TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (value, domain)
+);
+CREATE TABLE IF NOT EXISTS keyname_tokens (
+    value TEXT PRIMARY KEY,
+    key TEXT,
+    first_md5 TEXT NOT NULL,
+    first_seen REAL NOT NULL
+);
+"""
+
+
+def print_sighting(sighting):
+    if sighting.method == 'keyname':
+        print(f"[keyname] new token {sighting.key}: {sighting.value}\n"
+              f"    domain: {sighting.netloc} | md5: {sighting.md5} | {os.path.basename(sighting.source)}")
+    else:
+        print(f"[cross domain] value: {sighting.value}\n"
+              f"    new domain: {sighting.netloc} | md5: {sighting.md5} | {os.path.basename(sighting.source)}\n"
+              f"    known domains: {sighting.known_domains}")
+    print(thin_split)
+
+
+class NdjsonEntryWriter:
+    """
+    以 NDJSON 格式（每行一个 entry）追加写入 entry，每个 entry 写完立即 flush，
+    可以作为代理插件的替身，用于测试 watch 模式
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'a', encoding='utf-8')
+
+    def write(self, entry):
+        self._f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TokenWatcher:
+    """
+    持续检测不断增长的抓包：
+    - 目录中新出现的（或有变化的）.har 文件，在 settle_time 秒内没有再被修改后整体处理一次
+    - .ndjson 文件（每行一个 entry，例如代理插件追加写入的）从上次读到的位置继续读取完整的行
+    对新的 entry 同时进行 keyname 和 compare 两种检测，value 在新的域名中出现且之前已出现在其他域名中时，
+    以及第一次根据 keyname 发现 token 时，报告一次新的发现
+    每个 value 的状态和每个文件读到的位置保存在 SQLite 中（同一个事务），重启之后不会重复处理已经处理过的 entry；
+    .har 文件有变化时会整体重新读取，其中已经处理过的 entry（按 md5）跳过，不会重复计数
+    """
+
+    def __init__(self, paths, state_path=watch_state_path, enable_stopwords=1, keyname_stopwords=True,
+                 level=2, use_psl=False, only_hash=False, settle_time=2.0, on_sighting=print_sighting):
+        """
+        :param paths: 要监视的目录或文件（.har / .ndjson）路径列表
+        :param state_path: 状态数据库路径
+        :param enable_stopwords: compare 方式的停用词过滤，同 find_tokens_by_compare
+        :param keyname_stopwords: keyname 方式的停用词过滤，同 find_tokens_by_keyname
+        :param level: 分组的域名级别，同 group_by_domain
+        :param use_psl: 同 group_by_domain
+        :param only_hash: 目录中只处理带 _md5 后缀的 har 文件（.ndjson 文件不受影响）
+        :param settle_time: .har 文件最后一次修改之后等待的秒数，避免处理写了一半的文件
+        :param on_sighting: 每次新的发现时调用，参数为 Sighting
+        """
+        self.paths = paths
+        self.enable_stopwords = enable_stopwords
+        self.keyname_stopwords = keyname_stopwords
+        self.level = level
+        self.use_psl = use_psl
+        self.only_hash = only_hash
+        self.settle_time = settle_time
+        self.on_sighting = on_sighting
+
+        self._conn = sqlite3.connect(state_path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _list_sources(self):
+        sources = []
+        for path in self.paths:
+            if os.path.isdir(path):
+                sources.extend(list_har_files(path, only_hash=self.only_hash))
+                sources.extend(os.path.join(path, f) for f in os.listdir(path) if f.endswith(ndjson_ext))
+            elif os.path.exists(path):
+                sources.append(path)
+
+        return sorted(sources)
+
+    def _get_source_state(self, path):
+        row = self._conn.execute('SELECT offset, size, mtime FROM sources WHERE path = ?', (path,)).fetchone()
+        return row if row is not None else (0, -1, -1.0)
+
+    def _set_source_state(self, path, offset, size, mtime):
+        self._conn.execute('INSERT OR REPLACE INTO sources (path, offset, size, mtime) VALUES (?, ?, ?, ?)',
+                           (path, offset, size, mtime))
+
+    def poll(self):
+        """
+        检查所有来源一次，处理新的 entry
+        :return: 本次的新发现（Sighting 列表）
+        """
+        sightings = []
+        for path in self._list_sources():
+            if path.endswith(ndjson_ext):
+                sightings.extend(self._poll_ndjson(path))
+            else:
+                sightings.extend(self._poll_har(path))
+
+        return sightings
+
+    def _poll_har(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        _, size, mtime = self._get_source_state(path)
+        if (size, mtime) == (stat.st_size, stat.st_mtime) or time.time() - stat.st_mtime < self.settle_time:
+            return []
+
+        # 有变化的 har 整体重新读取，只处理这个文件中之前没有处理过的 entry（按 md5）
+        # 写了一半或格式错误的 har 读取出错时，保留已经处理的 entry 并记录文件的状态，文件再次变化时才重新读取
+        sightings = []
+        with self._conn:
+            try:
+                for entry in iter_har_entries(path):
+                    # 处理出错的 entry 回滚到 savepoint，不记录为已处理，文件再次变化时重试
+                    self._conn.execute('SAVEPOINT watch_entry')
+                    try:
+                        md5 = get_md5_from_entry(entry)
+                        if not self._conn.execute('SELECT 1 FROM source_entries WHERE path = ? AND md5 = ?',
+                                                  (path, md5)).fetchone():
+                            entry_sightings = self._process_entry(entry, path)
+                            self._conn.execute('INSERT INTO source_entries (path, md5) VALUES (?, ?)', (path, md5))
+                            sightings.extend(entry_sightings)
+                    except (ValueError, KeyError, TypeError) as e:
+                        self._conn.execute('ROLLBACK TO watch_entry')
+                        print(f"invalid entry in |{path}|: {type(e).__name__}: {e}")
+                    self._conn.execute('RELEASE watch_entry')
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"failed to read |{path}|: {type(e).__name__}: {e}")
+
+            self._set_source_state(path, 0, stat.st_size, stat.st_mtime)
+
+        return sightings
+
+    def _poll_ndjson(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        offset, size, mtime = self._get_source_state(path)
+        if (size, mtime) == (stat.st_size, stat.st_mtime):
+            # 上次检查之后没有变化，不需要打开文件
+            return []
+        if stat.st_size < offset or not _ends_with_newline(path, offset):
+            # 文件被截断，或被替换（轮转）为另一个文件（上次读到的位置不再是一行的结尾），从头读取
+            offset = 0
+        if stat.st_size == offset:
+            with self._conn:
+                self._set_source_state(path, offset, stat.st_size, stat.st_mtime)
+            return []
+
+        sightings = []
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            done = False
+            while not done:
+                # 每一批 entry 和读到的位置在同一个事务中提交，中断后不会重复或遗漏
+                with self._conn:
+                    for _ in range(commit_batch_size):
+                        line = f.readline()
+                        if not line.endswith(b'\n'):
+                            # 文件结束，或最后一行还在写入中，下次从这一行的开头读取
+                            done = True
+                            break
+
+                        offset += len(line)
+                        if not line.strip():
+                            continue
+
+                        try:
+                            entry = json.loads(line)
+                            sightings.extend(self._process_entry(entry, path))
+                        except (ValueError, KeyError, TypeError) as e:
+                            # 跳过无法解析的行，不影响之后的 entry
+                            print(f"invalid entry in |{path}| before offset {offset}: {type(e).__name__}: {e}")
+
+                    self._set_source_state(path, offset, stat.st_size, stat.st_mtime)
+
+        return sightings
+
+    def _process_entry(self, entry, source):
+        """对一个 entry 进行检测，更新状态（不提交），返回新的发现"""
+        md5 = get_md5_from_entry(entry)
+        url = entry['request']['url']
+        domain = get_domain(url, domain_level=self.level, with_suffix=False, use_psl=self.use_psl)
+        netloc = urlparse(url).netloc
+        now = time.time()
+        fields = extract_fields(entry)
+
+        sightings = []
+        try:
+            tokens = find_tokens_in_fields(fields, level=2, enable_stopwords=self.keyname_stopwords)
+        except ValueError as e:
+            # 持续运行时不因为单个请求中断，只跳过这个请求的 keyname 检测
+            print(f"keyname detection skipped for {md5}: {e}")
+            tokens = {}
+
+        for key, value in tokens.items():
+            value = str(value)
+            cursor = self._conn.execute('INSERT OR IGNORE INTO keyname_tokens (value, key, first_md5, first_seen) '
+                                        'VALUES (?, ?, ?, ?)', (value, key, md5, now))
+            if cursor.rowcount:
+                sightings.append(Sighting('keyname', value, key, domain, netloc, md5, [], source))
+
+        for value in get_values_from_fields(fields, enable_stopwords=self.enable_stopwords):
+            cursor = self._conn.execute('UPDATE value_domains SET count = count + 1 WHERE value = ? AND domain = ?',
+                                        (value, domain))
+            if cursor.rowcount:
+                continue
+
+            known_domains = [row[0] for row in self._conn.execute(
+                'SELECT netloc FROM value_domains WHERE value = ? ORDER BY first_seen', (value,))]
+            self._conn.execute('INSERT INTO value_domains (value, domain, netloc, first_md5, first_seen, count) '
+                               'VALUES (?, ?, ?, ?, ?, 1)', (value, domain, netloc, md5, now))
+            if known_domains:
+                sightings.append(Sighting('compare', value, None, domain, netloc, md5, known_domains, source))
+
+        for sighting in sightings:
+            self.on_sighting(sighting)
+
+        return sightings
+
+    def get_domains(self, value):
+        """value 出现过的域名（分组的域名）及请求数"""
+        return dict(self._conn.execute('SELECT domain, count FROM value_domains WHERE value = ? ORDER BY first_seen',
+                                       (value,)).fetchall())
+
+    def watch(self, interval=1.0, max_polls=None):
+        """
+        每 interval 秒检查一次，直到 Ctrl+C（或检查了 max_polls 次）
+        """
+        polls = 0
+        try:
+            while max_polls is None or polls < max_polls:
+                self.poll()
+                polls += 1
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+
+def _ends_with_newline(path, offset):
+    """offset 为 0，或文件中 offset 之前的一个字节是换行符（即 offset 是一行的开头）"""
+    if offset == 0:
+        return True
+
+    with open(path, 'rb') as f:
+        f.seek(offset - 1)
+        return f.read(1) == b'\n'
+
+
+def test_watch_mode():
+    """
+    在临时目录中检查 TokenWatcher：
+    - 用 NdjsonEntryWriter 追加 entry，poll 只报告一次跨域的发现，最后一行写了一半时等它写完再处理
+    - .ndjson 被替换（轮转）为另一个文件时从头读取
+    - 有变化的 .har 重新读取时不重复计数，处理出错的 entry 在文件再次变化时重试，格式错误的 .har 不会中断 poll
+    """
+    import tempfile
+
+    def make_entry(url, started_date_time):
+        return {'startedDateTime': started_date_time,
+                'request': {'method': 'GET', 'url': url, 'headers': [], 'cookies': []}}
+
+    def make_har(entries):
+        return json.dumps({'log': {'entries': entries}})
+
+    value = 'Qx7Lm2Rt5Wp8Kz3N'
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stream_dir = os.path.join(tmp_dir, 'stream')
+        os.mkdir(stream_dir)
+        with TokenWatcher([stream_dir], state_path=os.path.join(tmp_dir, 'state.sqlite'), settle_time=0,
+                          on_sighting=lambda sighting: None) as watcher:
+            ndjson_path = os.path.join(stream_dir, 'proxy.ndjson')
+            with NdjsonEntryWriter(ndjson_path) as writer:
+                writer.write(make_entry(f'https://a.alpha.com/x?trace={value}', '2024-08-10T12:00:00.000Z'))
+                writer.write(make_entry(f'https://b.beta.org/y?trace={value}', '2024-08-10T12:00:01.000Z'))
+
+            sightings = [s for s in watcher.poll() if s.method == 'compare']
+            if [(s.value, s.netloc, s.known_domains) for s in sightings] != \
+                    [(value, 'b.beta.org', ['a.alpha.com'])]:
+                raise AssertionError(f'unexpected sightings: {sightings}')
+            if watcher.poll():
+                raise AssertionError('sightings reported twice')
+
+            # 最后一行还在写入中
+            with open(ndjson_path, 'a', encoding='utf-8') as f:
+                line = json.dumps(make_entry(f'https://c.gamma.net/z?trace={value}', '2024-08-10T12:00:02.000Z'))
+                f.write(line[:20])
+                f.flush()
+                if watcher.poll():
+                    raise AssertionError('incomplete line processed')
+                f.write(line[20:] + '\n')
+            sightings = [s for s in watcher.poll() if s.method == 'compare']
+            if [s.netloc for s in sightings] != ['c.gamma.net']:
+                raise AssertionError(f'unexpected sightings: {sightings}')
+
+            # 轮转：替换为一个更大的新文件，上次读到的位置落在新文件的一行中间
+            offset = os.path.getsize(ndjson_path)
+            entry = make_entry(f'https://d.delta.io/{"p" * offset}?trace={value}', '2024-08-10T12:00:03.000Z')
+            with open(ndjson_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+            os.replace(ndjson_path + '.tmp', ndjson_path)
+            sightings = [s for s in watcher.poll() if s.method == 'compare']
+            if [s.netloc for s in sightings] != ['d.delta.io']:
+                raise AssertionError(f'rotated file not read from the start: {sightings}')
+
+        har_dir = os.path.join(tmp_dir, 'har')
+        os.mkdir(har_dir)
+        with TokenWatcher([har_dir], state_path=os.path.join(tmp_dir, 'har_state.sqlite'), settle_time=0,
+                          on_sighting=lambda sighting: None) as watcher:
+            entries = [make_entry(f'https://a.alpha.com/x?trace={value}', '2024-08-10T12:00:00.000Z'),
+                       make_entry(f'https://b.beta.org/y?trace={value}', '2024-08-10T12:00:01.000Z')]
+            har_path = os.path.join(har_dir, 'capture.har')
+            with open(har_path, 'w', encoding='utf-8') as f:
+                f.write(make_har(entries))
+
+            # 第一个 entry 处理出错，它的状态回滚，不记录为已处理
+            process_entry = watcher._process_entry
+            failed = []
+
+            def process_entry_once_failing(entry, source):
+                if not failed:
+                    failed.append(entry)
+                    raise ValueError('simulated failure')
+                return process_entry(entry, source)
+
+            watcher._process_entry = process_entry_once_failing
+            watcher.poll()
+            if watcher.get_domains(value) != {'beta': 1}:
+                raise AssertionError(f'unexpected counts: {watcher.get_domains(value)}')
+
+            # 重写 har（追加一个 entry），已经处理过的 entry 不重复计数，出错的 entry 重试
+            entries.append(make_entry(f'https://b.beta.org/z?trace={value}', '2024-08-10T12:00:02.000Z'))
+            with open(har_path, 'w', encoding='utf-8') as f:
+                f.write(make_har(entries))
+            watcher.poll()
+            if watcher.get_domains(value) != {'alpha': 1, 'beta': 2}:
+                raise AssertionError(f'unexpected counts: {watcher.get_domains(value)}')
+
+            # 写了一半的 har
+            with open(os.path.join(har_dir, 'partial.har'), 'w', encoding='utf-8') as f:
+                f.write(make_har(entries)[:60])
+            watcher.poll()
+
+    print('TokenWatcher test passed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='持续检测不断增长的抓包（目录中的 .har 文件或 .ndjson entry 流）')
+    parser.add_argument('paths', nargs='*', default=['./har_files'], help='要监视的目录或文件')
+    parser.add_argument('--state', default=watch_state_path, help='状态数据库路径')
+    parser.add_argument('--interval', type=float, default=1.0, help='检查间隔（秒）')
+    parser.add_argument('--stopwords', type=int, default=2, choices=[0, 1, 2], help='compare 方式的停用词过滤模式')
+    parser.add_argument('--psl', action='store_true', help='按公共后缀列表得到的可注册域名分组')
+    args = parser.parse_args()
+
+    with TokenWatcher(args.paths, state_path=args.state, enable_stopwords=args.stopwords,
+                      use_psl=args.psl) as watcher:
+        watcher.watch(interval=args.interval)